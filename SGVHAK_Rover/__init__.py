@@ -26,7 +26,8 @@ from flask import Flask
 app = Flask(__name__)
 
 # Randomly generated key means session cookies will not be usable across
-# instances. This is acceptable for now but may need changing later.
-app.secret_key = os.urandom(24)
+# instances. When running several web workers, set SGVHAK_SECRET_KEY so
+# they all share one key.
+app.secret_key = os.environ.get('SGVHAK_SECRET_KEY') or os.urandom(24)
 
 import SGVHAK_Rover.menu
\ No newline at end of file
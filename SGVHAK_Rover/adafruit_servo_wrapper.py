@@ -22,15 +22,73 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import configuration
+import motor_control
 import Adafruit_PCA9685
 
-class adafruit_servo_wrapper:
+# Typical hobby servo speed is 0.15 seconds per 60 degrees.
+degrees_per_second = 400
+
+class velocity_handle(object):
   """
-  Class that wraps the Adafruit PCA9685 servo control HAT with the motor
-  interface expected by roverchassis class.
+  Continuous rotation control of a single servo on the HAT. Servo number and
+  its pulse parameters are looked up once when the handle is created,
+  leaving only arithmetic and the I2C write for each command.
+
+  setpoint() translates percentage into PWM pulse count, which is passed to
+  send().
+  """
+  __slots__ = ('address', 'pulsezero', 'pulsemax', 'deadband', 'set_pwm')
+
+  def __init__(self, wrapper, id):
+    self.address = wrapper.check_id(id)
+    wrapper.check_pwmhat()
+
+    self.pulsezero = wrapper.servoparams[self.address][0]
+    self.pulsemax = wrapper.servoparams[self.address][2]
+    self.deadband = wrapper.velocity_deadband
+    self.set_pwm = wrapper.pwm.set_pwm
+
+  def setpoint(self, pct_velocity):
+    pct = int(pct_velocity)
+    if abs(pct) > 100:
+      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
+
+    return int(self.pulsezero + (pct*(self.pulsemax-self.pulsezero))/100)
+
+  def send(self, pulse):
+    self.set_pwm(self.address, 0, pulse)
+
+class angle_handle(object):
+  """
+  Position control of a single servo on the HAT, see velocity_handle.
 
-  Goal: Eventually have an abstract base class or interface shared with the
-  other motor control classes. For more details see roboclaw_wrapper.py
+  setpoint() translates angle in degrees off center into PWM pulse count,
+  which is passed to send().
+  """
+  __slots__ = ('address', 'pulsezero', 'anglemax', 'pulsemax', 'deadband', 'set_pwm')
+
+  def __init__(self, wrapper, id):
+    self.address = wrapper.check_id(id)
+    wrapper.check_pwmhat()
+
+    self.pulsezero, self.anglemax, self.pulsemax = wrapper.servoparams[self.address]
+    self.deadband = wrapper.angle_deadband
+    self.set_pwm = wrapper.pwm.set_pwm
+
+  def setpoint(self, angle):
+    if abs(angle) > self.anglemax:
+      raise ValueError("Angle {} exceeds maximum allowable up to {} degrees off center".format(angle,self.anglemax))
+
+    fraction = float(angle)/self.anglemax
+    return int(self.pulsezero + fraction*(self.pulsemax-self.pulsezero))
+
+  def send(self, pulse):
+    self.set_pwm(self.address, 0, pulse)
+
+class adafruit_servo_wrapper(motor_control.motor_control):
+  """
+  Class that wraps the Adafruit PCA9685 servo control HAT with the motor
+  interface expected by roverchassis class, see motor_control.py
   """
 
   def __init__(self):
@@ -43,6 +101,10 @@ class adafruit_servo_wrapper:
     # * third element of touple is the pulse count for maximum angle.
     self.servoparams = list()
 
+    # Changes smaller than these many PWM pulse ticks are not worth sending.
+    self.velocity_deadband = 0
+    self.angle_deadband = 0
+
   @staticmethod
   def check_id(id):
     """
@@ -67,15 +129,18 @@ class adafruit_servo_wrapper:
     if self.pwm == None:
       raise ValueError("Adafruit Servo HAT not yet connected")
 
-  def connect(self):
+  def connect(self, instance=None):
     """
     Read configuration parameters and use them to create an instance of the
     Adafruit PWM control class.
+
+    Given one of the "instances" in the configuration file, connect to that
+    instance instead.
     """
 
     # Load configuration file
     config = configuration.configuration("adafruit_servo")
-    allparams = config.load()
+    allparams = config.load(instance)
 
     self.servoparams = allparams['servos']
     if len(self.servoparams) != 16:
@@ -84,9 +149,23 @@ class adafruit_servo_wrapper:
     i2cbus = allparams['bus']
     i2caddr = allparams['address']
     self.pwm = Adafruit_PCA9685.PCA9685(address=i2caddr, busnum=i2cbus)
+    self.i2caddr = i2caddr
+    self.bus = "i2c-{}".format(i2cbus)
 
     self.pwm.set_pwm_freq(allparams['pwm_freq'])
 
+    deadband = allparams.get('deadband', dict())
+    self.velocity_deadband = deadband.get('velocity', 0)
+    self.angle_deadband = deadband.get('angle', 0)
+
+  def device(self, id):
+    """ All 16 servos are driven by one HAT """
+    return "Servo HAT 0x{:02x}".format(self.i2caddr)
+
+  def probe(self, id):
+    """ Nothing to read back from the HAT, writes fail with an exception """
+    self.check_pwmhat()
+
   def version(self, id):
     """
     Returns a version string for display - the servo HAT doesn't really have
@@ -116,27 +195,28 @@ class adafruit_servo_wrapper:
 
     self.pwm.set_pwm(address, 0, pulse)
 
+  def emergency_stop(self, ids):
+    """
+    Cut power to all 16 PWM channels at once with ALL_LED registers.
+    """
+    self.check_pwmhat()
+    self.pwm.set_all_pwm(0, 0)
+
   def init_velocity(self, id):
     """ Initializes controller for velocity - no-op in case of servo HAT. """
     return True
 
+  def velocity_handle(self, id):
+    """ Returns a velocity_handle for the specified servo """
+    return velocity_handle(self, id)
+
   def velocity(self, id, pct_velocity):
     """
     Very similar to power_percent for this servo HAT, except zero percent will
     try to hold at zero instead of cutting power.
     """
-    address = self.check_id(id)
-    self.check_pwmhat()
-
-    pct = int(pct_velocity)
-    if abs(pct) > 100:
-      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
-
-    pulsezero = self.servoparams[address][0]
-    pulsemax = self.servoparams[address][2]
-    pulse = int(pulsezero + (pct*(pulsemax-pulsezero))/100)
-
-    self.pwm.set_pwm(address, 0, pulse)
+    handle = self.velocity_handle(id)
+    handle.send(handle.setpoint(pct_velocity))
 
   def init_angle(self, id):
     """ Initializes controller for angle - no-op in case of servo HAT. """
@@ -151,23 +231,29 @@ class adafruit_servo_wrapper:
 
     return self.servoparams[address][1]
 
+  def angle_handle(self, id):
+    """ Returns an angle_handle for the specified servo """
+    return angle_handle(self, id)
+
   def angle(self, id, angle):
     """
     Moves the identified servo to the specified angle expressed in number of
     degrees off zero center, positive clockwise.
     """
-    address = self.check_id(id)
-    self.check_pwmhat()
-
-    pulsezero, anglemax, pulsemax = self.servoparams[address]
+    handle = self.angle_handle(id)
+    handle.send(handle.setpoint(angle))
 
-    if abs(angle) > anglemax:
-      raise ValueError("Angle {} exceeds maximum allowable up to {} degrees off center".format(angle,anglemax))
-
-    fraction = float(angle)/anglemax
-    pulse = int(pulsezero + fraction*(pulsemax-pulsezero))
+  def steering_position(self, id):
+    """
+    Hobby servos don't report their position.
+    """
+    return None
 
-    self.pwm.set_pwm(address, 0, pulse)
+  def steering_time(self, id, degrees):
+    """
+    Estimated number of seconds to turn through the given number of degrees.
+    """
+    return float(degrees) / degrees_per_second
 
   def steer_setzero(self, id):
     """
@@ -0,0 +1,637 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import errno
+import fcntl
+import heapq
+import os
+import select
+import threading
+
+import rovertime
+from rovertime import monotonic
+
+# Single threaded concurrency for the serial bus motor controllers, without
+# the busowner threads. Python 2 has no asyncio, so this is a small event loop
+# of its own built on select() and non-blocking file descriptors, with
+# coroutines written as generators in the style of Tornado: a coroutine yields
+# a future to wait for its result, and finishes with a value by raising
+# coroutine_return(value).
+#
+# Serial ports opened by pyserial on Linux are already non-blocking, so the
+# file descriptor of a connected motor controller can be used as-is. While
+# the event loop is talking over a serial port, the bus owner thread of that
+# port is held off it (see busowner.bus_hold), so other threads' commands
+# wait their turn instead of colliding with ours.
+
+class coroutine_return(Exception):
+  """ Raised by a coroutine to finish with a value """
+  def __init__(self, value=None):
+    Exception.__init__(self, value)
+    self.value = value
+
+class future(object):
+  """ Result of an operation that has not finished yet """
+  def __init__(self):
+    self.finished = False
+    self.value = None
+    self.error = None
+    self.callbacks = list()
+
+  def done(self):
+    return self.finished
+
+  def set_result(self, value):
+    self.value = value
+    self.finish()
+
+  def set_exception(self, error):
+    self.error = error
+    self.finish()
+
+  def finish(self):
+    self.finished = True
+    callbacks = self.callbacks
+    self.callbacks = list()
+    for callback in callbacks:
+      callback(self)
+
+  def add_done_callback(self, callback):
+    if self.finished:
+      callback(self)
+    else:
+      self.callbacks.append(callback)
+
+  def result(self):
+    """ Value of a finished future, or raise its error """
+    if not self.finished:
+      raise ValueError("Result requested before future finished")
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+class task(future):
+  """
+  Runs a generator based coroutine on the event loop. The task itself is a
+  future for the coroutine's value.
+  """
+  def __init__(self, loop, coroutine):
+    future.__init__(self)
+    self.loop = loop
+    self.coroutine = coroutine
+    loop.call_soon(self.step, None, None)
+
+  def step(self, value, error):
+    try:
+      if error is not None:
+        waitfor = self.coroutine.throw(error)
+      else:
+        waitfor = self.coroutine.send(value)
+    except coroutine_return as cr:
+      self.set_result(cr.value)
+      return
+    except StopIteration:
+      self.set_result(None)
+      return
+    except Exception as e:
+      self.set_exception(e)
+      return
+
+    if not isinstance(waitfor, future):
+      # Allow yielding another coroutine directly.
+      waitfor = task(self.loop, waitfor)
+    waitfor.add_done_callback(self.wakeup)
+
+  def wakeup(self, finished):
+    self.loop.call_soon(self.step, finished.value, finished.error)
+
+class eventloop:
+  """
+  Runs callbacks when file descriptors are ready or timers expire. Use
+  spawn() to start a coroutine and run_until_complete() to run the loop
+  until a coroutine or future is done.
+  """
+  def __init__(self):
+    self.readers = dict()
+    self.writers = dict()
+    self.timers = list()
+    self.ready = list()
+    self.sequence = 0
+
+    # Callbacks from other threads, and a pipe they write to so select()
+    # wakes up for them. 'awaiting' counts threadsafe futures not yet done.
+    self.threadsafe = list()
+    self.threadsafelock = threading.Lock()
+    self.wakeup = os.pipe()
+    for fd in self.wakeup:
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    self.awaiting = 0
+
+  def close(self):
+    """ Release the wakeup pipe. The loop can not be used afterwards. """
+    for fd in self.wakeup:
+      os.close(fd)
+
+  def call_soon(self, callback, *args):
+    self.ready.append((callback, args))
+
+  def call_soon_threadsafe(self, callback, *args):
+    """ call_soon() that may be called from any thread """
+    with self.threadsafelock:
+      self.threadsafe.append((callback, args))
+    try:
+      os.write(self.wakeup[1], b'\0')
+    except OSError as oe:
+      # Pipe full means a wakeup is already pending.
+      if oe.errno != errno.EAGAIN:
+        raise
+
+  def threadsafe_future(self):
+    """
+    Returns (future, finish) where another thread calls finish(value) to
+    give the future its result. The loop keeps waiting for it, see
+    run_until_complete()
+    """
+    waiting = future()
+    self.awaiting = self.awaiting + 1
+
+    def deliver(value):
+      self.awaiting = self.awaiting - 1
+      waiting.set_result(value)
+
+    def finish(value=None):
+      self.call_soon_threadsafe(deliver, value)
+
+    return waiting, finish
+
+  def call_later(self, delay, callback, *args):
+    """ Returns timer which can be passed to cancel_timer() """
+    self.sequence = self.sequence + 1
+    timer = [monotonic() + delay, self.sequence, callback, args]
+    heapq.heappush(self.timers, timer)
+    return timer
+
+  @staticmethod
+  def cancel_timer(timer):
+    timer[2] = None
+
+  def add_reader(self, fd, callback):
+    self.readers[fd] = callback
+
+  def remove_reader(self, fd):
+    self.readers.pop(fd, None)
+
+  def add_writer(self, fd, callback):
+    self.writers[fd] = callback
+
+  def remove_writer(self, fd):
+    self.writers.pop(fd, None)
+
+  def spawn(self, coroutine):
+    """ Start running a coroutine, returns its task """
+    return task(self, coroutine)
+
+  def run_once(self):
+    """ Wait for at least one thing to happen and run its callbacks """
+    timeout = None
+    if self.ready:
+      timeout = 0
+    elif self.timers:
+      timeout = max(0, self.timers[0][0] - monotonic())
+
+    readers = list(self.readers)
+    if self.awaiting:
+      readers.append(self.wakeup[0])
+    if readers or self.writers:
+      readable, writable, failed = select.select(readers, list(self.writers), [], timeout)
+      for fd in readable:
+        if fd in self.readers:
+          self.readers[fd]()
+      for fd in writable:
+        if fd in self.writers:
+          self.writers[fd]()
+    elif timeout:
+      select.select([], [], [], timeout)
+
+    if self.threadsafe:
+      try:
+        while os.read(self.wakeup[0], 256):
+          pass
+      except OSError as oe:
+        if oe.errno != errno.EAGAIN:
+          raise
+      with self.threadsafelock:
+        self.ready.extend(self.threadsafe)
+        self.threadsafe = list()
+
+    now = monotonic()
+    while self.timers and self.timers[0][0] <= now:
+      when, sequence, callback, args = heapq.heappop(self.timers)
+      if callback:
+        callback(*args)
+
+    ready = self.ready
+    self.ready = list()
+    for callback, args in ready:
+      callback(*args)
+
+  def run_until_complete(self, waitfor):
+    """ Run until given coroutine or future finishes, returns its result """
+    if not isinstance(waitfor, future):
+      waitfor = self.spawn(waitfor)
+    while not waitfor.done():
+      if not (self.ready or self.timers or self.readers or self.writers or self.awaiting):
+        raise ValueError("Event loop has nothing to do but {} has not finished".format(waitfor))
+      self.run_once()
+    return waitfor.result()
+
+def gather(futures):
+  """
+  Future for the list of results of all given futures, once they have all
+  finished. If any failed, raises the first error.
+  """
+  gathered = future()
+  futures = list(futures)
+  remaining = [len(futures)]
+
+  def finished(f):
+    remaining[0] = remaining[0] - 1
+    if remaining[0] == 0:
+      for f in futures:
+        if f.error is not None:
+          gathered.set_exception(f.error)
+          return
+      gathered.set_result([f.value for f in futures])
+
+  if not futures:
+    gathered.set_result(list())
+  for f in futures:
+    f.add_done_callback(finished)
+  return gathered
+
+class lock(object):
+  """ Lets one coroutine at a time through, others wait their turn. """
+  def __init__(self):
+    self.locked = False
+    self.waiting = list()
+
+  def acquire(self):
+    acquired = future()
+    if self.locked:
+      self.waiting.append(acquired)
+    else:
+      self.locked = True
+      acquired.set_result(True)
+    return acquired
+
+  def release(self):
+    if self.waiting:
+      self.waiting.pop(0).set_result(True)
+    else:
+      self.locked = False
+
+class serial_port(object):
+  """
+  Non-blocking reads and writes on an open pyserial port. Each transaction()
+  has the port to itself, so a command and its response are never mixed up
+  with another coroutine's.
+
+  Given the busowner.bus_owner of the port, it is held off the bus from the
+  first transaction until no more are waiting. If an emergency stop is
+  queued for the bus meanwhile, the next transaction raises ValueError and
+  lets it through.
+  """
+  def __init__(self, loop, sp, owner=None):
+    self.loop = loop
+    self.fd = sp.fileno()
+    self.timeout = sp.timeout
+    self.lock = lock()
+    self.owner = owner
+    self.hold = None
+
+    # pyserial opens ports non-blocking on Linux, make sure of it.
+    flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+    fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+  def write(self, data):
+    """ Future that finishes once all of data has been written """
+    written = future()
+    remaining = [bytes(data)]
+
+    def write_some():
+      try:
+        count = os.write(self.fd, remaining[0])
+      except OSError as oe:
+        if oe.errno == errno.EAGAIN:
+          return
+        self.loop.remove_writer(self.fd)
+        written.set_exception(ValueError("Serial write failed: {}".format(oe)))
+        return
+      remaining[0] = remaining[0][count:]
+      if not remaining[0]:
+        self.loop.remove_writer(self.fd)
+        written.set_result(len(data))
+
+    self.loop.add_writer(self.fd, write_some)
+    return written
+
+  def read(self, length, timeout=None):
+    """
+    Future for up to 'length' bytes. Like pyserial, finishes with fewer
+    bytes if 'timeout' seconds pass first.
+    """
+    received = future()
+    data = bytearray()
+    if timeout is None:
+      timeout = self.timeout
+
+    def finish(error=None):
+      self.loop.remove_reader(self.fd)
+      self.loop.cancel_timer(timer)
+      if received.done():
+        return
+      if error:
+        received.set_exception(error)
+      else:
+        received.set_result(data)
+
+    def read_some():
+      try:
+        chunk = os.read(self.fd, length - len(data))
+      except OSError as oe:
+        if oe.errno != errno.EAGAIN:
+          finish(ValueError("Serial read failed: {}".format(oe)))
+        return
+      data.extend(chunk)
+      if len(data) >= length:
+        finish()
+
+    timer = self.loop.call_later(timeout, finish)
+    if length > 0:
+      self.loop.add_reader(self.fd, read_some)
+    else:
+      finish()
+    return received
+
+  def flush_input(self):
+    """ Throw away anything already received """
+    while True:
+      try:
+        if not os.read(self.fd, 256):
+          return
+      except OSError as oe:
+        if oe.errno == errno.EAGAIN:
+          return
+        raise
+
+  def acquire(self):
+    """
+    Coroutine taking the port for the caller alone, until release(). The
+    bus owner is held off the bus first if it isn't already.
+    """
+    yield self.lock.acquire()
+    try:
+      if self.owner is not None and self.hold is None:
+        granted, finish = self.loop.threadsafe_future()
+        self.hold = self.owner.hold(finish)
+        yield granted
+      if self.hold is not None and self.hold.preempted():
+        self.release_hold()
+        raise ValueError("Bus {} given up for higher priority traffic".format(self.owner.name))
+    except ValueError:
+      self.release()
+      raise
+
+  def release(self):
+    """ Give up the port taken by acquire() """
+    if not self.lock.waiting:
+      self.release_hold()
+    self.lock.release()
+
+  def release_hold(self):
+    """ Let the bus owner back on the bus """
+    if self.hold is not None:
+      self.hold.release()
+      self.hold = None
+
+  def transaction(self, packet, length=0, check=None):
+    """
+    Coroutine that writes packet and, if 'length' is nonzero, reads that
+    many bytes of response and passes them to check(), which raises
+    ValueError if anything is wrong. Finishes with the response.
+    """
+    yield self.acquire()
+    try:
+      self.flush_input()
+      yield self.write(packet)
+      response = bytearray()
+      if length:
+        response = yield self.read(length)
+        if check:
+          check(response)
+    finally:
+      self.release()
+    raise coroutine_return(response)
+
+  def blocking(self, function, *args):
+    """
+    Coroutine calling function(*args) from the event loop thread the usual
+    blocking way, for example through the bus owner, once no transaction is
+    using the port and the bus owner is no longer held.
+    """
+    yield self.lock.acquire()
+    try:
+      self.release_hold()
+      value = function(*args)
+    finally:
+      self.release()
+    raise coroutine_return(value)
+
+# Python 2 does not have a constant for infinity. (Python 3 added math.inf.)
+infinity = float("inf")
+
+class async_chassis(object):
+  """
+  Commands a roverchassis.chassis from coroutines on an event loop. All wheel
+  commands are started at once: each serial port works through its own in
+  order while different ports are talking at the same time, all from a single
+  thread. Controllers not on a serial port are sent their commands the usual
+  blocking way.
+
+  Steering positions and input voltages can be read the same way, with
+  steering_positions() and motor_voltages().
+
+  Uses the same bookkeeping as the chassis, so commands that need not be
+  sent (see chassis.keepalive) are skipped. Nothing else should command the
+  chassis while this is in use. Run the event loop until every coroutine
+  started here has finished, as bus owners stay held off their ports while
+  a transaction is unfinished.
+  """
+  def __init__(self, chassis, loop=None):
+    self.chassis = chassis
+    self.loop = loop or eventloop()
+    self.ports = dict()
+
+  def port(self, control):
+    """ serial_port for the given motor controller, None if it has none """
+    if control.bus not in self.ports:
+      sp = control.serial_port()
+      if sp is None:
+        self.ports[control.bus] = None
+      else:
+        self.ports[control.bus] = serial_port(self.loop, sp, getattr(control, 'owner', None))
+    return self.ports[control.bus]
+
+  def send(self, control, handle, value):
+    """ Coroutine sending value to handle of the given controller """
+    port = self.port(control)
+    if port is None:
+      handle.send(value)
+    else:
+      packet, length, check = handle.command(value)
+      yield port.transaction(packet, length, check)
+
+  def query(self, control, name, id):
+    """
+    Coroutine reading a value from the given motor controller, finishing
+    with what its method 'name' (steering_position or input_voltage) would
+    return for id. Serial port controllers with a read command for it (see
+    motor_control.steering_position_command) are read on the event loop,
+    others are called the usual blocking way.
+    """
+    def call():
+      with rovertime.within(self.chassis.command_timeout):
+        return getattr(control, name)(id)
+
+    port = self.port(control)
+    command = None
+    if port is not None:
+      command = getattr(control, name + '_command')(id)
+
+    if port is None:
+      value = call()
+    elif command is None:
+      value = yield port.blocking(call)
+    else:
+      packet, length, parse = command
+      response = yield port.transaction(packet, length)
+      value = parse(response)
+    raise coroutine_return(value)
+
+  def steering_position(self, wheel):
+    """ Coroutine counterpart of roverwheel.steering_position() """
+    try:
+      angle = yield self.query(wheel.steeringcontrol, 'steering_position', wheel.steeringparam)
+    except ValueError:
+      angle = None
+    raise coroutine_return(angle)
+
+  def steering_positions(self):
+    """
+    Coroutine counterpart of chassis.steering_positions(), reading every
+    wheel at once.
+    """
+    names = [name for name, wheel in self.chassis.wheels.items() if wheel.steeringcontrol]
+    angles = yield gather([self.loop.spawn(self.steering_position(self.chassis.wheels[name])) for name in names])
+    raise coroutine_return(dict(zip(names, angles)))
+
+  def input_voltage(self, control, id):
+    """ Coroutine reading input voltage, or the error in its place """
+    try:
+      voltage = yield self.query(control, 'input_voltage', id)
+    except ValueError as ve:
+      voltage = "Error: {}".format(ve)
+    raise coroutine_return(voltage)
+
+  def motor_voltages(self):
+    """
+    Coroutine counterpart of chassis.motor_voltages(), reading every motor
+    at once.
+    """
+    voltages = dict()
+    reads = list()
+    for name, wheel in self.chassis.wheels.items():
+      voltages[name] = {"Rolling": "Not Applicable", "Steering": "Not Applicable"}
+      if wheel.rollingcontrol:
+        reads.append((name, "Rolling", self.loop.spawn(self.input_voltage(wheel.rollingcontrol, wheel.rollingparam))))
+      if wheel.steeringcontrol:
+        reads.append((name, "Steering", self.loop.spawn(self.input_voltage(wheel.steeringcontrol, wheel.steeringparam))))
+
+    yield gather([read for name, motor, read in reads])
+    for name, motor, read in reads:
+      voltages[name][motor] = read.value
+    raise coroutine_return(voltages)
+
+  def send_velocity(self, wheel, sent, now):
+    wheel.rollingsent = None
+    yield self.send(wheel.rollingcontrol, wheel.rollinghandle, sent)
+    wheel.velocity_sent(sent, now)
+
+  def send_angle(self, wheel, sent, now):
+    wheel.steeringsent = None
+    yield self.send(wheel.steeringcontrol, wheel.steeringhandle, sent)
+    wheel.angle_sent(sent, now)
+
+  def dispatch(self, force=False):
+    """
+    Coroutine sending dictated angle and velocity to all wheels that need
+    them. Raises the first error once every command has finished.
+    """
+    keepalive = self.chassis.keepalive
+    now = monotonic()
+    commands = list()
+    for wheel in self.chassis.wheels.values():
+      if wheel.steeringhandle:
+        sent = wheel.angle_due(now, force, keepalive)
+        if sent is not None:
+          commands.append(self.loop.spawn(self.send_angle(wheel, sent, now)))
+      if wheel.rollinghandle:
+        sent = wheel.velocity_due(now, force, keepalive)
+        if sent is not None:
+          commands.append(self.loop.spawn(self.send_velocity(wheel, sent, now)))
+
+    yield gather(commands)
+    raise coroutine_return(len(commands))
+
+  def move_velocity_radius(self, velocity, radius=infinity):
+    """
+    Coroutine counterpart of chassis.move_velocity_radius. Finishes with the
+    number of commands sent.
+    """
+    chassis = self.chassis
+    if abs(radius) < chassis.minRadius:
+      raise ValueError("Radius below minimum")
+
+    if abs(velocity) > 100:
+      raise ValueError("Velocity percentage may not exceed 100")
+
+    chassis.currentMotion = (velocity, radius)
+
+    wheels, angles, velocities = chassis.calculate_wheels(velocity, radius)
+    for wheel, angle, wheelvelocity in zip(wheels, angles, velocities):
+      wheel.angle = angle
+      wheel.velocity = wheelvelocity
+
+    sent = yield self.dispatch()
+    raise coroutine_return(sent)
@@ -0,0 +1,463 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import itertools
+import threading
+
+import devicehealth
+import rovertime
+from rovertime import monotonic
+
+try:
+  import Queue as queue # Python 2
+except ImportError:
+  import queue # Python 3
+
+# Priority lanes of a bus, lowest number runs first. A request waiting in a
+# higher priority lane is run before anything queued in lower lanes, and the
+# request running when it arrives is asked to give up early, see preempted().
+priority_emergency = 0
+priority_motion = 1
+priority_configuration = 2
+priority_telemetry = 3
+
+lane_names = {
+  priority_emergency: 'emergency',
+  priority_motion: 'motion',
+  priority_configuration: 'configuration',
+  priority_telemetry: 'telemetry',
+}
+
+# Priority lane of motor_control methods called through proxy. Anything not
+# listed here is configuration.
+method_priority = {
+  'emergency_stop': priority_emergency,
+  'power_percent': priority_motion,
+  'velocity': priority_motion,
+  'velocity_many': priority_motion,
+  'send_velocity_many': priority_motion,
+  'angle': priority_motion,
+  'angle_many': priority_motion,
+  'send_angle_many': priority_motion,
+  'version': priority_telemetry,
+  'probe': priority_telemetry,
+  'steering_position': priority_telemetry,
+  'input_voltage': priority_telemetry,
+  'input_voltage_many': priority_telemetry,
+  'statistics': priority_telemetry,
+}
+
+# Methods of a motor controller that only build commands or do arithmetic,
+# without touching the bus. proxy calls these directly instead of on the bus
+# owner thread, so they can be used while the bus is held, see bus_hold.
+direct_methods = ('steering_position_command', 'input_voltage_command')
+
+# Telemetry is turned away while more than this many seconds of commands,
+# estimated from their size, are queued for a bus. See bus_owner.enqueue()
+max_backlog = 0.1
+
+# Bus occupancy is measured over windows of this many seconds.
+occupancy_window = 1.0
+
+class request(object):
+  """
+  A function call submitted to a bus_owner. Caller waits for it to finish
+  with wait(), which returns its result or raises its error. The deadline in
+  effect when it was submitted (see rovertime.within) applies when it runs.
+
+  'cost' is the estimated number of seconds it will keep the bus busy, and
+  'key' identifies the actuator of a setpoint, see bus_owner.send_setpoint()
+  """
+  __slots__ = ('priority', 'function', 'args', 'kwargs', 'cost', 'key', 'deadline',
+    'submitted', 'done', 'result', 'error')
+
+  def __init__(self, priority, function, args, kwargs, cost=0, key=None):
+    self.priority = priority
+    self.function = function
+    self.args = args
+    self.kwargs = kwargs
+    self.cost = cost
+    self.key = key
+    self.deadline = rovertime.current_deadline()
+    self.submitted = monotonic()
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+  def execute(self):
+    try:
+      if self.deadline is not None and self.deadline.expired():
+        raise ValueError("Deadline passed while {} waited for bus".format(self.function))
+      with rovertime.within(self.deadline):
+        self.result = self.function(*self.args, **self.kwargs)
+    except Exception as e:
+      self.error = e
+    self.done.set()
+
+  def wait(self, timeout=None):
+    self.done.wait(timeout)
+    if not self.done.is_set():
+      raise ValueError("Timed out after {} seconds waiting for {}".format(timeout, self.function))
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+class bus_owner:
+  """
+  The one thread allowed to talk over a particular bus (serial port or I2C
+  bus). Other threads submit function calls to its queue and they are run
+  one at a time, so a write and the response it expects are never
+  interleaved with traffic from another thread.
+
+  Calls are run in order of priority lane, then in the order received. Time
+  spent waiting in each lane is recorded so we can see whether stops and
+  drive commands are held up by other traffic.
+
+  The bus is kept from falling behind: a new setpoint for an actuator whose
+  previous setpoint is still queued replaces it instead of queueing behind
+  it, and telemetry is turned away while the queue is full. Occupancy, the
+  fraction of time the bus is busy, is both measured and estimated from
+  the size of commands on the wire.
+  """
+  def __init__(self, name):
+    self.name = name
+    self.queue = queue.PriorityQueue()
+    self.sequence = itertools.count()
+    self.running = None
+
+    # Queued setpoints by actuator, and estimated seconds of queued work.
+    # Protected by lock.
+    self.lock = threading.Lock()
+    self.setpoints = dict()
+    self.backlog = 0.0
+    self.collapsed = 0
+    self.rejected = 0
+
+    # Per lane [count, total, maximum] seconds spent queued.
+    self.waits = dict((priority, [0, 0.0, 0.0]) for priority in lane_names)
+
+    # Seconds busy, measured and estimated, since start of current window.
+    # Occupancy of the previous window, None until there has been one.
+    self.windowstart = monotonic()
+    self.busy = 0.0
+    self.estimated = 0.0
+    self.occupancy = None
+    self.estimated_occupancy = None
+
+    self.thread = threading.Thread(target=self.run, name="bus {}".format(name))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, priority, function, *args, **kwargs):
+    """ Queue a function call and return its request without waiting """
+    return self.enqueue(request(priority, function, args, kwargs))
+
+  def enqueue(self, pending):
+    """
+    Queue a request and return it. Raises ValueError for telemetry when
+    more than max_backlog seconds of work is already queued.
+    """
+    with self.lock:
+      if pending.priority >= priority_telemetry and self.backlog > max_backlog:
+        self.rejected = self.rejected + 1
+        raise ValueError("Bus {} saturated with {:.0f} ms of commands queued".format(
+          self.name, self.backlog * 1000))
+      self.backlog = self.backlog + pending.cost
+      if pending.key is not None:
+        self.setpoints[pending.key] = pending
+    self.queue.put((pending.priority, next(self.sequence), pending))
+    return pending
+
+  def call(self, priority, function, *args, **kwargs):
+    """
+    Run function on the bus owner thread and return its result. Called from
+    the bus owner thread itself, runs it right away. Waits no longer than
+    the current deadline.
+    """
+    return self.call_request(request(priority, function, args, kwargs))
+
+  def call_request(self, pending):
+    """ Run request on bus owner thread and return its result, see call() """
+    if threading.current_thread() is self.thread:
+      pending.execute()
+      return pending.wait()
+    timeout = rovertime.budget(None, "Bus {}".format(self.name))
+    return self.enqueue(pending).wait(timeout)
+
+  def send_setpoint(self, key, cost, function, value):
+    """
+    Call function(value) in the motion lane and wait for it, like call().
+    If a setpoint for the same actuator 'key' is still queued, it is given
+    the newer value instead and both callers wait for it to be sent.
+    """
+    if threading.current_thread() is not self.thread:
+      with self.lock:
+        queued = self.setpoints.get(key)
+        if queued is not None:
+          queued.args = (value,)
+          self.collapsed = self.collapsed + 1
+      if queued is not None:
+        timeout = rovertime.budget(None, "Bus {}".format(self.name))
+        return queued.wait(timeout)
+    return self.call_request(request(priority_motion, function, (value,), {}, cost, key))
+
+  def hold(self, granted):
+    """
+    Keep this bus owner off the bus while another thread talks over it
+    directly, such as the asyncbus event loop. Returns a bus_hold, whose
+    request in the motion lane calls granted() from the bus owner thread
+    once it runs, then waits until released. Calls arriving meanwhile wait
+    their turn.
+    """
+    return bus_hold(self, granted)
+
+  def preempted(self):
+    """
+    True if something of higher priority is waiting behind the request
+    currently running.
+    """
+    running = self.running
+    if running is None:
+      return False
+    with self.queue.mutex:
+      return bool(self.queue.queue) and self.queue.queue[0][0] < running.priority
+
+  def run(self):
+    """ Body of the bus owner thread """
+    local.owner = self
+    if setup is not None:
+      setup()
+    while True:
+      priority, sequence, pending = self.queue.get()
+      with self.lock:
+        self.backlog = max(0.0, self.backlog - pending.cost)
+        if pending.key is not None and self.setpoints.get(pending.key) is pending:
+          del self.setpoints[pending.key]
+
+      started = monotonic()
+      waited = started - pending.submitted
+      wait = self.waits[priority]
+      wait[0] = wait[0] + 1
+      wait[1] = wait[1] + waited
+      wait[2] = max(wait[2], waited)
+
+      self.running = pending
+      pending.execute()
+      self.running = None
+      self.account(monotonic() - started, pending.cost)
+
+  def account(self, busy, estimated):
+    """ Add time spent on a request to bus occupancy """
+    self.busy = self.busy + busy
+    self.estimated = self.estimated + estimated
+    elapsed = monotonic() - self.windowstart
+    if elapsed >= occupancy_window:
+      self.occupancy = self.busy / elapsed
+      self.estimated_occupancy = self.estimated / elapsed
+      self.windowstart = self.windowstart + elapsed
+      self.busy = 0.0
+      self.estimated = 0.0
+
+  def status(self):
+    """
+    Queue wait statistics of each lane, and bus occupancy, suitable for JSON
+    """
+    lanes = dict()
+    for priority, (count, total, maximum) in self.waits.items():
+      lanes[lane_names[priority]] = {
+        'count': count,
+        'wait_mean': total / max(count, 1),
+        'wait_max': maximum,
+      }
+
+    # An idle bus doesn't finish its window, report what we have so far.
+    occupancy = self.occupancy
+    estimated_occupancy = self.estimated_occupancy
+    elapsed = monotonic() - self.windowstart
+    if elapsed >= occupancy_window:
+      occupancy = self.busy / elapsed
+      estimated_occupancy = self.estimated / elapsed
+
+    return {
+      'lanes': lanes,
+      'occupancy': occupancy,
+      'estimated_occupancy': estimated_occupancy,
+      'backlog': self.backlog,
+      'collapsed': self.collapsed,
+      'rejected': self.rejected,
+    }
+
+class bus_hold(object):
+  """
+  Keeps a bus_owner thread waiting, away from its bus, until release(). See
+  bus_owner.hold()
+  """
+  def __init__(self, owner, granted):
+    self.owner = owner
+    self.granted = granted
+    self.released = threading.Event()
+    self.request = request(priority_motion, self.wait, (), {})
+    # Held for as long as the holder needs, not bound by its deadline.
+    self.request.deadline = None
+    owner.enqueue(self.request)
+
+  def wait(self):
+    self.granted()
+    self.released.wait()
+
+  def preempted(self):
+    """
+    True if the bus is held and something more urgent than motion, such as
+    an emergency stop, is waiting for it. The holder should let go.
+    """
+    return self.owner.running is self.request and self.owner.preempted()
+
+  def release(self):
+    self.released.set()
+
+# Remembers which bus_owner, if any, the current thread is.
+local = threading.local()
+
+def preempted():
+  """
+  Called by motor controller code from within a request, True if it should
+  give up early because higher priority traffic is waiting for the bus.
+  Always False outside of a bus owner thread.
+  """
+  current = getattr(local, 'owner', None)
+  return current is not None and current.preempted()
+
+# One bus_owner for each bus name, shared by all controllers on that bus.
+owners = dict()
+ownerslock = threading.Lock()
+
+# Called from every bus owner thread as it starts, see follow().
+setup = None
+
+def owner(name):
+  """ Returns the bus_owner for the named bus, creating it if necessary """
+  with ownerslock:
+    if name not in owners:
+      owners[name] = bus_owner(name)
+    return owners[name]
+
+def follow(function):
+  """
+  Call function from every bus owner thread, those already running as well
+  as those started later. Used to give bus owners the same real time
+  settings as the control loop thread, which waits on them for every send.
+  """
+  global setup
+  with ownerslock:
+    setup = function
+    running = list(owners.values())
+  for current in running:
+    current.submit(priority_configuration, function)
+
+def status():
+  """ Dictionary of bus_owner.status() for every bus by name """
+  with ownerslock:
+    return dict((str(name), owners[name].status()) for name in owners)
+
+class handle_proxy(object):
+  """
+  Wraps a velocity or angle handle (see motor_control.py) so send() runs on
+  the bus owner thread in the motion lane. Outcome of every send() is
+  recorded in the health of its device, and fails right away while that
+  device isn't responding. setpoint() doesn't touch the bus and runs
+  directly. Other attributes are read from the wrapped handle.
+  """
+  __slots__ = ('handle', 'owner', 'health', 'cost', 'setpoint', 'deadband')
+
+  def __init__(self, handle, owner, health, cost):
+    self.handle = handle
+    self.owner = owner
+    self.health = health
+    self.cost = cost
+    self.setpoint = handle.setpoint
+    self.deadband = handle.deadband
+
+  def send(self, value):
+    self.health.call(self.owner.send_setpoint, self, self.cost, self.handle.send, value)
+
+  def __getattr__(self, name):
+    return getattr(self.handle, name)
+
+class proxy(object):
+  """
+  Wraps a motor controller so it can be called from any thread. Every method
+  call runs on the owner thread of the controller's bus, in the lane given
+  by method_priority. See bus_owner.
+  Handles returned by velocity_handle() and angle_handle() are wrapped the
+  same way. Other attributes such as capability flags, and direct_methods,
+  are used directly.
+  """
+  def __init__(self, control):
+    self.control = control
+    self.owner = owner(control.bus)
+
+  def velocity_handle(self, id):
+    handle = self.control.velocity_handle(id)
+    return handle_proxy(handle, self.owner, self.health(id), self.cost(handle))
+
+  def angle_handle(self, id):
+    handle = self.control.angle_handle(id)
+    return handle_proxy(handle, self.owner, self.health(id), self.cost(handle))
+
+  def cost(self, handle):
+    """
+    Estimated seconds one send() of handle keeps the bus busy: its bytes on
+    the wire at 10 bits each (8 data, start and stop) plus the device's
+    turnaround time. Zero if the controller doesn't know its baud rate.
+    """
+    baudrate = self.control.baudrate
+    if not baudrate:
+      return 0
+    return getattr(handle, 'wire_bytes', 0) * 10.0 / baudrate + self.control.turnaround
+
+  def send_many(self, function, commands, *args, **kwargs):
+    """ Run send_velocity_many or send_angle_many with the cost of all its handles """
+    cost = sum([getattr(handle, 'cost', 0) for handle, value in commands])
+    return self.owner.call_request(request(priority_motion, function, (commands,) + args, kwargs, cost))
+
+  def health(self, id):
+    """ devicehealth tracking the device of the given motor """
+    name = "{} @ {}".format(self.control.device(id), self.control.bus)
+    return devicehealth.device(name, lambda: self.probe(id))
+
+  def __getattr__(self, name):
+    value = getattr(self.control, name)
+    if not callable(value) or name in direct_methods:
+      return value
+
+    priority = method_priority.get(name, priority_configuration)
+    if name in ('send_velocity_many', 'send_angle_many'):
+      def call(commands, *args, **kwargs):
+        return self.send_many(value, commands, *args, **kwargs)
+    else:
+      def call(*args, **kwargs):
+        return self.owner.call(priority, value, *args, **kwargs)
+
+    # Remember it so __getattr__ isn't needed next time.
+    self.__dict__[name] = call
+    return call
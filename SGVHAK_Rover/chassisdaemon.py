@@ -0,0 +1,482 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import busowner
+import controlloop
+import devicehealth
+import roverchassis
+import scheduler
+
+try:
+  import SocketServer as socketserver # Python 2
+except ImportError:
+  import socketserver # Python 3
+
+# Socket the daemon listens on unless given another on the command line.
+default_socket = "/tmp/sgvhak_chassis"
+
+# Only the daemon's own user and group may connect to the socket, which
+# drives the rover, or read the shared state file. Run web workers as the
+# same user, or as a member of its group.
+socket_mode = 0o660
+state_mode = 0o640
+
+# Every message, either direction, is a header followed by 'length' bytes
+# of payload. Requests carry a method code, replies a status code.
+header = struct.Struct('!BI')
+
+# Methods. The drive and stop commands have fixed binary payloads, the
+# rest are less frequent and carry JSON.
+call_publish = 1            # setpoint -> nothing
+call_stop = 2               # nothing -> elapsed
+call_config = 3             # nothing -> chassis configuration
+call_steer_to = 4           # [wheel name, angle] -> nothing
+call_steer_set_zero = 5     # wheel name -> nothing
+call_run_maneuver = 6       # segments -> nothing
+call_maneuver_status = 7    # nothing -> maneuver status
+call_motor_voltages = 8     # nothing -> voltages by wheel name
+call_steering_positions = 9 # nothing -> positions by wheel name
+call_diagnostics = 10       # kind -> status, see chassisdaemon.diagnostics()
+
+reply_ok = 0
+reply_error = 1 # Payload is the error message, raised as ValueError
+
+setpoint = struct.Struct('!dd') # velocity, pct_angle
+elapsed = struct.Struct('!d')
+
+# Shared wheel state is a sequence number and wheel count, followed by
+# velocity, angle, and a mask of unresponsive devices for every wheel in
+# the order given by call_config. The sequence number is odd while the
+# daemon is in the middle of an update, see write_state() and read_state().
+# It wraps around to zero after 2**32 - 1, which keeps it even or odd.
+state_header = struct.Struct('!II')
+wheel_state = struct.Struct('!ddB')
+rolling_dead = 1
+steering_dead = 2
+
+# A web worker reading shared state tries this many times, this many
+# seconds apart, to catch the daemon between updates before giving up.
+state_attempts = 100
+state_retry_delay = 0.001
+
+def receive_exactly(sock, length):
+  data = b''
+  while len(data) < length:
+    chunk = sock.recv(length - len(data))
+    if not chunk:
+      raise EOFError("Connection closed")
+    data = data + chunk
+  return data
+
+def receive(sock):
+  """ Read one message, returns (code, payload) """
+  code, length = header.unpack(receive_exactly(sock, header.size))
+  return code, receive_exactly(sock, length)
+
+def send(sock, code, payload=b''):
+  sock.sendall(header.pack(code, len(payload)) + payload)
+
+def encode(value):
+  return json.dumps(value).encode('utf-8')
+
+def decode(payload):
+  return json.loads(payload.decode('utf-8'))
+
+def device_name(handle):
+  health = getattr(handle, 'health', None)
+  return health.name if health else None
+
+class connection(socketserver.BaseRequestHandler):
+  """ Serves requests from one web worker thread until it disconnects """
+  def handle(self):
+    daemon = self.server.chassisdaemon
+    while True:
+      try:
+        code, payload = receive(self.request)
+      except (EOFError, socket.error):
+        return
+      try:
+        status, reply = reply_ok, daemon.call(code, payload)
+      except StandardError as se:
+        if not isinstance(se, ValueError):
+          logging.getLogger(__name__).exception("Method %s failed", code)
+        status, reply = reply_error, str(se).encode('utf-8')
+      try:
+        send(self.request, status, reply)
+      except socket.error:
+        return
+
+class chassisdaemon:
+  """
+  Owns the chassis and every motor controller on behalf of any number of
+  web worker processes, which use client below. The control tick, shared
+  state updates and health probes run as periodic jobs in between accepting
+  connections, and each connection is served on a thread of its own. Wheel velocity, angle and health are written to a memory
+  mapped file every control period so workers can read them without
+  asking.
+  """
+  def __init__(self, chassis, controller, path=default_socket):
+    self.chassis = chassis
+    self.controller = controller
+    self.path = path
+    self.statepath = path + ".state"
+
+    chassis.ensureready()
+    self.names = sorted(chassis.wheels)
+
+    self.jobs = scheduler.scheduler()
+    self.jobs.add('control', controller.tick, controller.period, priority=10)
+    self.jobs.add('state', self.write_state, controller.period, priority=5)
+    self.jobs.add('probe', devicehealth.probe, devicehealth.probe_interval, priority=2)
+
+    size = state_header.size + wheel_state.size * len(self.names)
+    with open(self.statepath, 'w+b') as statefile:
+      os.fchmod(statefile.fileno(), state_mode)
+      statefile.truncate(size)
+      self.state = mmap.mmap(statefile.fileno(), size)
+    self.sequence = 0
+    self.write_state()
+
+    self.methods = {
+      call_publish: self.publish,
+      call_stop: self.stop,
+      call_config: self.config,
+      call_steer_to: self.steer_to,
+      call_steer_set_zero: self.steer_set_zero,
+      call_run_maneuver: self.run_maneuver,
+      call_maneuver_status: self.maneuver_status,
+      call_motor_voltages: lambda payload: encode(chassis.motor_voltages()),
+      call_steering_positions: lambda payload: encode(chassis.steering_positions()),
+      call_diagnostics: lambda payload: encode(self.diagnostics(decode(payload))),
+    }
+
+  def write_state(self):
+    """ Copy wheel state into shared memory """
+    self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+    state_header.pack_into(self.state, 0, self.sequence, len(self.names))
+    offset = state_header.size
+    for name in self.names:
+      wheel = self.chassis.wheels[name]
+      dead = 0
+      if not roverchassis.responding(wheel.rollinghandle):
+        dead = dead | rolling_dead
+      if not roverchassis.responding(wheel.steeringhandle):
+        dead = dead | steering_dead
+      wheel_state.pack_into(self.state, offset, wheel.velocity, wheel.angle, dead)
+      offset = offset + wheel_state.size
+    self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+    state_header.pack_into(self.state, 0, self.sequence, len(self.names))
+
+  def call(self, code, payload):
+    """ Run method 'code' with request payload, returns reply payload """
+    method = self.methods.get(code)
+    if method is None:
+      raise ValueError("Unknown chassis daemon method {}".format(code))
+    return method(payload) or b''
+
+  def wheel(self, name):
+    if name not in self.chassis.wheels:
+      raise ValueError("No wheel named {}".format(name))
+    return self.chassis.wheels[name]
+
+  def publish(self, payload):
+    self.controller.publish(*setpoint.unpack(payload))
+
+  def stop(self, payload):
+    return elapsed.pack(self.controller.emergency_stop())
+
+  def config(self, payload):
+    wheels = list()
+    for name in self.names:
+      wheel = self.chassis.wheels[name]
+      wheels.append({
+        'name': name,
+        'x': wheel.x,
+        'y': wheel.y,
+        'rollingparam': wheel.rollingparam,
+        'steeringparam': wheel.steeringparam,
+        'rollinglabel': getattr(wheel, 'rollinglabel', None),
+        'steeringlabel': getattr(wheel, 'steeringlabel', None),
+        'steering': wheel.steeringcontrol is not None,
+        'rollingdevice': device_name(wheel.rollinghandle),
+        'steeringdevice': device_name(wheel.steeringhandle),
+      })
+    return encode({
+      'wheels': wheels,
+      'state': self.statepath,
+      'period': self.controller.period,
+      'command_timeout': self.chassis.command_timeout,
+      'dispatch_timeout': self.chassis.dispatch_timeout,
+    })
+
+  def steer_to(self, payload):
+    name, angle = decode(payload)
+    self.wheel(name).steerto(angle)
+
+  def steer_set_zero(self, payload):
+    self.wheel(decode(payload)).steersetzero()
+
+  def run_maneuver(self, payload):
+    self.chassis.run_maneuver(decode(payload))
+
+  def maneuver_status(self, payload):
+    if self.chassis.maneuver:
+      return encode(self.chassis.maneuver.status())
+    return encode({'running': False})
+
+  def diagnostics(self, kind):
+    """ Status of 'jobs', 'buses', 'devices', 'control' or 'controllers' """
+    if kind == 'jobs':
+      return self.jobs.status()
+    elif kind == 'buses':
+      return busowner.status()
+    elif kind == 'devices':
+      return devicehealth.status()
+    elif kind == 'control':
+      return self.controller.status()
+    elif kind == 'controllers':
+      return self.chassis.controller_statistics()
+    raise ValueError("Unknown diagnostics {}".format(kind))
+
+  def serve(self):
+    """
+    Serve requests, running jobs as they come due in between accepting
+    connections. Never returns.
+    """
+    self.controller.start()
+
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    # Bind with no access for others, then open it up to socket_mode.
+    umask = os.umask(0o077)
+    try:
+      server = socketserver.ThreadingUnixStreamServer(self.path, connection)
+    finally:
+      os.umask(umask)
+    os.chmod(self.path, socket_mode)
+    server.daemon_threads = True
+    server.chassisdaemon = self
+    logging.getLogger(__name__).info("Chassis daemon listening on %s", self.path)
+    while True:
+      server.timeout = self.jobs.time_until_next()
+      server.handle_request()
+      self.jobs.run_pending()
+
+class remote_controller:
+  """ Stands in for controlloop.controlloop in a web worker """
+  def __init__(self, client):
+    self.client = client
+    self.threaded = True
+    self.period = 1.0/controlloop.default_rate
+
+  def publish(self, velocity, pct_angle):
+    self.client.call(call_publish, setpoint.pack(velocity, pct_angle))
+
+  def emergency_stop(self):
+    return elapsed.unpack(self.client.call(call_stop))[0]
+
+  def tick(self):
+    pass
+
+  def status(self):
+    return self.client.diagnostics('control')
+
+class remote_maneuver:
+  """ Stands in for the chassis maneuver in a web worker """
+  def __init__(self, client):
+    self.client = client
+
+  def status(self):
+    return decode(self.client.call(call_maneuver_status))
+
+class remote_wheel:
+  """
+  Stands in for roverchassis.roverwheel in a web worker. Velocity, angle
+  and health are read from shared memory.
+  """
+  def __init__(self, client, index, config):
+    self.client = client
+    self.index = index
+    self.name = config['name']
+    self.x = config['x']
+    self.y = config['y']
+    self.rollingparam = config['rollingparam']
+    self.steeringparam = config['steeringparam']
+    self.rollinglabel = config['rollinglabel']
+    self.steeringlabel = config['steeringlabel']
+    self.steeringcontrol = config['steering']
+    self.rollingdevice = config['rollingdevice']
+    self.steeringdevice = config['steeringdevice']
+
+  @property
+  def velocity(self):
+    return self.client.read_state()[self.index][0]
+
+  @property
+  def angle(self):
+    return self.client.read_state()[self.index][1]
+
+  def health(self):
+    return self.dead(self.client.read_state()[self.index][2])
+
+  def dead(self, mask):
+    """ Devices not responding, given the dead mask from shared state """
+    dead = list()
+    if mask & rolling_dead:
+      dead.append(self.rollingdevice)
+    if mask & steering_dead and self.steeringdevice not in dead:
+      dead.append(self.steeringdevice)
+    return dead
+
+  def steerto(self, angle):
+    self.client.call(call_steer_to, encode([self.name, angle]))
+
+  def steersetzero(self):
+    self.client.call(call_steer_set_zero, encode(self.name))
+
+class client:
+  """
+  Stands in for roverchassis.chassis in a web worker, passing everything
+  on to the chassis daemon listening on socket 'path'. Each thread has
+  its own connection, so a stop isn't held up behind another thread's
+  request, and connections are not shared across fork().
+  """
+  def __init__(self, path=default_socket):
+    self.path = path
+    self.local = threading.local()
+    self.wheels = dict()
+    self.controller = remote_controller(self)
+    self.maneuver = remote_maneuver(self)
+    self.state = None
+    self.statepath = None
+    self.pid = None
+    self.command_timeout = None
+    self.dispatch_timeout = None
+
+  def connection(self):
+    sock = getattr(self.local, 'sock', None)
+    if sock is None or getattr(self.local, 'pid', None) != os.getpid():
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        sock.connect(self.path)
+      except socket.error as e:
+        sock.close()
+        raise ValueError("Chassis daemon not reachable at {}: {}".format(self.path, e))
+      self.local.sock = sock
+      self.local.pid = os.getpid()
+    return sock
+
+  def call(self, code, payload=b''):
+    """ Send request to daemon and return its reply payload """
+    sock = self.connection()
+    try:
+      send(sock, code, payload)
+      status, reply = receive(sock)
+    except (EOFError, socket.error) as e:
+      self.local.sock = None
+      sock.close()
+      raise ValueError("Lost connection to chassis daemon: {}".format(e))
+    if status != reply_ok:
+      raise ValueError(reply.decode('utf-8'))
+    return reply
+
+  def ensureready(self):
+    """ Fetch chassis configuration and map shared state, once per process """
+    if self.wheels and self.pid == os.getpid():
+      return
+
+    config = decode(self.call(call_config))
+    wheels = dict()
+    for index, wheel in enumerate(config['wheels']):
+      wheels[wheel['name']] = remote_wheel(self, index, wheel)
+
+    with open(config['state'], 'rb') as statefile:
+      self.state = mmap.mmap(statefile.fileno(), 0, access=mmap.ACCESS_READ)
+    self.statepath = config['state']
+    self.command_timeout = config['command_timeout']
+    self.dispatch_timeout = config['dispatch_timeout']
+    self.controller.period = config['period']
+    self.pid = os.getpid()
+    self.wheels = wheels
+
+  def read_state(self):
+    """
+    List of (velocity, angle, dead mask) for every wheel, a consistent
+    snapshot even if the daemon is writing at the same time. Raises
+    ValueError if the daemon never finishes its update, such as when it
+    died in the middle of one.
+    """
+    for attempt in range(state_attempts):
+      if attempt:
+        time.sleep(state_retry_delay)
+      sequence, count = state_header.unpack_from(self.state, 0)
+      if sequence % 2 == 0:
+        snapshot = [wheel_state.unpack_from(self.state, state_header.size + wheel_state.size * index)
+          for index in range(count)]
+        if state_header.unpack_from(self.state, 0)[0] == sequence:
+          return snapshot
+    raise ValueError("Chassis daemon state {} still being updated after {} attempts".format(
+      self.statepath, state_attempts))
+
+  def wheel_status(self):
+    """ Same as roverchassis.chassis.wheel_status(), from one snapshot """
+    snapshot = self.read_state()
+    status = dict()
+    for name, wheel in self.wheels.items():
+      velocity, angle, mask = snapshot[wheel.index]
+      status[name] = {'velocity': velocity, 'angle': angle, 'health': wheel.dead(mask)}
+    return status
+
+  def run_maneuver(self, segments):
+    self.call(call_run_maneuver, encode(segments))
+
+  def motor_voltages(self):
+    return decode(self.call(call_motor_voltages))
+
+  def steering_positions(self):
+    return decode(self.call(call_steering_positions))
+
+  def diagnostics(self, kind):
+    return decode(self.call(call_diagnostics, encode(kind)))
+
+def main(path=default_socket):
+  logging.basicConfig(level=logging.INFO)
+
+  chassis = roverchassis.chassis()
+  chassis.command_timeout = float(os.environ.get('SGVHAK_COMMAND_TIMEOUT', chassis.command_timeout))
+  controller = controlloop.from_environment(chassis)
+
+  chassisdaemon(chassis, controller, path).serve()
+
+if __name__ == '__main__':
+  main(*sys.argv[1:2])
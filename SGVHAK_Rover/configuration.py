@@ -27,11 +27,17 @@ class configuration:
   def __init__(self, name):
     self.name = name
 
-  def load(self):
+  def load(self, instance=None):
     """
     Loads the configuration file. Filename format is based on the name given
     in the constructor. Prepended by "config_" with ".json" suffix. If all
     goes well, returns a dictionary of configuration parameters.
+
+    A configuration file may list additional instances under "instances",
+    each a dictionary of parameters that differ from the rest of the file.
+    When given one of those dictionaries as 'instance', its parameters are
+    applied on top of the file. Nested dictionaries such as "connect" are
+    merged, so an instance only needs to list what is different.
     """
     filename = "config_"+self.name+".json"
     filehandle = open(filename, 'r')
@@ -39,4 +45,20 @@ class configuration:
     filehandle.close()
 
     # TODO: Validate JSON data against schema
-    return json.loads(filecontent)
\ No newline at end of file
+    params = json.loads(filecontent)
+
+    if instance is not None:
+      params.pop('instances', None)
+      for key, value in instance.items():
+        if isinstance(value, dict) and isinstance(params.get(key), dict):
+          merged = dict(params[key])
+          merged.update(value)
+          params[key] = merged
+        else:
+          params[key] = value
+
+    return params
+
+  def instances(self):
+    """ List of additional instances in configuration file, if any """
+    return self.load().get('instances', list())
\ No newline at end of file
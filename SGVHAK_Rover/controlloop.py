@@ -0,0 +1,267 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import os
+import threading
+
+import busowner
+import realtime
+from rovertime import monotonic
+
+# Default number of drive commands per second sent to the chassis. Faster
+# than this is more work for motor controllers and their buses, and the
+# mechanical bits can't respond super fast anyway.
+default_rate = 20
+
+class controlloop:
+  """
+  Fixed rate loop that sends drive commands to the chassis from its own
+  thread. Web requests only publish the newest (velocity, pct_angle)
+  setpoint and return right away, without waiting on any motor controller.
+
+  At most one setpoint is sent every 1/rate seconds. If more than one
+  arrives within that window, only the final one is sent and the rest are
+  dropped. A stop (zero velocity) is sent immediately.
+
+  By default there is no loop thread: tick() must be called at least once
+  per period, typically as a scheduler job, and publish() sends right away
+  when a setpoint is already due. Set 'threaded' to True before start() to
+  send from a loop thread of its own instead, see from_environment().
+
+  The loop ticks once per period, whether or not there is anything to
+  send. Jitter is how far each actual period between ticks was from the
+  one asked for, early negative and late positive, kept as a histogram.
+  Set 'realtime' to a realtime.realtime instance before start() to run the
+  loop thread with real time settings.
+  """
+  def __init__(self, chassis, rate=default_rate):
+    if rate <= 0:
+      raise ValueError("Control loop rate {} must be positive".format(rate))
+
+    self.chassis = chassis
+    self.period = 1.0/rate
+
+    # Newest (velocity, pct_angle) not yet sent to chassis, None if nothing
+    # new. Protected by condition, which is notified when it changes.
+    self.setpoint = None
+    self.condition = threading.Condition()
+
+    # Set while the loop thread is not in the middle of sending a setpoint.
+    self.idle = threading.Event()
+    self.idle.set()
+
+    # Held by tick() while sending, so setpoints from several threads
+    # calling it go out one at a time and in order.
+    self.sending = threading.Lock()
+
+    self.threaded = False
+    self.realtime = None
+    self.thread = None
+    self.lastsent = 0
+    self.lastwake = None
+
+    # Counters, and most recent error, for diagnostics.
+    self.published = 0
+    self.sent = 0
+    self.error = None
+    self.jitter = realtime.histogram(realtime.period_buckets)
+
+  def start(self):
+    """ Start the loop thread if it isn't already running """
+    if not self.threaded:
+      return
+    if self.thread is None or not self.thread.is_alive():
+      self.thread = threading.Thread(target=self.run, name="controlloop")
+      self.thread.daemon = True
+      self.thread.start()
+
+  def publish(self, velocity, pct_angle):
+    """
+    Make this the setpoint to send next, replacing any not yet sent.
+    """
+    if abs(velocity) > 100:
+      raise ValueError("Velocity percentage {} may not exceed 100".format(velocity))
+    if abs(pct_angle) > 100:
+      raise ValueError("Steering percentage {} may not exceed 100".format(pct_angle))
+
+    with self.condition:
+      self.setpoint = (velocity, pct_angle)
+      self.published = self.published + 1
+      self.condition.notify()
+
+    self.start()
+    self.send_due()
+
+  def emergency_stop(self):
+    """
+    Drop any setpoint not yet sent and stop the chassis right away from the
+    calling thread, see chassis.emergency_stop(). If another thread was in
+    the middle of sending a setpoint, stop again once it is done so the
+    rover isn't left moving. Returns number of seconds the first stop took.
+    """
+    with self.condition:
+      self.setpoint = None
+      busy = not self.idle.is_set()
+
+    elapsed = self.chassis.emergency_stop()
+
+    if busy:
+      self.idle.wait(self.chassis.dispatch_timeout)
+      self.chassis.emergency_stop()
+
+    return elapsed
+
+  def next_setpoint(self, wake):
+    """
+    Wait for a setpoint that is due to be sent and return it, or None once
+    monotonic time 'wake' is reached. Anything but a stop waits until a full
+    period has passed since the previous send, picking up any newer
+    setpoint that arrives in the meantime.
+    """
+    with self.condition:
+      while True:
+        due, remaining = self.due_setpoint()
+        if due:
+          return due
+
+        wait = wake - monotonic()
+        if wait <= 0:
+          return None
+        self.condition.wait(min(remaining, wait))
+
+  def due_setpoint(self):
+    """
+    Returns (setpoint, None) if there's a setpoint due to be sent, taking
+    it, or (None, seconds until it is due). Caller must hold condition.
+    """
+    if self.setpoint is None:
+      return None, self.period
+
+    velocity, pct_angle = self.setpoint
+    remaining = self.lastsent + self.period - monotonic()
+    if velocity == 0 or remaining <= 0:
+      self.setpoint = None
+      self.idle.clear()
+      return (velocity, pct_angle), None
+
+    return None, remaining
+
+  def ticked(self, now):
+    """ Add how far the period since the previous tick was off to jitter """
+    if self.lastwake is not None:
+      self.jitter.add(now - self.lastwake - self.period)
+    self.lastwake = now
+
+  def tick(self):
+    """
+    Without the loop thread, called once per period, typically as a
+    scheduler job. Sends setpoint if one is due.
+    """
+    if self.threaded:
+      return
+
+    self.ticked(monotonic())
+    self.send_due()
+
+  def send_due(self):
+    """ Send setpoint if one is due, unless the loop thread does that """
+    if self.threaded:
+      return
+
+    with self.sending:
+      with self.condition:
+        due, remaining = self.due_setpoint()
+
+      if due:
+        self.send(*due)
+
+  def run(self):
+    """
+    Body of the loop thread: sends setpoints as they come due, and ticks
+    once every period. Garbage is collected on every tick with real time
+    settings, as enter() turned off automatic collection.
+    """
+    if self.realtime:
+      # Bus owners run every command the loop waits on, so they get the
+      # same priority.
+      self.realtime.enter()
+      busowner.follow(self.realtime.follow)
+
+    wake = monotonic() + self.period
+    while True:
+      setpoint = self.next_setpoint(wake)
+      if setpoint:
+        self.send(*setpoint)
+        continue
+
+      now = monotonic()
+      self.ticked(now)
+      if self.realtime:
+        self.realtime.after_tick()
+
+      # Ticks are scheduled from when they were due, not when they ran, so
+      # the period doesn't drift. Skip any ticks already gone by.
+      wake = wake + self.period
+      if wake <= now:
+        wake = now + self.period
+
+  def send(self, velocity, pct_angle):
+    """ Send setpoint from next_setpoint() or send_due() to chassis """
+    self.lastsent = monotonic()
+    try:
+      # Manual driving takes over from any maneuver in progress.
+      self.chassis.cancel_maneuver()
+      self.chassis.move_velocity_pct(velocity, pct_angle)
+      self.sent = self.sent + 1
+    except StandardError as se:
+      # Any error, not only protocol errors, so the loop thread keeps going.
+      self.error = str(se)
+      logging.getLogger(__name__).error("Drive command (%s, %s) failed: %s", velocity, pct_angle, self.error)
+    finally:
+      self.idle.set()
+
+  def status(self):
+    """ Dictionary of counters and jitter statistics, suitable for JSON """
+    status = {
+      'period': self.period,
+      'threaded': self.threaded,
+      'published': self.published,
+      'sent': self.sent,
+      'error': self.error,
+      'jitter': self.jitter.status(),
+    }
+    if self.realtime:
+      status['realtime'] = self.realtime.status()
+    return status
+
+def from_environment(chassis):
+  """
+  Control loop for chassis sending SGVHAK_CONTROL_RATE commands per second.
+  It only gets a loop thread of its own if SGVHAK_CONTROL_THREAD is set to
+  1, or to run with real time settings, see realtime.from_environment().
+  """
+  controller = controlloop(chassis, float(os.environ.get('SGVHAK_CONTROL_RATE', default_rate)))
+  controller.realtime = realtime.from_environment()
+  controller.threaded = os.environ.get('SGVHAK_CONTROL_THREAD', '0') == '1' or controller.realtime is not None
+  return controller
@@ -0,0 +1,172 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import threading
+
+import rovertime
+from rovertime import monotonic
+
+# Consecutive failures before a device is considered dead.
+failure_threshold = 3
+
+# Seconds between attempts to reach a dead device, see probe_due().
+probe_interval = 1.0
+
+# Most seconds a probe may take, including retries. A device that is back
+# answers well within this, a dead one shouldn't hold up its bus for long.
+probe_timeout = 0.1
+
+# Weight of the newest round trip time in the running average.
+rtt_weight = 0.2
+
+class device_health(object):
+  """
+  Success rate and round trip time of a single device on a bus, for example
+  one servo or one RoboClaw address, acting as a circuit breaker.
+
+  After failure_threshold failures in a row the circuit is opened: check()
+  then fails right away instead of paying for another timeout and retries,
+  so one dead device doesn't slow down commands to all the others. It stays
+  open until a probe (any successful command, typically from probe()) gets
+  through.
+  """
+  def __init__(self, name, probe=None):
+    self.name = name
+    self.probe_function = probe
+    self.lock = threading.Lock()
+
+    self.open = False
+    self.opened = None
+    self.lastprobe = 0
+
+    self.successes = 0
+    self.failures = 0
+    self.consecutive_failures = 0
+    self.rtt = None
+    self.error = None
+
+  def check(self):
+    """ Raises ValueError if circuit is open """
+    if self.open:
+      raise ValueError("{} not responding since {:.1f} seconds ago: {}".format(
+        self.name, monotonic() - self.opened, self.error))
+
+  def success(self, rtt):
+    """ Record a command that succeeded after 'rtt' seconds """
+    with self.lock:
+      self.successes = self.successes + 1
+      self.consecutive_failures = 0
+      if self.rtt is None:
+        self.rtt = rtt
+      else:
+        self.rtt = self.rtt + rtt_weight * (rtt - self.rtt)
+      if self.open:
+        self.open = False
+        logging.getLogger(__name__).info("%s responding again", self.name)
+
+  def failure(self, error):
+    """ Record a command that failed, opening circuit if it keeps happening """
+    with self.lock:
+      self.failures = self.failures + 1
+      self.consecutive_failures = self.consecutive_failures + 1
+      self.error = str(error)
+      if not self.open and self.consecutive_failures >= failure_threshold:
+        self.open = True
+        self.opened = monotonic()
+        self.lastprobe = self.opened
+        logging.getLogger(__name__).error("%s stopped responding: %s", self.name, self.error)
+
+  def call(self, function, *args):
+    """
+    Fail fast if circuit is open, otherwise call function and record the
+    outcome.
+    """
+    self.check()
+    start = monotonic()
+    try:
+      result = function(*args)
+    except StandardError as se:
+      self.failure(se)
+      raise
+    self.success(monotonic() - start)
+    return result
+
+  def probe_due(self, now):
+    return self.open and self.probe_function is not None and now - self.lastprobe >= probe_interval
+
+  def probe(self):
+    """
+    Try to reach a device whose circuit is open, giving up after
+    probe_timeout seconds.
+    """
+    self.lastprobe = monotonic()
+    try:
+      start = monotonic()
+      with rovertime.within(probe_timeout):
+        self.probe_function()
+      self.success(monotonic() - start)
+    except StandardError as se:
+      with self.lock:
+        self.error = str(se)
+
+  def status(self):
+    """ Dictionary of health information, suitable for JSON """
+    total = self.successes + self.failures
+    success_rate = None
+    if total:
+      success_rate = float(self.successes) / total
+    return {
+      'name': self.name,
+      'open': self.open,
+      'successes': self.successes,
+      'failures': self.failures,
+      'success_rate': success_rate,
+      'rtt': self.rtt,
+      'error': self.error,
+    }
+
+# One device_health for every device by name, shared by all its handles.
+devices = dict()
+deviceslock = threading.Lock()
+
+def device(name, probe=None):
+  """ Returns the device_health for the named device, creating it if necessary """
+  with deviceslock:
+    if name not in devices:
+      devices[name] = device_health(name, probe)
+    return devices[name]
+
+def probe():
+  """ Probe every dead device that is due, returns number probed """
+  now = monotonic()
+  with deviceslock:
+    due = [health for health in devices.values() if health.probe_due(now)]
+  for health in due:
+    health.probe()
+  return len(due)
+
+def status():
+  """ List of every device's status, see device_health.status() """
+  with deviceslock:
+    return [devices[name].status() for name in sorted(devices)]
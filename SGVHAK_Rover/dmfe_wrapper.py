@@ -25,9 +25,16 @@ import serial
 import struct
 
 import configuration
+import motor_control
+import rovertime
 
 maxangle = 45 # TODO: make this generally configurable
 
+# Steering servo speed assumed unless "degrees_per_second" is given in the
+# configuration file. Typical for a standard size servo: 60 degrees in 0.2
+# seconds. Set it to the speed of the servos actually fitted.
+default_degrees_per_second = 300
+
 def bytetohex(bytearray):
   """
   Returns hexadecimal string representation of byte array
@@ -36,38 +43,176 @@ def bytetohex(bytearray):
   """
   return ''.join('{:02x}'.format(x) for x in bytearray)
 
-class dmfe_wrapper:
+class velocity_handle(object):
+  """
+  Brushed motor speed control of a single DMFE device. Identifier is
+  validated and the send/acknowledge methods are looked up once when the
+  handle is created, leaving only arithmetic and serial traffic for each
+  command.
+
+  setpoint() translates percentage into motor speed value, which is passed
+  to send(). command() returns the same packet for asyncbus along with its
+  acknowledgement length and a check for it.
+  """
+  __slots__ = ('did', 'inverted', 'deadband', 'write', 'read_ack', 'packet')
+
+  # Bytes on the wire for one send(): 9 byte packet and 1 byte acknowledgement.
+  wire_bytes = 10
+
+  def __init__(self, wrapper, id):
+    self.did, center, self.inverted = wrapper.check_id(id)
+    wrapper.check_sp()
+
+    self.deadband = wrapper.velocity_deadband
+    self.write = wrapper.send
+    self.read_ack = wrapper.read_ack
+    self.packet = wrapper.packet
+
+  def setpoint(self, pct_velocity):
+    if self.inverted:
+      pct_velocity = pct_velocity * -1
+
+    pct = int(pct_velocity)
+    if abs(pct) > 100:
+      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
+
+    # 50 is wheel power maximum of Mr. Blue rover. TBD: Make this general and configurable
+    return int((pct_velocity * 50) / 100)
+
+  def send(self, power):
+    self.write(self.did, 0x87, dmfe_wrapper.data1byte(power))
+    self.read_ack()
+
+  def command(self, power):
+    return (self.packet(self.did, 0x87, dmfe_wrapper.data1byte(power)), 1, dmfe_wrapper.check_ack)
+
+class angle_handle(object):
+  """
+  Servo position control of a single DMFE device, see velocity_handle.
+
+  setpoint() translates angle in degrees off center into servo position,
+  which is passed to send().
+  """
+  __slots__ = ('did', 'inverted', 'deadband', 'write', 'read_ack', 'packet')
+
+  # 9 byte packet and 1 byte acknowledgement.
+  wire_bytes = 10
+
+  def __init__(self, wrapper, id):
+    self.did, center, self.inverted = wrapper.check_id(id)
+    wrapper.check_sp()
+
+    self.deadband = wrapper.angle_deadband
+    self.write = wrapper.send
+    self.read_ack = wrapper.read_ack
+    self.packet = wrapper.packet
+
+  def setpoint(self, angle):
+    if abs(angle) > maxangle:
+      raise ValueError("Steering angle {} exceeded expected maximum of {}".format(angle,maxangle))
+
+    if self.inverted:
+      angle = angle * -1
+
+    return int(2048 + (angle * 4096/360)) # 0 min, 2048 center, 4096 max at 360 degrees
+
+  def send(self, position):
+    self.write(self.did, 0x82, dmfe_wrapper.data2byte(position))
+    self.read_ack()
+
+  def command(self, position):
+    return (self.packet(self.did, 0x82, dmfe_wrapper.data2byte(position)), 1, dmfe_wrapper.check_ack)
+
+class dmfe_wrapper(motor_control.motor_control):
   """
   Class that implements the rover motor control methods for David M Flynn
   Enterprises motor control boards.
+
+  Commands for several devices are written back to back before reading
+  any of their acknowledgements, so we wait for the bus only once.
   """
+  supports_velocity_many = True
+  supports_angle_many = True
+
+  # Estimated, not measured.
+  turnaround = 0.001
+
   def __init__(self):
     self.sp = None
 
+    # Configured read timeout, shortened as needed to meet deadlines.
+    self.timeout = None
+
+    # Number of acknowledgements we did not wait for after emergency_stop()
+    # They arrive ahead of acknowledgement for any later command.
+    self.unread_acks = 0
+
+    # Changes smaller than these (in units sent to the device) are not worth
+    # sending. Optionally configured by "deadband" in configuration file.
+    self.velocity_deadband = 0
+    self.angle_deadband = 0
+
+    # Steering speed used to estimate how long a turn takes, see
+    # steering_time(). Optionally configured by "degrees_per_second".
+    self.degrees_per_second = default_degrees_per_second
+
+  def device(self, id):
+    """ Each DMFE device has its own ID on the bus """
+    did, center, inverted = self.check_id(id)
+    return "DMFE {}".format(did)
+
+  def serial_port(self):
+    """ Serial port for asyncbus """
+    self.check_sp()
+    return self.sp
+
   def check_sp(self):
-    """ Raises error if we haven't opened serial port yet. """
+    """
+    Raises error if we haven't opened serial port yet, or if the current
+    deadline (see rovertime.within) has passed. Otherwise limits read
+    timeout to the time left before that deadline.
+    """
     if self.sp == None:
       raise ValueError("DMFE serial communication is not available.")
 
-  def connect(self):
+    timeout = rovertime.budget(self.timeout, "DMFE command")
+    if self.sp.timeout != timeout:
+      self.sp.timeout = timeout
+
+  def connect(self, instance=None):
     """
     Read serial port connection parameters from JSON configuration file
     and open the port.
+
+    Given one of the "instances" in the configuration file, connect to that
+    instance instead.
     """
 
     # Read parameter file
     config = configuration.configuration("dmfe")
-    connectparams = config.load()['connect']
+    allparams = config.load(instance)
+    connectparams = allparams['connect']
+
+    deadband = allparams.get('deadband', dict())
+    self.velocity_deadband = deadband.get('velocity', 0)
+    self.angle_deadband = deadband.get('angle', 0)
+
+    self.degrees_per_second = float(allparams.get('degrees_per_second', default_degrees_per_second))
+    if self.degrees_per_second <= 0:
+      raise ValueError("DMFE degrees_per_second {} must be positive".format(self.degrees_per_second))
 
     # Open serial port with parameters
     s = serial.Serial()
     s.baudrate = connectparams['baudrate']
     s.port = connectparams['port']
     s.timeout = connectparams['timeout']
+    self.timeout = s.timeout
+    self.baudrate = s.baudrate
     s.open()
 
     if s.is_open:
       self.sp = s
+      self.bus = s.port
 
   def close(self):
     """
@@ -83,6 +228,14 @@ class dmfe_wrapper:
     checksum calculation for a command packet.
     """
     self.check_sp()
+    self.sp.write(self.packet(device_id, command, data))
+
+  @staticmethod
+  def packet(device_id, command, data=b'\x00\x00\x00'):
+    """
+    Build a command packet for a DMFE bus device, including header and
+    checksum, and return it as a bytearray ready to send.
+    """
     packet = bytearray([0xDD, 0xDD])
 
     # Sender is master with ID of 1
@@ -105,7 +258,7 @@ class dmfe_wrapper:
       checksum = checksum ^ packet[i]
     packet.append(checksum)
 
-    self.sp.write(packet)
+    return packet
 
   def read_raw(self, length=100):
     """
@@ -120,19 +273,45 @@ class dmfe_wrapper:
     We expect to receive a single byte 0xFF as acknowledgement
     """
     self.check_sp()
-    r = bytearray(self.sp.read(1))
+    self.discard_unread_acks()
+    self.check_ack(bytearray(self.sp.read(1)))
 
+  @staticmethod
+  def check_ack(r):
+    """ Validates acknowledgement bytes already read """
     if len(r) == 0:
       raise ValueError("Expected single byte 0xFF in response but received no data.")
 
     if r[0] != 255:
       raise ValueError("Expected 0xFF in response but got {}".format(r[0]))
 
+  def read_ack_many(self, count):
+    """
+    Read acknowledgement for 'count' commands sent back to back.
+    """
+    self.check_sp()
+    self.discard_unread_acks()
+    r = bytearray(self.sp.read(count))
+
+    if len(r) != count:
+      raise ValueError("Expected {} acknowledgement bytes but received {}".format(count, len(r)))
+
+    for b in r:
+      if b != 255:
+        raise ValueError("Expected 0xFF in response but got {}".format(b))
+
+  def discard_unread_acks(self):
+    """ Read and throw away acknowledgements counted in unread_acks """
+    if self.unread_acks:
+      self.sp.read(self.unread_acks)
+      self.unread_acks = 0
+
   def read_dmfeserialservo(self):
     """
     We expect a device identifier string
     """
     self.check_sp()
+    self.discard_unread_acks()
     r = self.sp.read(18).decode('utf-8')
 
     if len(r) == 0:
@@ -149,6 +328,7 @@ class dmfe_wrapper:
     We expect a device identifier string
     """
     self.check_sp()
+    self.discard_unread_acks()
     r = self.sp.read(20).decode('utf-8')
 
     if len(r) == 0:
@@ -167,6 +347,7 @@ class dmfe_wrapper:
     Returns the 4-byte data array
     """
     self.check_sp()
+    self.discard_unread_acks()
     r = self.sp.read(7)
 
     if len(r) != 7:
@@ -237,21 +418,22 @@ class dmfe_wrapper:
 
   def power_percent(self, id, percentage):
     """ Send brushed motor speed command to device 'id' at specified +/- 'percentage' """
-    did, center, inverted = self.check_id(id)
-    self.check_sp()
-
-    if inverted:
-      percentage = percentage * -1
+    handle = self.velocity_handle(id)
+    handle.send(handle.setpoint(percentage))
 
-    pct = int(percentage)
-    if abs(pct) > 100:
-      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
-
-    # 50 is wheel power maximum of Mr. Blue rover. TBD: Make this general and configurable
-    power = (percentage * 50) / 100
+  def emergency_stop(self, ids):
+    """
+    Send zero motor speed to every device in the list in a single write,
+    without waiting for acknowledgements.
+    """
+    self.check_sp()
 
-    self.send(did, 0x87, self.data1byte(power))
-    self.read_ack()
+    block = bytearray()
+    for id in ids:
+      did, center, inverted = self.check_id(id)
+      block += self.packet(did, 0x87, self.data1byte(0))
+    self.sp.write(block)
+    self.unread_acks = self.unread_acks + len(ids)
 
   def set_max_current(self, id, current):
     """ Set maximum current allowed before tripping protection """
@@ -265,6 +447,10 @@ class dmfe_wrapper:
     self.check_sp()
     # Not applicable to DMFE devices
   
+  def velocity_handle(self, id):
+    """ Returns a velocity_handle for the specified device """
+    return velocity_handle(self, id)
+
   def velocity(self,id,pct_velocity):
     """
     Runs the device in motor mode at specified velocity
@@ -288,20 +474,44 @@ class dmfe_wrapper:
     self.check_sp()
     return maxangle
 
-  def angle(self, id, angle):
-    did, center, inverted = self.check_id(id)
-    self.check_sp()
-
-    if abs(angle) > maxangle:
-      raise ValueError("Steering angle {} exceeded expected maximum of {}}".format(angle,maxangle))
+  def angle_handle(self, id):
+    """ Returns an angle_handle for the specified device """
+    return angle_handle(self, id)
 
-    if inverted:
-      angle = angle * -1
+  def angle(self, id, angle):
+    handle = self.angle_handle(id)
+    handle.send(handle.setpoint(angle))
 
-    position = 2048 + (angle * 4096/360) # 0 min, 2048 center, 4096 max at 360 degrees
+  def send_many(self, command, commands):
+    """
+    Write all command packets in a single block, then read back all their
+    acknowledgements. 'commands' is a list of (device id, data) tuples.
+    """
+    self.check_sp()
 
-    self.send(did, 0x82, self.data2byte(position))
-    self.read_ack()
+    block = bytearray()
+    for did, data in commands:
+      block += self.packet(did, command, data)
+    self.sp.write(block)
+    self.read_ack_many(len(commands))
+
+  def send_velocity_many(self, commands, wait_ack=True):
+    """ Send brushed motor speed to several devices """
+    if commands:
+      self.send_many(0x87, [(handle.did, self.data1byte(power)) for handle, power in commands])
+
+  def send_angle_many(self, commands, wait_ack=True):
+    """ Send servo position to several devices """
+    if commands:
+      self.send_many(0x82, [(handle.did, self.data2byte(position)) for handle, position in commands])
+
+  def steering_position(self, id):
+    """ Position query is not yet implemented for DMFE devices """
+    return None
+
+  def steering_time(self, id, degrees):
+    """ Estimated number of seconds to turn through given degrees """
+    return float(degrees) / self.degrees_per_second
 
   def steer_setzero(self, id):
     did, center, inverted = self.check_id(id)
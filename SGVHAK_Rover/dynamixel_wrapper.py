@@ -25,6 +25,12 @@ import serial
 from struct import *
 
 import configuration
+import motor_control
+import rovertime
+
+# Rated no-load speed of AX-12A at 12V is 59 RPM, expressed in degrees per
+# second. Moves are commanded at maximum speed so this is how fast we turn.
+max_degrees_per_second = 354
 
 def bytetohex(bytearray):
   """
@@ -34,38 +40,179 @@ def bytetohex(bytearray):
   """
   return ''.join('{:02x}'.format(x) for x in bytearray)
 
-class dynamixel_wrapper:
+class velocity_handle(object):
+  """
+  Wheel mode velocity control of a single Dynamixel servo. Identifier is
+  validated and the send/acknowledge methods are looked up once when the
+  handle is created, leaving only arithmetic and serial traffic for each
+  command.
+
+  setpoint() translates percentage into moving speed register value, which
+  is passed to send(). command() returns the same packet for asyncbus along
+  with its status packet length and a check for it.
+  """
+  __slots__ = ('sid', 'inverted', 'deadband', 'write', 'read_parsed', 'packet')
+
+  # Bytes on the wire for one send(): 9 byte write and 6 byte status.
+  wire_bytes = 15
+
+  def __init__(self, wrapper, id):
+    self.sid, center, self.inverted = wrapper.check_id(id)
+    wrapper.check_sp()
+
+    self.deadband = wrapper.velocity_deadband
+    self.write = wrapper.send
+    self.read_parsed = wrapper.read_parsed
+    self.packet = wrapper.packet
+
+  def setpoint(self, pct_velocity):
+    if self.inverted:
+      pct_velocity = pct_velocity * -1
+
+    pct = int(pct_velocity)
+    if abs(pct) > 100:
+      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
+
+    # Dynamixel API wants power expressed from 0 to 2047. 0-1023 CCW, 1024-2047 CW
+    power = abs(pct_velocity)*1023/100
+
+    if pct_velocity >= 0:
+      power = power + 1024
+
+    return int(power)
+
+  def send(self, power):
+    self.write(self.sid, 3, bytearray(pack('=Bh',32, power)))
+    self.read_parsed(length=6, expectedid=self.sid, expectederr=0, expectedparams=0)
+
+  def command(self, power):
+    return (self.packet(self.sid, 3, bytearray(pack('=Bh',32, power))), 6, self.check)
+
+  def check(self, response):
+    dynamixel_wrapper.parse_status(response, expectedid=self.sid, expectederr=0, expectedparams=0)
+
+class angle_handle(object):
+  """
+  Joint mode angle control of a single Dynamixel servo, see velocity_handle.
+
+  setpoint() translates angle in degrees off center into goal position
+  register value, which is passed to send().
+  """
+  __slots__ = ('sid', 'inverted', 'deadband', 'write', 'read_parsed', 'packet')
+
+  # 11 byte write and 6 byte status.
+  wire_bytes = 17
+
+  def __init__(self, wrapper, id):
+    self.sid, center, self.inverted = wrapper.check_id(id)
+    wrapper.check_sp()
+
+    self.deadband = wrapper.angle_deadband
+    self.write = wrapper.send
+    self.read_parsed = wrapper.read_parsed
+    self.packet = wrapper.packet
+
+  def setpoint(self, angle):
+    if abs(angle) > 95:
+      raise ValueError("Steering angle {} exceeded expected maximum of 90".format(angle))
+
+    if self.inverted:
+      angle = angle * -1
+
+    return int(512 + 511*(angle/150.0)) # 512 count/ 150 degrees = counts per degree.
+
+  def send(self, position):
+    self.write(self.sid, 3, bytearray(pack('=Bhh',30, position, 0)))
+    self.read_parsed(length=6, expectedid=self.sid, expectederr=0, expectedparams=0)
+
+  def command(self, position):
+    return (self.packet(self.sid, 3, bytearray(pack('=Bhh',30, position, 0))), 6, self.check)
+
+  def check(self, response):
+    dynamixel_wrapper.parse_status(response, expectedid=self.sid, expectederr=0, expectedparams=0)
+
+class dynamixel_wrapper(motor_control.motor_control):
   """
   Class that implements the rover motor control methods for Dynamixel serial
   bus servo by Robotis. Specifically the model AX-12A.
+
+  Commands for several servos are sent with SYNC_WRITE in a single packet,
+  which servos act on at the same time but do not acknowledge. If
+  acknowledgement is required, each servo is sent its command with
+  REG_WRITE and acknowledges it, then they all start on a broadcast ACTION.
   """
+  supports_velocity_many = True
+  supports_angle_many = True
+  supports_synchronized_start = True
+  supports_no_ack = True
+
+  # Default return delay time of AX-12A is 250 * 2 microseconds.
+  turnaround = 0.0005
+
   def __init__(self):
     self.sp = None
 
+    # Configured read timeout, shortened as needed to meet deadlines.
+    self.timeout = None
+
+    # Changes smaller than these (in units sent to the device) are not worth
+    # sending. Optionally configured by "deadband" in configuration file.
+    self.velocity_deadband = 0
+    self.angle_deadband = 0
+
+  def device(self, id):
+    """ Each Dynamixel device has its own ID on the bus """
+    sid, center, inverted = self.check_id(id)
+    return "Dynamixel {}".format(sid)
+
+  def serial_port(self):
+    """ Serial port for asyncbus """
+    self.check_sp()
+    return self.sp
+
   def check_sp(self):
-    """ Raises error if we haven't opened serial port yet. """
+    """
+    Raises error if we haven't opened serial port yet, or if the current
+    deadline (see rovertime.within) has passed. Otherwise limits read
+    timeout to the time left before that deadline.
+    """
     if self.sp == None:
       raise ValueError("Dynamixel serial communication is not available.")
 
-  def connect(self):
+    timeout = rovertime.budget(self.timeout, "Dynamixel command")
+    if self.sp.timeout != timeout:
+      self.sp.timeout = timeout
+
+  def connect(self, instance=None):
     """
     Read serial port connection parameters from JSON configuration file
     and open the port.
+
+    Given one of the "instances" in the configuration file, connect to that
+    instance instead.
     """
 
     # Read parameter file
     config = configuration.configuration("dynamixel")
-    connectparams = config.load()['connect']
+    allparams = config.load(instance)
+    connectparams = allparams['connect']
+
+    deadband = allparams.get('deadband', dict())
+    self.velocity_deadband = deadband.get('velocity', 0)
+    self.angle_deadband = deadband.get('angle', 0)
 
     # Open serial port with parameters
     s = serial.Serial()
     s.baudrate = connectparams['baudrate']
     s.port = connectparams['port']
     s.timeout = connectparams['timeout']
+    self.timeout = s.timeout
+    self.baudrate = s.baudrate
     s.open()
 
     if s.is_open:
       self.sp = s
+      self.bus = s.port
 
   def close(self):
     """
@@ -81,6 +228,14 @@ class dynamixel_wrapper:
     checksum calculation for a command packet.
     """
     self.check_sp()
+    self.sp.write(self.packet(servo_id, command, data))
+
+  @staticmethod
+  def packet(servo_id, command, data=None):
+    """
+    Build a command packet for a Dynamixel servo, including header and
+    checksum, and return it as a bytearray ready to send.
+    """
     packet = [0xFF, 0xFF]
 
     if servo_id < 0 or servo_id > 0xfe:
@@ -109,7 +264,7 @@ class dynamixel_wrapper:
 
     packet_bytes = bytearray(packet)
     # print("Sending command byte stream of {}".format(bytetohex(packet_bytes)))
-    self.sp.write(packet_bytes)
+    return packet_bytes
 
   def read_raw(self, length=100):
     """
@@ -143,8 +298,14 @@ class dynamixel_wrapper:
       If a mismatch is found, a ValueError is raised.
     """
     self.check_sp()
-    r = bytearray(self.sp.read(length))
+    return self.parse_status(bytearray(self.sp.read(length)), expectedid, expectederr, expectedparams)
 
+  @staticmethod
+  def parse_status(r, expectedid=None, expectederr=None, expectedparams=None):
+    """
+    Validates status packet bytes already read, as described in read_parsed.
+    Returns (id, error, parameters) tuple.
+    """
     # Check response length
     if len(r) < 6:
       raise ValueError("Need at least 6 bytes for a valid packet, received {}".format(len(r)))
@@ -216,24 +377,17 @@ class dynamixel_wrapper:
 
   def power_percent(self, id, percentage):
     """ Runs servo in motor mode at specified +/- percentage """
-    sid, center, inverted = self.check_id(id)
-    self.check_sp()
-
-    if inverted:
-      percentage = percentage * -1
-
-    pct = int(percentage)
-    if abs(pct) > 100:
-      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
-
-    # Dynamixel API wants power expressed from 0 to 2047. 0-1023 CCW, 1024-2047 CW
-    power = abs(percentage)*1023/100
-
-    if percentage >= 0:
-      power = power + 1024
+    handle = self.velocity_handle(id)
+    handle.send(handle.setpoint(percentage))
 
-    self.send(sid, 3, bytearray(pack('=Bh',32, power)))
-    self.read_parsed(length=6, expectedid=sid, expectederr=0, expectedparams=0)
+  def emergency_stop(self, ids):
+    """
+    Broadcast torque disable to every servo on the bus, which stops all of
+    them with a single packet. Dynamixel servos do not respond to broadcast.
+    Next goal position or moving speed written re-enables torque.
+    """
+    self.check_sp()
+    self.send(0xfe, 3, bytearray([24, 0]))
 
   def set_max_current(self, id, current):
     sid, center, inverted = self.check_id(id)
@@ -247,6 +401,10 @@ class dynamixel_wrapper:
     self.send(sid, 3, bytearray(pack('=Bhh',6, 0, 0))) # Make sure we're in wheel mode
     self.read_parsed(length=6, expectedid=sid, expectederr=0, expectedparams=0)
 
+  def velocity_handle(self, id):
+    """ Returns a velocity_handle for the specified servo """
+    return velocity_handle(self, id)
+
   def velocity(self,id,pct_velocity):
     """
     Runs the specified servo in motor mode at specified velocity
@@ -269,20 +427,73 @@ class dynamixel_wrapper:
     self.check_sp()
     return 150
 
+  def angle_handle(self, id):
+    """ Returns an angle_handle for the specified servo """
+    return angle_handle(self, id)
+
   def angle(self, id, angle):
-    sid, center, inverted = self.check_id(id)
+    handle = self.angle_handle(id)
+    handle.send(handle.setpoint(angle))
+
+  def send_many(self, address, commands, wait_ack):
+    """
+    Write to control table of several servos, starting at the same time.
+    'commands' is a list of (servo id, data bytes) tuples, all data of the
+    same length.
+    """
     self.check_sp()
 
-    if abs(angle) > 95:
-      raise ValueError("Steering angle {} exceeded expected maximum of 90".format(angle))
+    if wait_ack:
+      for sid, data in commands:
+        self.send(sid, 4, bytearray([address]) + data) # REG_WRITE
+        self.read_parsed(length=6, expectedid=sid, expectederr=0, expectedparams=0)
+      self.send(0xfe, 5) # ACTION, broadcast so no response.
+    else:
+      params = bytearray([address, len(commands[0][1])])
+      for sid, data in commands:
+        params.append(sid)
+        params += data
+      self.send(0xfe, 0x83, params) # SYNC_WRITE, broadcast so no response.
+
+  def send_velocity_many(self, commands, wait_ack=True):
+    """ Write moving speed register of several servos """
+    if commands:
+      self.send_many(32, [(handle.sid, bytearray(pack('=h', power))) for handle, power in commands], wait_ack)
+
+  def send_angle_many(self, commands, wait_ack=True):
+    """ Write goal position (and moving speed) register of several servos """
+    if commands:
+      self.send_many(30, [(handle.sid, bytearray(pack('=hh', position, 0))) for handle, position in commands], wait_ack)
+
+  def steering_position(self, id):
+    """
+    Read servo present position and return it as angle expressed in number
+    of degrees off center.
+    """
+    packet, length, parse = self.steering_position_command(id)
+    self.check_sp()
 
-    if inverted:
-      angle = angle * -1
+    self.sp.write(packet)
+    return parse(self.read_raw(length))
 
-    delta = 512 + 511*(angle/150.0) # 512 count/ 150 degrees = counts per degree.
+  def steering_position_command(self, id):
+    """ Present position read for asyncbus, see motor_control """
+    sid, center, inverted = self.check_id(id)
 
-    self.send(sid, 3, bytearray(pack('=Bhh',30, delta, 0)))
-    self.read_parsed(length=6, expectedid=sid, expectederr=0, expectedparams=0)
+    def parse(response):
+      (rid, err, params) = self.parse_status(response, expectedid=sid, expectederr=0, expectedparams=2)
+      angle = (unpack('h', params)[0] - 512) * 150.0/511
+
+      if inverted:
+        angle = angle * -1
+
+      return angle
+
+    return (self.packet(sid, 2, (36,2)), 8, parse)
+
+  def steering_time(self, id, degrees):
+    """ Estimated number of seconds to turn through given degrees """
+    return float(degrees) / max_degrees_per_second
 
   def steer_setzero(self, id):
     sid, center, inverted = self.check_id(id)
@@ -293,14 +504,23 @@ class dynamixel_wrapper:
     """
     Query Dynamixel servo's internal voltage monitor
     """
-    sid, center, inverted = self.check_id(id)
+    packet, length, parse = self.input_voltage_command(id)
     self.check_sp()
 
-    self.send(sid, 2, (42,1))
-    (sid, err, params) = self.read_parsed(length=7,expectedid=sid, expectederr=0, expectedparams=1)
-    voltage = params[0]
+    self.sp.write(packet)
+    return parse(self.read_raw(length))
+
+  def input_voltage_command(self, id):
+    """ Present voltage read for asyncbus, see motor_control """
+    sid, center, inverted = self.check_id(id)
+
+    def parse(response):
+      (rid, err, params) = self.parse_status(response, expectedid=sid, expectederr=0, expectedparams=1)
+      voltage = params[0]
+
+      return voltage/10.0
 
-    return voltage/10.0
+    return (self.packet(sid, 2, (42,1)), 7, parse)
 
 if __name__ == "__main__":
   """
@@ -0,0 +1,130 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# NumPy is optional. Without it, roverchassis falls back to calculating one
+# wheel at a time in plain Python.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def available():
+  """ True if NumPy is installed and the vectorized solver can be used. """
+  return numpy is not None
+
+class chassis_geometry:
+  """
+  Structure-of-arrays copy of the chassis wheel geometry. Instead of one
+  roverwheel object per wheel, every wheel's X, Y, and steering limit is
+  packed into a NumPy array so the Ackerman math in
+  roverchassis.chassis.move_velocity_radius can be done for all wheels at
+  once. The same math also runs across many (velocity, radius) pairs in a
+  single call, which is what motion planning code wants when it evaluates
+  hundreds of candidate arcs.
+
+  Wheel order in every array matches the order of the 'wheels' list given
+  to the constructor, also available as the 'wheels' and 'names' attributes.
+  """
+  def __init__(self, wheels):
+    if numpy is None:
+      raise ValueError("NumPy is required for vectorized chassis geometry")
+
+    self.wheels = list(wheels)
+    self.names = [wheel.name for wheel in self.wheels]
+
+    self.x = numpy.array([wheel.x for wheel in self.wheels], dtype=float)
+    self.y = numpy.array([wheel.y for wheel in self.wheels], dtype=float)
+
+    # Maximum steering angle of each wheel. Wheels without steering control
+    # can't turn at all, so their limit is zero.
+    maxangle = list()
+    for wheel in self.wheels:
+      if wheel.steeringcontrol:
+        maxangle.append(wheel.steeringcontrol.maxangle(wheel.steeringparam))
+      else:
+        maxangle.append(0)
+    self.maxangle = numpy.array(maxangle, dtype=float)
+    self.steerable = numpy.array([wheel.steeringcontrol is not None for wheel in self.wheels])
+
+  def solve(self, velocity, radius, maxRadius):
+    """
+    Calculate steering angle and rolling velocity of every wheel for a single
+    (velocity, radius) motion. Returns a tuple of two arrays (angles,
+    velocities) each with one element per wheel.
+
+    Caller is responsible for validating velocity and radius.
+    """
+    angles, velocities = self.solve_many(
+      numpy.array([velocity], dtype=float),
+      numpy.array([radius], dtype=float),
+      maxRadius)
+    return angles[0], velocities[0]
+
+  def solve_many(self, velocities, radii, maxRadius):
+    """
+    Vectorized form of the per-wheel calculation in
+    roverchassis.chassis.move_velocity_radius. Given N velocities and N radii
+    returns a tuple of two N x (number of wheels) arrays: steering angles and
+    rolling velocities. Row i is the result for (velocities[i], radii[i]).
+
+    Caller is responsible for validating velocity and radius.
+    """
+    velocity = numpy.asarray(velocities, dtype=float).reshape(-1, 1)
+    radius = numpy.asarray(radii, dtype=float).reshape(-1, 1)
+    x = self.x.reshape(1, -1)
+    y = self.y.reshape(1, -1)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      # Dimensions of triangle representing each wheel. Used for calculations
+      # in form of opposite, adjacent, and hypotenuse
+      opp = y
+      adj = radius - x
+      hyp = numpy.hypot(opp, adj)
+
+      # Wheel steering angle, 90 degrees when wheel is directly in line with
+      # center of turn.
+      angles = numpy.where(adj == 0, 90.0, numpy.degrees(numpy.arctan(opp/adj)))
+
+      # Wheel rolling velocity. TODO: spin-in-place where radius is zero.
+      wheelvelocity = numpy.where(radius == 0, 0.0, velocity * hyp/numpy.abs(radius))
+
+      # If center of rotation is within the wheel track, and between the
+      # wheel and the origin, then this wheel will need to turn in the
+      # opposite direction so the rover body can turn about the center.
+      flip = ((radius < 0) & (x < 0) & (x < radius)) | ((radius > 0) & (x > 0) & (x > radius))
+      wheelvelocity = numpy.where(flip, -wheelvelocity, wheelvelocity)
+
+      # Straight line travel
+      straight = radius > maxRadius
+      angles = numpy.where(straight, 0.0, angles)
+      wheelvelocity = numpy.where(straight, velocity, wheelvelocity)
+
+      # Normalize wheel roll rate magnitude so they are at or below target
+      # velocity while maintaining relative ratios between their rates.
+      maxCalculated = numpy.abs(wheelvelocity).max(axis=1).reshape(-1, 1)
+      normalize = (maxCalculated > velocity) & (maxCalculated > 0)
+      reductionRatio = numpy.where(normalize, numpy.abs(velocity)/maxCalculated, 1.0)
+      wheelvelocity = wheelvelocity * reductionRatio
+
+    return angles, wheelvelocity
@@ -25,6 +25,11 @@ import serial
 from struct import *
 
 import configuration
+import motor_control
+import rovertime
+
+# Number of milliseconds we ask the servo to take when moving to a new angle.
+angle_move_time = 200
 
 def bytetohex(bytearray):
   """
@@ -34,38 +39,162 @@ def bytetohex(bytearray):
   """
   return ''.join('{:02x}'.format(x) for x in bytearray)
 
-class lewansoul_wrapper:
+class velocity_handle(object):
+  """
+  Motor mode velocity control of a single LewanSoul servo. Identifier is
+  validated and the packet writer is looked up once when the handle is
+  created, leaving only arithmetic and the write for each command.
+
+  setpoint() translates percentage into motor mode power value, which is
+  passed to send(). command() returns the same packet for asyncbus. Servos
+  do not respond, so there is no response to check.
+  """
+  __slots__ = ('sid', 'scale', 'deadband', 'packet', 'write')
+
+  # Bytes on the wire for one send(): 10 byte packet, servos don't answer.
+  wire_bytes = 10
+
+  def __init__(self, wrapper, id):
+    self.sid, center, inverted = wrapper.check_id(id)
+    wrapper.check_sp()
+
+    # LewanSoul API wants power expressed between -1000 and 1000, so multiply by 10.
+    self.scale = 10
+    if inverted:
+      self.scale = -self.scale
+
+    self.deadband = wrapper.velocity_deadband
+    self.packet = wrapper.packet
+    self.write = wrapper.sp.write
+
+  def setpoint(self, pct_velocity):
+    if abs(int(pct_velocity)) > 100:
+      raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct_velocity))
+
+    return int(pct_velocity * self.scale)
+
+  def send(self, power):
+    self.write(self.packet(self.sid, 29, bytearray(pack('hh',1,power))))
+
+  def command(self, power):
+    return (self.packet(self.sid, 29, bytearray(pack('hh',1,power))), 0, None)
+
+class angle_handle(object):
+  """
+  Servo mode angle control of a single LewanSoul servo, see velocity_handle.
+
+  setpoint() translates angle in degrees off center into servo position,
+  which is passed to send().
+  """
+  __slots__ = ('sid', 'center', 'scale', 'deadband', 'servomode', 'packet', 'write')
+
+  # Servo mode packet and move packet, 10 bytes each.
+  wire_bytes = 20
+
+  def __init__(self, wrapper, id):
+    self.sid, self.center, inverted = wrapper.check_id(id)
+    wrapper.check_sp()
+
+    self.scale = 500.0/120.0 # 500 count/ 120 degrees = counts per degree.
+    if inverted:
+      self.scale = -self.scale
+
+    self.deadband = wrapper.angle_deadband
+    self.servomode = wrapper.packet(self.sid, 29, (0,0,0,0))
+    self.packet = wrapper.packet
+    self.write = wrapper.sp.write
+
+  def setpoint(self, angle):
+    if abs(angle) > 95:
+      raise ValueError("Steering angle {} exceeded expected maximum of 90".format(angle))
+
+    return int(self.center + angle * self.scale)
+
+  def send(self, position):
+    self.write(self.servomode)
+    self.write(self.packet(self.sid, 1, bytearray(pack('hh', position, angle_move_time))))
+
+  def command(self, position):
+    return (self.servomode + self.packet(self.sid, 1, bytearray(pack('hh', position, angle_move_time))), 0, None)
+
+class lewansoul_wrapper(motor_control.motor_control):
   """
   Class that implements the rover motor control methods for serial bus
   servo by LewanSoul. Specifically their model LX-16A.
+
+  LewanSoul servos never acknowledge commands, so commands for several
+  servos can be written as one block. Angle commands for several servos use
+  move-and-wait, started together with a single broadcast move start.
   """
+  supports_velocity_many = True
+  supports_angle_many = True
+  supports_synchronized_start = True
+  supports_no_ack = True
+
   def __init__(self):
     self.sp = None
 
+    # Configured read timeout, shortened as needed to meet deadlines.
+    self.timeout = None
+
+    # Changes smaller than these (in units sent to the device) are not worth
+    # sending. Optionally configured by "deadband" in configuration file.
+    self.velocity_deadband = 0
+    self.angle_deadband = 0
+
+  def device(self, id):
+    """ Each LewanSoul device has its own ID on the bus """
+    sid, center, inverted = self.check_id(id)
+    return "LewanSoul {}".format(sid)
+
+  def serial_port(self):
+    """ Serial port for asyncbus """
+    self.check_sp()
+    return self.sp
+
   def check_sp(self):
-    """ Raises error if we haven't opened serial port yet. """
+    """
+    Raises error if we haven't opened serial port yet, or if the current
+    deadline (see rovertime.within) has passed. Otherwise limits read
+    timeout to the time left before that deadline.
+    """
     if self.sp == None:
       raise ValueError("LewanSoul serial communication is not available.")
 
-  def connect(self):
+    timeout = rovertime.budget(self.timeout, "LewanSoul command")
+    if self.sp.timeout != timeout:
+      self.sp.timeout = timeout
+
+  def connect(self, instance=None):
     """
     Read serial port connection parameters from JSON configuration file
     and open the port.
+
+    Given one of the "instances" in the configuration file, connect to that
+    instance instead.
     """
 
     # Read parameter file
     config = configuration.configuration("lewansoul")
-    connectparams = config.load()['connect']
+    allparams = config.load(instance)
+    connectparams = allparams['connect']
+
+    deadband = allparams.get('deadband', dict())
+    self.velocity_deadband = deadband.get('velocity', 0)
+    self.angle_deadband = deadband.get('angle', 0)
 
     # Open serial port with parameters
     s = serial.Serial()
     s.baudrate = connectparams['baudrate']
     s.port = connectparams['port']
     s.timeout = connectparams['timeout']
+    self.timeout = s.timeout
+    self.baudrate = s.baudrate
     s.open()
 
     if s.is_open:
       self.sp = s
+      self.bus = s.port
 
   def close(self):
     """
@@ -81,6 +210,16 @@ class lewansoul_wrapper:
     checksum calculation for a command packet.
     """
     self.check_sp()
+    packet_bytes = self.packet(servo_id, command, data)
+    # print("Sending command byte stream of {}".format(bytetohex(packet_bytes)))
+    self.sp.write(packet_bytes)
+
+  @staticmethod
+  def packet(servo_id, command, data=None):
+    """
+    Build a command packet for a LewanSoul servo, including header and
+    checksum, and return it as a bytearray ready to send.
+    """
     packet = [0x55, 0x55]
 
     if servo_id < 0 or servo_id > 0xfe:
@@ -107,9 +246,7 @@ class lewansoul_wrapper:
     checksum = (~checksum) & 0xff
     packet.append(checksum)
 
-    packet_bytes = bytearray(packet)
-    # print("Sending command byte stream of {}".format(bytetohex(packet_bytes)))
-    self.sp.write(packet_bytes)
+    return bytearray(packet)
 
   def read_raw(self, length=100):
     """
@@ -141,8 +278,14 @@ class lewansoul_wrapper:
       If a mismatch is found, a ValueError is raised.
     """
     self.check_sp()
-    r = bytearray(self.sp.read(length))
+    return self.parse_status(bytearray(self.sp.read(length)), expectedid, expectedcmd, expectedparams)
 
+  @staticmethod
+  def parse_status(r, expectedid=None, expectedcmd=None, expectedparams=None):
+    """
+    Validates response packet bytes already read, as described in
+    read_parsed. Returns (id, command, parameters) tuple.
+    """
     # Check response length
     if len(r) < 6:
       raise ValueError("Need at least 6 bytes for a valid packet, received {}".format(len(r)))
@@ -222,13 +365,22 @@ class lewansoul_wrapper:
       raise ValueError("Motor power percentage {0} outside valid range from 0 to 100.".format(pct))
 
     # LewanSoul API wants power expressed between -1000 and 1000, so multiply by 10.
-    power = percentage*10
+    power = int(percentage*10)
 
     if inverted:
       power = power * -1
 
     self.send(sid, 29, bytearray(pack('hh',1,power)))
 
+  def emergency_stop(self, ids):
+    """
+    Broadcast motor mode at zero power to every servo on the bus, which
+    stops all of them with a single packet. LewanSoul servos do not
+    respond to broadcast.
+    """
+    self.check_sp()
+    self.sp.write(self.packet(0xfe, 29, bytearray(pack('hh',1,0))))
+
   def set_max_current(self, id, current):
     """ LewanSoul does not support overpower protection. """
     sid, center, inverted = self.check_id(id)
@@ -242,12 +394,17 @@ class lewansoul_wrapper:
 
     self.send(sid, 29, bytearray(pack('hh',1,0)))
 
+  def velocity_handle(self, id):
+    """ Returns a velocity_handle for the specified servo """
+    return velocity_handle(self, id)
+
   def velocity(self,id,pct_velocity):
     """
     Runs the specified servo in motor mode at specified velocity
     In case of LewanSoul servos, it is the same as power_percent.
     """
-    self.power_percent(id,pct_velocity)
+    handle = self.velocity_handle(id)
+    handle.send(handle.setpoint(pct_velocity))
 
   def init_angle(self, id):
     """
@@ -264,20 +421,69 @@ class lewansoul_wrapper:
     self.check_sp()
     return 120
 
+  def angle_handle(self, id):
+    """ Returns an angle_handle for the specified servo """
+    return angle_handle(self, id)
+
   def angle(self, id, angle):
-    sid, center, inverted = self.check_id(id)
+    handle = self.angle_handle(id)
+    handle.send(handle.setpoint(angle))
+
+  def send_velocity_many(self, commands, wait_ack=True):
+    """ Send motor mode power to several servos in a single write """
     self.check_sp()
 
-    if abs(angle) > 95:
-      raise ValueError("Steering angle {} exceeded expected maximum of 90".format(angle))
+    block = bytearray()
+    for handle, power in commands:
+      block += self.packet(handle.sid, 29, bytearray(pack('hh',1,power)))
+    self.sp.write(block)
 
-    delta = angle * (500.0/120.0) # 500 count/ 120 degrees = counts per degree.
+  def send_angle_many(self, commands, wait_ack=True):
+    """
+    Send servo positions to several servos in a single write. Each servo
+    waits for the broadcast move start at the end so they all start moving
+    at the same time.
+    """
+    self.check_sp()
 
-    if inverted:
-      delta = delta * -1
+    block = bytearray()
+    for handle, position in commands:
+      block += handle.servomode
+      block += self.packet(handle.sid, 7, bytearray(pack('hh', position, angle_move_time)))
+    block += self.packet(0xfe, 11)
+    self.sp.write(block)
 
-    self.send(sid, 29, (0,0,0,0)) # Servo mode
-    self.send(sid, 1, bytearray(pack('hh', center+delta, 200)))
+  def steering_position(self, id):
+    """
+    Query servo for its current position and return it as angle expressed in
+    number of degrees off center.
+    """
+    packet, length, parse = self.steering_position_command(id)
+    self.check_sp()
+
+    self.sp.write(packet)
+    return parse(self.read_raw(length))
+
+  def steering_position_command(self, id):
+    """ Position read for asyncbus, see motor_control """
+    sid, center, inverted = self.check_id(id)
+
+    def parse(response):
+      (rid, cmd, params) = self.parse_status(response, expectedid=sid, expectedcmd=28, expectedparams=2)
+      delta = unpack('h', params)[0] - center
+
+      if inverted:
+        delta = delta * -1
+
+      return delta * (120.0/500.0) # 500 count/ 120 degrees = counts per degree.
+
+    return (self.packet(sid, 28), 8, parse)
+
+  def steering_time(self, id, degrees):
+    """
+    Servo is told to complete every move in the same amount of time.
+    """
+    return angle_move_time / 1000.0
 
   def steer_setzero(self, id):
     sid, center, inverted = self.check_id(id)
@@ -288,14 +494,23 @@ class lewansoul_wrapper:
     """
     Query LewanSoul servo's internal voltage monitor
     """
-    sid, center, inverted = self.check_id(id)
+    packet, length, parse = self.input_voltage_command(id)
     self.check_sp()
 
-    self.send(sid, 27)
-    (sid, cmd, params) = self.read_parsed(length=8, expectedcmd=27, expectedparams=2)
-    millivolts = unpack('h', params)[0]
+    self.sp.write(packet)
+    return parse(self.read_raw(length))
+
+  def input_voltage_command(self, id):
+    """ Voltage read for asyncbus, see motor_control """
+    sid, center, inverted = self.check_id(id)
+
+    def parse(response):
+      (rid, cmd, params) = self.parse_status(response, expectedcmd=27, expectedparams=2)
+      millivolts = unpack('h', params)[0]
+
+      return millivolts/1000.0
 
-    return millivolts/1000.0
+    return (self.packet(sid, 27), 8, parse)
 
 if __name__ == "__main__":
   """
@@ -0,0 +1,202 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import math
+import threading
+import time
+
+from rovertime import monotonic
+
+# Python 2 does not have a constant for infinity. (Python 3 added math.inf.)
+infinity = float("inf")
+
+# Longest time the maneuver thread sleeps before checking whether it has
+# been cancelled. This is the worst case delay for cancel() to take effect.
+cancel_check_interval = 0.005
+
+class maneuver:
+  """
+  A timed sequence of motions executed by the rover without any further
+  input. Each segment is a (velocity, radius, duration) tuple where velocity
+  and radius are as given to chassis.move_velocity_radius and duration is in
+  seconds. Rover stops at the end of the final segment.
+
+  Segments run in a background thread so the web server stays available to
+  receive a stop command. Segment start times are scheduled relative to the
+  start of the whole maneuver, so time spent sending commands to motor
+  controllers does not accumulate over many segments.
+
+  While a maneuver is running nothing else should command the chassis: call
+  cancel() first, which waits for the thread to finish. Like every other
+  thread, this one reaches motor controllers through the owner thread of
+  their bus, see busowner.py
+  """
+  def __init__(self, chassis, segments):
+    self.chassis = chassis
+    self.segments = self.check_segments(chassis, segments)
+
+    self.cancelled = False
+    self.thread = None
+
+    # Progress information for status display.
+    self.current = None
+    self.error = None
+    self.starttime = None
+
+  @staticmethod
+  def check_segments(chassis, segments):
+    """
+    Validate list of segments before we start moving. Radius of None means
+    straight line travel, since JSON has no way to express infinity.
+    Returns list of validated (velocity, radius, duration) tuples.
+    """
+    if not isinstance(segments, (list, tuple)) or len(segments) == 0:
+      raise ValueError("Maneuver needs a list of at least one segment")
+
+    checked = list()
+    for segment in segments:
+      if not isinstance(segment, (list, tuple)) or len(segment) != 3:
+        raise ValueError("Maneuver segment {} must be (velocity, radius, duration)".format(segment))
+
+      velocity, radius, duration = segment
+      if radius is None:
+        radius = infinity
+      try:
+        velocity = float(velocity)
+        radius = float(radius)
+        duration = float(duration)
+      except TypeError:
+        raise ValueError("Maneuver segment {} must be numbers".format(segment))
+
+      # NaN compares False against everything, so it has to be rejected
+      # explicitly or it would slip past every range check below.
+      if math.isnan(velocity) or abs(velocity) > 100:
+        raise ValueError("Velocity percentage {} must be a number no more than 100".format(velocity))
+
+      if math.isnan(radius) or abs(radius) < chassis.minRadius:
+        raise ValueError("Radius {} must be a number no smaller than {}".format(radius, chassis.minRadius))
+
+      if math.isnan(duration) or math.isinf(duration) or duration <= 0:
+        raise ValueError("Segment duration {} must be a positive number of seconds".format(duration))
+
+      checked.append((velocity, radius, duration))
+
+    return checked
+
+  def duration(self):
+    """ Total number of seconds for all segments """
+    return sum([segment[2] for segment in self.segments])
+
+  def start(self):
+    """ Start executing the maneuver in the background """
+    self.thread = threading.Thread(target=self.run, name="maneuver")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def cancel(self):
+    """
+    Stop executing the maneuver and wait for its thread to exit. Wheels are
+    left with whatever was last commanded, it is up to the caller to stop
+    them.
+    """
+    self.cancelled = True
+    if self.thread and self.thread is not threading.current_thread():
+      self.thread.join()
+
+  def running(self):
+    """ True if the maneuver thread is still going """
+    return self.thread is not None and self.thread.is_alive()
+
+  def wait_until(self, deadline):
+    """
+    Sleep until the given monotonic time. Returns False if cancelled.
+    """
+    while not self.cancelled:
+      remaining = deadline - monotonic()
+      if remaining <= 0:
+        return True
+      time.sleep(min(remaining, cancel_check_interval))
+    return False
+
+  def run(self):
+    """ Body of the maneuver thread """
+    self.starttime = monotonic()
+    deadline = self.starttime
+    radius = infinity
+
+    try:
+      for index, (velocity, radius, duration) in enumerate(self.segments):
+        if self.cancelled:
+          return
+        self.current = index
+        self.chassis.move_velocity_radius(velocity, radius)
+
+        deadline = deadline + duration
+        if not self.wait_until(deadline):
+          return
+
+      self.current = None
+    except StandardError as se:
+      self.error = str(se)
+      logging.getLogger(__name__).error("Maneuver stopped at segment %s: %s", self.current, self.error)
+    finally:
+      # Whoever cancelled the maneuver takes care of the wheels. Otherwise
+      # they must be stopped here, whether we finished or failed partway.
+      if not self.cancelled:
+        self.stop(radius)
+
+  def stop(self, radius):
+    """
+    Bring the rover to a stop at the end of the maneuver, or after an error.
+    If the usual zero velocity command fails, fall back to the chassis
+    emergency stop, which keeps going past controllers that fail.
+    """
+    try:
+      self.chassis.move_velocity_radius(0, radius)
+      return
+    except StandardError as se:
+      logging.getLogger(__name__).error("Maneuver could not stop, trying emergency stop: %s", str(se))
+
+    try:
+      self.chassis.emergency_stop()
+    except StandardError as se:
+      logging.getLogger(__name__).error("Maneuver emergency stop failed: %s", str(se))
+      if self.error is None:
+        self.error = str(se)
+
+  def status(self):
+    """ Dictionary describing progress, suitable for JSON """
+    elapsed = None
+    if self.starttime is not None:
+      elapsed = monotonic() - self.starttime
+
+    return {
+      'running': self.running(),
+      'cancelled': self.cancelled,
+      'segment': self.current,
+      'segments': len(self.segments),
+      'elapsed': elapsed,
+      'duration': self.duration(),
+      'error': self.error,
+    }
@@ -22,14 +22,130 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 from subprocess import call
+import os
 import socket
+import threading
 from SGVHAK_Rover import app
 from flask import flash, json, redirect, render_template, request, url_for
+import busowner
+import chassisdaemon
+import devicehealth
 import roverchassis
-
-# Rover chassis geometry, including methods to calculate wheel angle and
-# velocity based on chassis geometry.
-chassis = roverchassis.chassis()
+import controlloop
+import scheduler
+from rovertime import monotonic
+
+# Socket of the chassis daemon (chassisdaemon.py) that owns the motor
+# controllers, if SGVHAK_CHASSIS_DAEMON is set. Otherwise this process
+# owns them itself.
+daemon_socket = os.environ.get('SGVHAK_CHASSIS_DAEMON')
+
+# Periodic jobs: the control tick sending drive commands, and telemetry
+# reading from motor controllers. All run cooperatively from the thread
+# serving web requests, see serve(), run_control() and run_telemetry().
+jobs = scheduler.scheduler()
+
+# Jobs of at least this priority run ahead of a web request, the rest only
+# once its response has been sent.
+control_priority = 10
+
+# Held while a web request runs due jobs, in case the web server runs
+# requests on several threads, so they don't run the same jobs at once.
+jobs_lock = threading.Lock()
+
+if daemon_socket:
+  # The daemon runs the control loop and jobs, all we do is ask it.
+  chassis = chassisdaemon.client(daemon_socket)
+  controller = chassis.controller
+else:
+  # Rover chassis geometry, including methods to calculate wheel angle and
+  # velocity based on chassis geometry.
+  chassis = roverchassis.chassis()
+
+  # Sends drive commands to chassis at a fixed rate, set in commands per
+  # second by SGVHAK_CONTROL_RATE environment variable. Only has a thread of
+  # its own if asked for, see controlloop.from_environment()
+  controller = controlloop.from_environment(chassis)
+
+  # Most seconds a drive command, or any other chassis operation, may take.
+  chassis.command_timeout = float(os.environ.get('SGVHAK_COMMAND_TIMEOUT', chassis.command_timeout))
+
+# Most recent readings taken by the telemetry jobs, and when they were taken.
+telemetry = dict()
+
+# Voltage readings younger than this many seconds are shown instead of
+# querying every controller again, so several people looking at the page
+# don't add up to a lot of bus traffic.
+voltage_max_age = 5.0
+
+def sample_voltages():
+  telemetry['voltages'] = (monotonic(), chassis.motor_voltages())
+
+def poll_steering():
+  telemetry['steering'] = (monotonic(), chassis.steering_positions())
+
+if not daemon_socket:
+  jobs.add('control', controller.tick, controller.period, priority=control_priority)
+  jobs.add('steering', poll_steering, 1.0, priority=1)
+  jobs.add('voltage', sample_voltages, 10.0)
+  jobs.add('probe', devicehealth.probe, devicehealth.probe_interval, priority=2)
+
+def run_due(minimum=None):
+  """
+  Run due jobs of at least 'minimum' priority, see scheduler.run_pending(),
+  unless another request is already running them.
+  """
+  if jobs_lock.acquire(False):
+    try:
+      jobs.run_pending(minimum)
+    finally:
+      jobs_lock.release()
+
+def diagnostics(kind):
+  """
+  Status of 'jobs', 'buses', 'devices', 'control' or 'controllers', from
+  the chassis daemon if there is one.
+  """
+  if daemon_socket:
+    return chassis.diagnostics(kind)
+  elif kind == 'jobs':
+    return jobs.status()
+  elif kind == 'buses':
+    return busowner.status()
+  elif kind == 'devices':
+    return devicehealth.status()
+  elif kind == 'controllers':
+    return chassis.controller_statistics()
+  return controller.status()
+
+@app.before_request
+def run_control():
+  """
+  When served by 'flask run' there is no idle time in which to run jobs, so
+  run them as requests come in. A due control tick runs ahead of the
+  request, but not ahead of a stop, which must not wait.
+  """
+  if daemon_socket or not chassis.wheels or request.endpoint == 'stop_motors':
+    return
+  run_due(control_priority)
+
+@app.after_request
+def run_telemetry(response):
+  """
+  Telemetry jobs talk to motor controllers, which can take a while, so
+  they run once the response has been sent instead of holding it up.
+  """
+  if not daemon_socket and chassis.wheels:
+    response.call_on_close(run_due)
+  return response
+
+def serve(host='0.0.0.0', port=5000):
+  """
+  Serve the rover UI, running jobs on time in between web requests instead
+  of only as requests come in. See scheduler.serve()
+  """
+  chassis.ensureready()
+  jobs.serve(app, host, port)
 
 class main_menu:
 
@@ -48,9 +164,11 @@ class main_menu:
     Stop motors immediately
     """
     chassis.ensureready()
-    for wheel in chassis.wheels.values():
-      wheel.poweroff()
-    flash("Motors Stopped","success")
+    try:
+      elapsed = controller.emergency_stop()
+      flash("Motors Stopped in {:.1f} ms".format(elapsed*1000),"success")
+    except ValueError as ve:
+      flash("Error stopping motors: {}".format(str(ve)),"error")
     return render_template("index.html")
 
   @app.route('/drive')
@@ -83,25 +201,85 @@ class main_menu:
       return render_template("drive_command.html",
         page_title = 'Velocity & Angle Commands')
     else:
-      # TODO: Limit the frequency of updates to one every 50ms. If more
-      # than one update arrive within the window, use the final one. This
-      # reduces workload on RoboClaw serial network and the mechanical bits
-      # can't respond super fast anyway.
-      # EXCEPTION: If a stop command arrives, stop immediately.
+      # Control loop sends the final command in each window (stop
+      # immediately) so we don't wait on motor controllers here.
       pct_angle = float(request.form['pct_angle'])
       magnitude = float(request.form['magnitude'])
 
-      if pct_angle == 0:
-        radius = float("inf")
-      elif pct_angle>0:
-        radius = chassis.minRadius + (chassis.maxRadius-chassis.minRadius) * (100-pct_angle)/100.0
-      else:
-        radius = -chassis.minRadius - (chassis.maxRadius-chassis.minRadius) * (100+pct_angle)/100.0
-
-      chassis.move_velocity_radius(magnitude, radius)
+      try:
+        controller.publish(magnitude, pct_angle)
+      except ValueError as ve:
+        return json.jsonify({'Success':0, 'error':str(ve)}), 400
 
       return json.jsonify({'Success':1})
 
+  @app.route('/maneuver', methods=['GET','POST'])
+  def maneuver():
+    """
+    POST a JSON object with a list of [velocity, radius, duration] segments
+    under 'segments' to have the rover execute them in sequence without
+    further network traffic. Radius of null means straight line. GET returns
+    progress of the most recent maneuver. Use /stop_motors to cancel.
+    """
+    chassis.ensureready()
+
+    if request.method == 'POST':
+      body = request.get_json(force=True, silent=True)
+      if not isinstance(body, dict) or 'segments' not in body:
+        return json.jsonify({'Success':0, 'error':"Expected a JSON object with a list of 'segments'"}), 400
+      try:
+        chassis.run_maneuver(body['segments'])
+      except ValueError as ve:
+        return json.jsonify({'Success':0, 'error':str(ve)}), 400
+
+    if chassis.maneuver:
+      status = chassis.maneuver.status()
+    else:
+      status = {'running': False}
+    status['Success'] = 1
+    return json.jsonify(status)
+
+  @app.route('/scheduler_status')
+  def scheduler_status():
+    """
+    Runtime and lateness statistics of every periodic job, to tell whether
+    the Pi keeps up with the jobs as scheduled.
+    """
+    return json.jsonify({'Success':1, 'jobs':diagnostics('jobs')})
+
+  @app.route('/control_status')
+  def control_status():
+    """
+    Drive command counters and a histogram of how late each one went out,
+    along with real time settings of the control loop thread if enabled.
+    """
+    return json.jsonify({'Success':1, 'control':diagnostics('control')})
+
+  @app.route('/bus_status')
+  def bus_status():
+    """
+    How long commands in each priority lane waited for their bus, to check
+    stops and drive commands aren't held up by telemetry.
+    """
+    return json.jsonify({'Success':1, 'buses':diagnostics('buses')})
+
+  @app.route('/device_health')
+  def device_health():
+    """
+    Success rate, round trip time, and whether each motor controller device
+    is responding. Ones that aren't are skipped until a probe gets through.
+    """
+    return json.jsonify({'Success':1, 'devices':diagnostics('devices')})
+
+  @app.route('/controller_status')
+  def controller_status():
+    """
+    Retries, timeouts and CRC errors counted by each motor controller that
+    keeps track, and the round trip times its reply timeouts adapt to.
+    """
+    chassis.ensureready()
+    return json.jsonify({'Success':1, 'controllers':diagnostics('controllers')})
+
   @app.route('/chassis_config')
   def chassis_config():
     """
@@ -186,12 +364,7 @@ class main_menu:
     chassis_config.html.
     """
     chassis.ensureready()
-    wheelInfo = dict()
-    for name, wheel in chassis.wheels.iteritems():
-      wheelInfo[name] = dict()
-      wheelInfo[name]['velocity'] = wheel.velocity
-      wheelInfo[name]['angle'] = wheel.angle
-    return json.jsonify(wheelInfo)
+    return json.jsonify(chassis.wheel_status())
 
   @app.route('/steering_trim', methods=['GET','POST'])
   def steering_trim():
@@ -266,10 +439,11 @@ class main_menu:
     display this information for the user.
     """
     chassis.ensureready()
-    voltages = dict()
-
-    for name,wheel in chassis.wheels.iteritems():
-      voltages[name] = wheel.motor_voltage()
+    sampled = telemetry.get('voltages')
+    if sampled is None or monotonic() - sampled[0] > voltage_max_age:
+      sample_voltages()
+      sampled = telemetry['voltages']
+    voltages = sampled[1]
 
     return render_template("input_voltage.html",
       voltages = voltages,
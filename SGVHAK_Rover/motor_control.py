@@ -0,0 +1,238 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+class motor_control:
+  """
+  Interface between roverchassis and a family of motor controllers. Every
+  motor controller wrapper derives from this class. Methods that raise
+  NotImplementedError here must be implemented by each wrapper. The 'id'
+  parameter identifies a single motor in whatever form that wrapper expects,
+  as given in config_roverchassis.json.
+
+  Beyond commanding one motor at a time, a controller may be able to do
+  better. Each optional capability is advertised by a flag below, and
+  roverchassis uses the fastest path a controller advertises:
+
+  * supports_velocity_many / supports_angle_many: send_velocity_many() and
+    send_angle_many() command several motors with fewer bus transactions
+    than one command per motor.
+  * supports_synchronized_start: all motors commanded in one
+    send_angle_many() call start moving at the same time.
+  * supports_no_ack: send_velocity_many() and send_angle_many() can skip
+    waiting for acknowledgement when given wait_ack=False. Faster, but
+    errors go unnoticed.
+  * supports_input_voltage_many: input_voltage_many() is faster than
+    calling input_voltage() for each motor.
+
+  Without the capability, the default implementation here does the same
+  work one motor at a time, so callers may use these methods regardless.
+  """
+  supports_velocity_many = False
+  supports_angle_many = False
+  supports_synchronized_start = False
+  supports_no_ack = False
+  supports_input_voltage_many = False
+
+  # Name of the physical bus this controller talks over. Controllers on
+  # different buses can be commanded at the same time, see
+  # roverchassis.chassis.run_on_buses()
+  bus = None
+
+  # Changes smaller than these (in units sent to the device) are not worth
+  # sending.
+  velocity_deadband = 0
+  angle_deadband = 0
+
+  # Bits per second of a serial bus, None for other buses. Along with the
+  # 'wire_bytes' (command plus response) of each handle and seconds a
+  # device takes to turn around and respond, estimates how busy the bus is.
+  baudrate = None
+  turnaround = 0
+
+  def connect(self, instance=None):
+    """
+    Read configuration file and connect to motor controller. If given one of
+    the "instances" listed in configuration file, connect to that instead.
+    See configuration.load()
+    """
+    raise NotImplementedError()
+
+  def version(self, id):
+    """ Identifier string for this motor controller """
+    raise NotImplementedError()
+
+  def device(self, id):
+    """
+    Name of the device on the bus that controls the given motor. Motors
+    sharing a device (for example both motors of a RoboClaw) share its
+    health tracking, see devicehealth.py
+    """
+    return str(id)
+
+  def probe(self, id):
+    """
+    Exchange a harmless message with the device of the given motor, raising
+    ValueError if it doesn't answer. By default reads input voltage.
+    """
+    self.input_voltage(id)
+
+  def serial_port(self):
+    """
+    The open pyserial port this controller talks over, or None if it isn't
+    on a serial port. If there is one, handles from velocity_handle() and
+    angle_handle() must also have command(value) returning (packet,
+    response length, response check) so asyncbus can send it.
+    """
+    return None
+
+  def power_percent(self, id, percentage):
+    """ Run motor at +/- percentage of power, zero cuts power. """
+    raise NotImplementedError()
+
+  def emergency_stop(self, ids):
+    """
+    Cut power to the given motors as quickly as possible, using the cheapest
+    stop the protocol offers and not waiting for acknowledgement where
+    possible. May also stop other motors on the same bus. By default calls
+    power_percent(id, 0) for each motor, continuing past any errors.
+    """
+    errors = list()
+    for id in ids:
+      try:
+        self.power_percent(id, 0)
+      except ValueError as ve:
+        errors.append(str(ve))
+
+    if errors:
+      raise ValueError("; ".join(errors))
+
+  def set_max_current(self, id, current):
+    """ Limit motor current. Does nothing unless controller supports it. """
+    pass
+
+  def init_velocity(self, id):
+    """ Prepare motor for velocity() commands """
+    raise NotImplementedError()
+
+  def velocity_handle(self, id):
+    """
+    Returns an object with setpoint(pct_velocity) to translate percentage
+    into the value sent to controller, send(value) to send it, and deadband.
+    """
+    raise NotImplementedError()
+
+  def velocity(self, id, pct_velocity):
+    """ Run motor at +/- percentage of maximum velocity """
+    handle = self.velocity_handle(id)
+    handle.send(handle.setpoint(pct_velocity))
+
+  def velocity_many(self, commands):
+    """ Given a list of (id, pct_velocity) tuples, run each motor """
+    handles = [(self.velocity_handle(id), pct) for id, pct in commands]
+    self.send_velocity_many([(handle, handle.setpoint(pct)) for handle, pct in handles])
+
+  def send_velocity_many(self, commands, wait_ack=True):
+    """
+    Given a list of (velocity_handle, value) tuples, send each value. See
+    supports_velocity_many and supports_no_ack.
+    """
+    for handle, value in commands:
+      handle.send(value)
+
+  def init_angle(self, id):
+    """ Prepare motor for angle() commands """
+    raise NotImplementedError()
+
+  def maxangle(self, id):
+    """ Maximum steering angle in degrees off center """
+    raise NotImplementedError()
+
+  def angle_handle(self, id):
+    """
+    Returns an object with setpoint(angle) to translate angle into the value
+    sent to controller, send(value) to send it, and deadband.
+    """
+    raise NotImplementedError()
+
+  def angle(self, id, angle):
+    """ Move to angle in degrees off center """
+    handle = self.angle_handle(id)
+    handle.send(handle.setpoint(angle))
+
+  def angle_many(self, commands):
+    """ Given a list of (id, angle) tuples, move each motor """
+    handles = [(self.angle_handle(id), angle) for id, angle in commands]
+    self.send_angle_many([(handle, handle.setpoint(angle)) for handle, angle in handles])
+
+  def send_angle_many(self, commands, wait_ack=True):
+    """
+    Given a list of (angle_handle, value) tuples, send each value. See
+    supports_angle_many, supports_synchronized_start, and supports_no_ack.
+    """
+    for handle, value in commands:
+      handle.send(value)
+
+  def steering_position(self, id):
+    """ Current angle in degrees off center, raise ValueError if unknown """
+    raise ValueError("{} can not report steering position".format(self.__class__.__name__))
+
+  def steering_position_command(self, id):
+    """
+    For asyncbus, a (packet, response length, parse) tuple reading the
+    steering position of the given motor, where parse(response) returns
+    what steering_position() would or raises ValueError. None if the
+    controller has no such command, then steering_position() is used. Must
+    not touch the bus, see busowner.direct_methods
+    """
+    return None
+
+  def steering_time(self, id, degrees):
+    """ Estimated number of seconds to steer through given degrees """
+    raise NotImplementedError()
+
+  def steer_setzero(self, id):
+    """ Mark current position as center """
+    raise NotImplementedError()
+
+  def input_voltage(self, id):
+    """ Input voltage available to drive specified motor """
+    raise NotImplementedError()
+
+  def input_voltage_command(self, id):
+    """
+    For asyncbus, a (packet, response length, parse) tuple reading input
+    voltage, see steering_position_command()
+    """
+    return None
+
+  def input_voltage_many(self, ids):
+    """ List of input_voltage() for each id in the given list """
+    return [self.input_voltage(id) for id in ids]
+
+  def statistics(self):
+    """
+    Dictionary of protocol level counters such as retries and CRC errors,
+    suitable for JSON. None if this controller doesn't keep any.
+    """
+    return None
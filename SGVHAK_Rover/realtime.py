@@ -0,0 +1,241 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import threading
+
+from rovertime import monotonic
+
+# Constants from <sched.h> and <sys/mman.h> on Linux
+SCHED_FIFO = 1
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# Priority for SCHED_FIFO, 1 (lowest) to 99 (highest). Above most kernel
+# threads' default of 50 would starve them, so stay at it.
+default_priority = 50
+
+# Every this many ticks, collect all generations instead of just the
+# youngest one. At 20 ticks per second that is every 10 seconds.
+default_full_collect_ticks = 200
+
+# Upper bounds, in seconds, of histogram buckets for garbage collection
+# times. Anything longer than the final bound goes into an overflow bucket.
+gc_buckets = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+# Upper bounds for loop period jitter, how far each period was off. Early
+# periods are negative, late ones positive.
+period_buckets = (-0.01, -0.005, -0.002, -0.001, -0.0005, -0.0002, -0.0001,
+  0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+def _libc():
+  """ The C library, for calls Python's os module doesn't have """
+  return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def _oserror(call):
+  errno = ctypes.get_errno()
+  return OSError(errno, "{} failed: {}".format(call, os.strerror(errno)))
+
+def set_fifo(priority):
+  """
+  Switch the calling thread to SCHED_FIFO real time scheduling at the
+  given priority. Raises OSError if not permitted (needs root or
+  CAP_SYS_NICE) or not supported.
+  """
+  if hasattr(os, 'sched_setscheduler'):
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    return
+
+  class sched_param(ctypes.Structure):
+    _fields_ = [('sched_priority', ctypes.c_int)]
+
+  if _libc().sched_setscheduler(0, SCHED_FIFO, ctypes.byref(sched_param(priority))) != 0:
+    raise _oserror("sched_setscheduler")
+
+def set_affinity(cpu):
+  """
+  Restrict the calling thread to run only on the given CPU core. Raises
+  OSError if that core doesn't exist or isn't allowed.
+  """
+  if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, [cpu])
+    return
+
+  # cpu_set_t is a bit mask of 1024 CPUs packed into unsigned longs.
+  bits = ctypes.sizeof(ctypes.c_ulong) * 8
+  mask = (ctypes.c_ulong * (1024 // bits))()
+  mask[cpu // bits] = 1 << (cpu % bits)
+  if _libc().sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+    raise _oserror("sched_setaffinity")
+
+def lock_memory():
+  """
+  Lock every page of the process, current and future, into RAM so the
+  control path never waits on a page fault. Raises OSError if not
+  permitted (needs root, CAP_IPC_LOCK, or a large enough memlock limit).
+  """
+  if _libc().mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+    raise _oserror("mlockall")
+
+class histogram(object):
+  """
+  Counts of samples, in seconds, falling into each of 'buckets' upper
+  bounds plus one overflow bucket. Also keeps count, mean, minimum and
+  maximum.
+  """
+  def __init__(self, buckets=gc_buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, sample):
+    index = 0
+    while index < len(self.buckets) and sample > self.buckets[index]:
+      index = index + 1
+    self.counts[index] = self.counts[index] + 1
+    self.total = self.total + sample
+    if self.max is None:
+      self.min = self.max = sample
+    self.min = min(self.min, sample)
+    self.max = max(self.max, sample)
+
+  def status(self):
+    """ Dictionary of statistics, suitable for JSON """
+    count = sum(self.counts)
+    labels = ["<={}ms".format(bound * 1000) for bound in self.buckets]
+    labels.append(">{}ms".format(self.buckets[-1] * 1000))
+    return {
+      'count': count,
+      'mean': self.total / max(count, 1),
+      'min': self.min,
+      'max': self.max,
+      'buckets': [[label, n] for label, n in zip(labels, self.counts)],
+    }
+
+class realtime(object):
+  """
+  Real time execution settings for a control thread: SCHED_FIFO priority,
+  pinned to a CPU core, memory locked, and garbage collection moved from
+  whenever Python feels like it to right after each tick, where it is
+  timed. Each setting that can't be applied (usually for lack of
+  privileges) is logged as a warning and skipped, so the rover still runs
+  on an ordinary Linux box, just without real time guarantees.
+
+  Call enter() from the thread to run in real time, then after_tick() once
+  every tick, including ticks with nothing to send: garbage collection is
+  disabled for the whole process, so the loop must keep collecting while
+  idle or garbage from web server threads would pile up, locked into RAM.
+  Threads the real time thread waits on call follow() to run at the same
+  priority, otherwise they would be preempted by anything else runnable
+  and hold it up. 'cpu' None leaves the thread free to run on any core.
+  """
+  def __init__(self, priority=default_priority, cpu=None, lock=True,
+    full_collect_ticks=default_full_collect_ticks):
+    if not 1 <= priority <= 99:
+      raise ValueError("Real time priority {} must be from 1 to 99".format(priority))
+    if full_collect_ticks < 1:
+      raise ValueError("Full collection interval {} must be at least one tick".format(full_collect_ticks))
+
+    self.priority = priority
+    self.cpu = cpu
+    self.lock = lock
+    self.full_collect_ticks = full_collect_ticks
+
+    # Setting name to True if applied, or the error message if not.
+    self.applied = dict()
+
+    self.ticks = 0
+    self.gc_time = histogram()
+
+  def apply(self, name, function, *args):
+    try:
+      function(*args)
+      self.applied[name] = True
+    except (OSError, AttributeError) as e:
+      self.applied[name] = str(e)
+      logging.getLogger(__name__).warning("Real time %s not available: %s", name, e)
+
+  def enter(self):
+    """ Apply settings to the calling thread """
+    self.apply('scheduler', set_fifo, self.priority)
+    if self.cpu is not None:
+      self.apply('affinity', set_affinity, self.cpu)
+    if self.lock:
+      self.apply('memory lock', lock_memory)
+
+    # Process wide, so web server threads' garbage is also collected here.
+    gc.collect()
+    gc.disable()
+    self.applied['gc'] = True
+
+  def follow(self):
+    """
+    Apply scheduling settings to the calling thread, one the thread that
+    called enter() waits on. Memory lock and garbage collection are process
+    wide and already taken care of by enter().
+    """
+    name = threading.current_thread().name
+    self.apply('scheduler ({})'.format(name), set_fifo, self.priority)
+    if self.cpu is not None:
+      self.apply('affinity ({})'.format(name), set_affinity, self.cpu)
+
+  def after_tick(self):
+    """
+    Collect garbage now that the tick is done: the youngest generation
+    every time, which is quick, and all of them every full_collect_ticks.
+    """
+    self.ticks = self.ticks + 1
+    start = monotonic()
+    if self.ticks % self.full_collect_ticks == 0:
+      gc.collect()
+    else:
+      gc.collect(0)
+    self.gc_time.add(monotonic() - start)
+
+  def status(self):
+    """ Dictionary of settings and garbage collection times, suitable for JSON """
+    return {
+      'priority': self.priority,
+      'cpu': self.cpu,
+      'applied': self.applied,
+      'gc_time': self.gc_time.status(),
+    }
+
+def from_environment():
+  """
+  Real time settings from environment variables, None unless
+  SGVHAK_REALTIME is set to 1. SGVHAK_REALTIME_PRIORITY and
+  SGVHAK_REALTIME_CPU optionally set priority and core to pin to.
+  """
+  if os.environ.get('SGVHAK_REALTIME') != '1':
+    return None
+  cpu = os.environ.get('SGVHAK_REALTIME_CPU')
+  if cpu is not None:
+    cpu = int(cpu)
+  return realtime(int(os.environ.get('SGVHAK_REALTIME_PRIORITY', default_priority)), cpu)
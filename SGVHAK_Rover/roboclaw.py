@@ -9,15 +9,94 @@ import serial
 import struct
 import time
 
+from rovertime import monotonic
+
+def _crc_table():
+	"""CRC16 (polynomial 0x1021) of every byte value, so each byte takes one lookup instead of 8 shifts"""
+	table = []
+	for byte in range(0, 256):
+		crc = byte << 8
+		for bit in range(0, 8):
+			if (crc&0x8000) == 0x8000:
+				crc = ((crc << 1) ^ 0x1021)
+			else:
+				crc = crc << 1
+		table.append(crc & 0xFFFF)
+	return table
+
+CRC_TABLE = _crc_table()
+
+def crc16(data, crc=0):
+	"""CRC16 of a whole packet, table driven"""
+	for byte in bytearray(data):
+		crc = ((crc << 8) & 0xFFFF) ^ CRC_TABLE[(crc >> 8) ^ byte]
+	return crc
+
+#Masks to send signed values as the unsigned field of the same size
+_MASKS = {'B': 0xFF, 'H': 0xFFFF, 'I': 0xFFFFFFFF}
+
+#Replies of known length: values followed by CRC, read and decoded at once by _readfixed()
+_REPLY1 = struct.Struct('>BH')
+_REPLY2 = struct.Struct('>HH')
+_REPLY4 = struct.Struct('>IH')
+_REPLY4_1 = struct.Struct('>iBH')
+_REPLY111 = struct.Struct('>BBBH')
+_REPLY_N = {}
+
+#Longest ReadVersion string, including its terminating zero
+_VERSION_LENGTH = 48
+
+#Round trip times kept per address, and how many are needed before reply timeouts adapt to them
+_RTT_SAMPLES = 128
+_RTT_MIN_SAMPLES = 16
+
+def packet(address, cmd, format, *values):
+	"""Command packet with CRC, the bytes a _write method sends without waiting for the reply"""
+	data = struct.pack('>BB' + format, address, cmd, *values)
+	return data + struct.pack('>H', crc16(data))
+
+def read_packet(address, cmd, format):
+	"""Command packet of a read, and length of its reply: values packed as format followed by CRC"""
+	return bytearray((address, cmd)), struct.calcsize('>' + format + 'H')
+
+def reply_values(address, cmd, format, data):
+	"""Values of a reply to a read already received, such as by asyncbus. None if its length or CRC is wrong"""
+	reply = struct.Struct('>' + format + 'H')
+	data = bytearray(data)
+	if len(data) != reply.size:
+		return None
+	values = reply.unpack(bytes(data))
+	if crc16(data[:-2], crc16(bytearray((address, cmd)))) != values[-1]:
+		return None
+	return values[:-1]
+
 class Roboclaw:
 	'Roboclaw Interface Class'
 	
-	def __init__(self, comport, rate, timeout=0.01, retries=3):
+	def __init__(self, comport, rate, timeout=0.01, retries=3, max_timeout=1.0):
 		self.comport = comport
 		self.rate = rate
 		self.timeout = timeout;
 		self._trystimeout = retries
+		#Reply timeout of an address is timeout_multiple times the 99th percentile of its measured
+		#round trip times, between min_timeout and max_timeout. max_timeout until enough are measured.
+		self.max_timeout = max_timeout
+		self.min_timeout = 0.005
+		self.timeout_multiple = 3.0
+		#Wait before the first retry for a late reply, doubled before each further retry
+		self.backoff = 0.002
+		self._rtts = {}
+		self._rttcount = {}
+		self._timeouts = {}
+		#Set when a reply went wrong, so bytes still to arrive for it must be discarded before the next command
+		self._stale = False
+		self.counters = {'commands': 0, 'retries': 0, 'timeouts': 0, 'crc_errors': 0, 'resyncs': 0, 'discarded': 0}
 		self._crc = 0;
+		self._unacked = 0;
+		#Preallocated packet buffer and compiled struct for each _write format
+		self._packets = {}
+		#Optional function called before every command, raises ValueError to abandon it
+		self.before_command = None
 
 	#Command Enums
 	class Cmd():
@@ -113,536 +192,318 @@ class Roboclaw:
 		FLAGBOOTLOADER = 255
 			
 	#Private Functions
-	def crc_clear(self):
-		self._crc = 0
-		return
-		
-	def crc_update(self,data):
-		self._crc = self._crc ^ (data << 8)
-		for bit in range(0, 8):
-			if (self._crc&0x8000)  == 0x8000:
-				self._crc = ((self._crc << 1) ^ 0x1021)
+	def _beforesend(self,addresses,extra=0):
+		#Reply timeout for the slowest of the addresses, plus 'extra' seconds such as time to send several packets
+		timeout = round(max([self._timeouts.get(address, self.max_timeout) for address in addresses]) + extra, 3)
+		if self._port.timeout != timeout:
+			self._port.timeout = timeout
+		if self.before_command:
+			self.before_command()
+		self.counters['commands'] += 1
+		if self._unacked or self._stale:
+			#Discard acknowledgements of commands sent without waiting for them, and the rest of
+			#any reply that went wrong, so they aren't taken as the reply to this command
+			waiting = self._port.in_waiting
+			if waiting:
+				self.counters['discarded'] += len(self._port.read(waiting))
+			self._unacked = 0
+			self._stale = False
+
+	def _measured(self,address,rtt):
+		#Record a round trip time, and every _RTT_MIN_SAMPLES of them adapt the reply timeout of the address.
+		#Time on the wire is already taken off, which can leave less than nothing over USB, faster than 'rate'.
+		samples = self._rtts.setdefault(address, [])
+		samples.append(max(rtt, 0.0))
+		if len(samples) > _RTT_SAMPLES:
+			del samples[0]
+		count = self._rttcount.get(address, 0) + 1
+		self._rttcount[address] = count
+		if count % _RTT_MIN_SAMPLES == 0:
+			self._timeouts[address] = min(self.max_timeout, max(self.min_timeout, self._percentile(samples, 0.99) * self.timeout_multiple))
+
+	@staticmethod
+	def _percentile(samples,fraction):
+		ordered = sorted(samples)
+		return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+	def _retrywait(self,attempt):
+		#Exponential backoff before retry number 'attempt', giving a late reply time to arrive
+		self.counters['retries'] += 1
+		time.sleep(min(self.backoff * (2 ** (attempt - 1)), self.max_timeout))
+
+	def _wiretime(self,count):
+		#Seconds to send 'count' bytes at 10 bits each, start and stop bits included
+		return count * 10.0 / self.rate
+
+	def _sendcommand(self,address,command,reply):
+		#Reply timeout allows for the 2 bytes sent and 'reply' bytes to come back, on top of the
+		#learned turnaround. Returns those seconds on the wire, to take off the measured round trip.
+		wire = self._wiretime(2 + reply)
+		self._beforesend((address,),wire)
+		self._crc = crc16(bytearray((address, command)))
+		self._port.write(bytes(bytearray((address, command))))
+		return wire
+
+	def _sendpacket(self,address,cmd,format,values):
+		#Whole packet, CRC included, assembled in one buffer and sent with a single write.
+		#Returns seconds on the wire for the packet and its acknowledgement, see _sendcommand().
+		data = self._packetbytes(address,cmd,format,values)
+		wire = self._wiretime(len(data) + 1)
+		self._beforesend((address,),wire)
+		self._crc = (data[-2]<<8) | data[-1]
+		self._port.write(bytes(data))
+		return wire
+
+	def _packetbytes(self,address,cmd,format,values):
+		#Packet with CRC in the preallocated buffer for its format, valid until the next call with the same format
+		compiled = self._packets.get(format)
+		if compiled is None:
+			compiled = (struct.Struct('>BB' + format), bytearray(struct.calcsize('>BB' + format) + 2), [_MASKS[f] for f in format])
+			self._packets[format] = compiled
+		body, buffer, masks = compiled
+		body.pack_into(buffer, 0, address, cmd, *[value & mask for value, mask in zip(values, masks)])
+		crc = crc16(buffer[:-2])
+		buffer[-2] = crc >> 8
+		buffer[-1] = crc & 0xFF
+		return buffer
+
+	def _readfixed(self,address,cmd,reply):
+		#Send a read command and return the values of its known length reply, read with one sized read.
+		#Retries with backoff, first looking for a late reply to the previous try. None if all tries failed.
+		seed = crc16(bytearray((address, cmd)))
+		data = b''
+		for attempt in range(0, self._trystimeout):
+			if attempt:
+				self._retrywait(attempt)
+				data = data + self._port.read(self._port.in_waiting)
+				values = self._findframe(data,reply,seed)
+				if values:
+					self.counters['resyncs'] += 1
+					return values
+			start = monotonic()
+			wire = self._sendcommand(address,cmd,reply.size)
+			data = self._port.read(reply.size)
+			if len(data) == reply.size:
+				values = reply.unpack(data)
+				if crc16(bytearray(data)[:-2], seed) == values[-1]:
+					self._measured(address, monotonic() - start - wire)
+					return values
+				self.counters['crc_errors'] += 1
 			else:
-				self._crc = self._crc << 1
-		return
-
-	def _sendcommand(self,address,command):
-		self.crc_clear()
-		self.crc_update(address)
-		self._port.write(chr(address))
-		self.crc_update(command)
-		self._port.write(chr(command))
-		return
-
-	def _readchecksumword(self):
-		data = self._port.read(2)
-		if len(data)==2:
-			crc = (ord(data[0])<<8) | ord(data[1])
-			return (1,crc)	
-		return (0,0)
-		
-	def _readbyte(self):
-		data = self._port.read(1)
-		if len(data):
-			val = ord(data)
-			self.crc_update(val)
-			return (1,val)	
-		return (0,0)
-		
-	def _readword(self):
-		val1 = self._readbyte()
-		if val1[0]:
-			val2 = self._readbyte()
-			if val2[0]:
-				return (1,val1[1]<<8|val2[1])
-		return (0,0)
-
-	def _readlong(self):
-		val1 = self._readbyte()
-		if val1[0]:
-			val2 = self._readbyte()
-			if val2[0]:
-				val3 = self._readbyte()
-				if val3[0]:
-					val4 = self._readbyte()
-					if val4[0]:
-						return (1,val1[1]<<24|val2[1]<<16|val3[1]<<8|val4[1])
-		return (0,0)	
-
-	def _readslong(self):
-		val = self._readlong()
-		if val[0]:
-			if val[1]&0x80000000:
-				return (val[0],val[1]-0x100000000)
-			return (val[0],val[1])
-		return (0,0)
-
-	def _writebyte(self,val):
-		self.crc_update(val&0xFF)
-		self._port.write(chr(val&0xFF))
-
-	def _writesbyte(self,val):
-		self._writebyte(val)
-
-	def _writeword(self,val):
-		self._writebyte((val>>8)&0xFF)
-		self._writebyte(val&0xFF)
-		
-	def _writesword(self,val):
-		self._writeword(val)
-
-	def _writelong(self,val):
-		self._writebyte((val>>24)&0xFF)
-		self._writebyte((val>>16)&0xFF)
-		self._writebyte((val>>8)&0xFF)
-		self._writebyte(val&0xFF)
-
-	def _writeslong(self,val):
-		self._writelong(val)
+				self.counters['timeouts'] += 1
+			self._stale = True
+		return None
+
+	@staticmethod
+	def _findframe(data,reply,seed):
+		#Newest whole reply with a valid CRC anywhere in data, to resynchronize after stray or missing bytes
+		data = bytearray(data)
+		for offset in range(len(data) - reply.size, -1, -1):
+			frame = data[offset:offset + reply.size]
+			values = reply.unpack(bytes(frame))
+			if crc16(frame[:-2], seed) == values[-1]:
+				return values
+		return None
 
 	def _read1(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readbyte()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
-			trys-=1
-			if trys==0:
-				break
+		val = self._readfixed(address,cmd,_REPLY1)
+		if val:
+			return (1,val[0])
 		return (0,0)
 
 	def _read2(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readword()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
-			trys-=1
-			if trys==0:
-				break
+		val = self._readfixed(address,cmd,_REPLY2)
+		if val:
+			return (1,val[0])
 		return (0,0)
 
 	def _read4(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readlong()
-			if val1[0]:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF!=crc[1]&0xFFFF:
-						return (0,0)
-					return (1,val1[1])
-			trys-=1
-			if trys==0:
-				break
+		val = self._readfixed(address,cmd,_REPLY4)
+		if val:
+			return (1,val[0])
 		return (0,0)
 
 	def _read4_1(self,address,cmd):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,cmd)
-			val1 = self._readslong()
-			if val1[0]:
-				val2 = self._readbyte()
-				if val2[0]:
-					crc = self._readchecksumword()
-					if crc[0]:
-						if self._crc&0xFFFF!=crc[1]&0xFFFF:
-							return (0,0)
-						return (1,val1[1],val2[1])
-			trys-=1
-			if trys==0:
-				break
+		val = self._readfixed(address,cmd,_REPLY4_1)
+		if val:
+			return (1,val[0],val[1])
 		return (0,0)
 
 	def _read_n(self,address,cmd,args):
-		trys = self._trystimeout
-		while 1:
-			self._port.flushInput()
-			trys-=1
-			if trys==0:
-				break
-			failed=False
-			self._sendcommand(address,cmd)
-			data = [1,]
-			for i in range(0,args):
-				val = self._readlong()
-				if val[0]==0:
-					failed=True
-					break
-				data.append(val[1])
-			if failed:
-				continue
-			crc = self._readchecksumword()
-			if crc[0]:
-				if self._crc&0xFFFF==crc[1]&0xFFFF:
-					return (data);
+		reply = _REPLY_N.get(args)
+		if reply is None:
+			reply = _REPLY_N[args] = struct.Struct('>' + 'I'*args + 'H')
+		val = self._readfixed(address,cmd,reply)
+		if val:
+			return [1,] + list(val[:-1])
 		return (0,0,0,0,0)
 
-	def _writechecksum(self):
-		self._writeword(self._crc&0xFFFF)
-		val = self._readbyte()
-		if(len(val)>0):
-			if val[0]:
+	def _readack(self):
+		return len(self._port.read(1)) == 1
+
+	def _lateacks(self):
+		#Acknowledgements that arrived after the read for them gave up
+		return bytearray(self._port.read(self._port.in_waiting)).count(b'\xff')
+
+	def _write(self,address,cmd,format,*values):
+		#Send packet with fields of 'format' (struct codes B, H, I) until acknowledged, with
+		#backoff between tries. An acknowledgement of the previous try arriving late also counts.
+		for attempt in range(0, self._trystimeout):
+			if attempt:
+				self._retrywait(attempt)
+				if self._lateacks():
+					self.counters['resyncs'] += 1
+					return True
+			start = monotonic()
+			wire = self._sendpacket(address,cmd,format,values)
+			if self._readack():
+				self._measured(address, monotonic() - start - wire)
 				return True
+			self.counters['timeouts'] += 1
+			self._stale = True
 		return False
 
 	def _write0(self,address,cmd):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'')
 
 	def _write1(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writebyte(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'B',val)
 
 	def _write11(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writebyte(val1)
-			self._writebyte(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'BB',val1,val2)
 
 	def _write111(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writebyte(val1)
-			self._writebyte(val2)
-			self._writebyte(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'BBB',val1,val2,val3)
 
 	def _write2(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeword(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'H',val)
 
 	def _writeS2(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'H',val)
 
 	def _write22(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeword(val1)
-			self._writeword(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'HH',val1,val2)
 
 	def _writeS22(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writeword(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'HH',val1,val2)
 
 	def _writeS2S2(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writesword(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'HH',val1,val2)
 
 	def _writeS24(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writelong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'HI',val1,val2)
 
 	def _writeS24S24(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writesword(val1)
-			self._writelong(val2)
-			self._writesword(val3)
-			self._writelong(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'HIHI',val1,val2,val3,val4)
 
 	def _write4(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'I',val)
 
 	def _writeS4(self,address,cmd,val):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'I',val)
 
 	def _write44(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'II',val1,val2)
 
 	def _write4S4(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'II',val1,val2)
 
 	def _writeS4S4(self,address,cmd,val1,val2):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val1)
-			self._writeslong(val2)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'II',val1,val2)
 
 	def _write441(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writebyte(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIB',val1,val2,val3)
 
 	def _writeS441(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val1)
-			self._writelong(val2)
-			self._writebyte(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIB',val1,val2,val3)
 
 	def _write4S4S4(self,address,cmd,val1,val2,val3):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writeslong(val3)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'III',val1,val2,val3)
 
 	def _write4S441(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writebyte(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIB',val1,val2,val3,val4)
 
 	def _write4444(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIII',val1,val2,val3,val4)
 
 	def _write4S44S4(self,address,cmd,val1,val2,val3,val4):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writeslong(val4)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIII',val1,val2,val3,val4)
 
 	def _write44441(self,address,cmd,val1,val2,val3,val4,val5):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writebyte(val5)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIIB',val1,val2,val3,val4,val5)
 
 	def _writeS44S441(self,address,cmd,val1,val2,val3,val4,val5):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writeslong(val1)
-			self._writelong(val2)
-			self._writeslong(val3)
-			self._writelong(val4)
-			self._writebyte(val5)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIIB',val1,val2,val3,val4,val5)
 
 	def _write4S44S441(self,address,cmd,val1,val2,val3,val4,val5,val6):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writeslong(val4)
-			self._writelong(val5)
-			self._writebyte(val6)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIIIB',val1,val2,val3,val4,val5,val6)
 
 	def _write4S444S441(self,address,cmd,val1,val2,val3,val4,val5,val6,val7):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(self,address,cmd)
-			self._writelong(val1)
-			self._writeslong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writeslong(val5)
-			self._writelong(val6)
-			self._writebyte(val7)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIIIIB',val1,val2,val3,val4,val5,val6,val7)
 
 	def _write4444444(self,address,cmd,val1,val2,val3,val4,val5,val6,val7):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writelong(val5)
-			self._writelong(val6)
-			self._writelong(val7)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIIIII',val1,val2,val3,val4,val5,val6,val7)
 
 	def _write444444441(self,address,cmd,val1,val2,val3,val4,val5,val6,val7,val8,val9):
-		trys=self._trystimeout
-		while trys:
-			self._sendcommand(address,cmd)
-			self._writelong(val1)
-			self._writelong(val2)
-			self._writelong(val3)
-			self._writelong(val4)
-			self._writelong(val5)
-			self._writelong(val6)
-			self._writelong(val7)
-			self._writelong(val8)
-			self._writebyte(val9)
-			if self._writechecksum():
-				return True
-			trys=trys-1
-		return False
+		return self._write(address,cmd,'IIIIIIIIB',val1,val2,val3,val4,val5,val6,val7,val8,val9)
+
+	def _writepipelined(self,packets,trys):
+		block = bytearray()
+		for address, cmd, format, values in packets:
+			block += self._packetbytes(address,cmd,format,values)
+		addresses = set([address for address, cmd, format, values in packets])
+		#Bits on the wire for the whole block and its acknowledgements go on top of one turnaround
+		sending = self._wiretime(len(block) + len(packets))
+		start = monotonic()
+		self._beforesend(addresses,sending)
+		self._port.write(bytes(block))
+		acks = bytearray(self._port.read(len(packets))).count(b'\xff')
+		if acks == len(packets):
+			for address in addresses:
+				self._measured(address, monotonic() - start - sending)
+			return [True] * len(packets)
+		self.counters['timeouts'] += 1
+		self._retrywait(self._trystimeout - trys + 1)
+		if acks + self._lateacks() == len(packets):
+			self.counters['resyncs'] += 1
+			return [True] * len(packets)
+		self._stale = True
+		if len(packets) == 1:
+			if trys > 1:
+				return self._writepipelined(packets,trys-1)
+			return [False]
+		half = len(packets) // 2
+		return self._writepipelined(packets[:half],trys) + self._writepipelined(packets[half:],trys)
 
 	#User accessible functions
+	def WritePipelined(self,packets):
+		#Send a list of (address, cmd, format, values) write packets back to back, for any mix of
+		#addresses on this port, then read their acknowledgements together: one turnaround instead
+		#of one per packet. Format is struct codes B, H, I as for _write().
+		#Acknowledgements are bare 0xFF bytes that don't say which packet they are for, so when some
+		#are missing there is no telling which packets got through. Instead the packets are split in
+		#half and each half sent again, down to single packets retried on their own. That finds
+		#exactly which ones fail, but sends some that were already acknowledged a second time, so
+		#only commands that are safe to repeat are accepted, see _repeatable(). Raises ValueError
+		#for any other. Returns a list of True/False, whether each packet was acknowledged.
+		for address, cmd, format, values in packets:
+			if not self._repeatable(cmd,values):
+				raise ValueError("Command {} to address {} is not safe to repeat, can't be pipelined".format(cmd, address))
+		if not packets:
+			return []
+		return self._writepipelined(packets,self._trystimeout)
+
+	def _repeatable(self,cmd,values):
+		#Setpoints that replace the previous one, so receiving one twice does no harm. Position commands
+		#only with their buffer flag set to execute immediately, otherwise a second copy queues another move.
+		if cmd in (self.Cmd.M1DUTY, self.Cmd.M2DUTY, self.Cmd.MIXEDDUTY, self.Cmd.M1SPEED, self.Cmd.M2SPEED,
+			self.Cmd.MIXEDSPEED, self.Cmd.M1SPEEDACCEL, self.Cmd.M2SPEEDACCEL, self.Cmd.MIXEDSPEEDACCEL,
+			self.Cmd.MIXEDSPEED2ACCEL, self.Cmd.M1DUTYACCEL, self.Cmd.M2DUTYACCEL, self.Cmd.MIXEDDUTYACCEL):
+			return True
+		if cmd in (self.Cmd.M1SPEEDACCELDECCELPOS, self.Cmd.M2SPEEDACCELDECCELPOS, self.Cmd.MIXEDSPEEDACCELDECCELPOS):
+			return values[-1] == 1
+		return False
+
 	def SendRandomData(self,cnt):
 		for i in range(0,cnt):
 			byte = random.getrandbits(8)
@@ -707,35 +568,43 @@ class Roboclaw:
 		return self._write0(address,self.Cmd.RESETENC)
 
 	def ReadVersion(self,address):
-		trys=self._trystimeout
-		while 1:
-			self._port.flushInput()
-			self._sendcommand(address,self.Cmd.GETVERSION)
-			str = ""
-			passed = True
-			for i in range(0,48):
-				data = self._port.read(1)
-				if len(data):
-					val = ord(data)
-					self.crc_update(val)
-					if(val==0):
-						break
-					str+=data[0]
-				else:
-					passed = False
-					break
-			if passed:
-				crc = self._readchecksumword()
-				if crc[0]:
-					if self._crc&0xFFFF==crc[1]&0xFFFF:
-						return (1,str)
-					else:
-						time.sleep(0.01)
-			trys-=1
-			if trys==0:
-				break
+		for attempt in range(0, self._trystimeout):
+			if attempt:
+				self._retrywait(attempt)
+			start = monotonic()
+			self._sendcommand(address,self.Cmd.GETVERSION,_VERSION_LENGTH + 2)
+			data = self._readversion()
+			if data:
+				if crc16(data[:-2], self._crc)==(data[-2]<<8|data[-1]):
+					self._measured(address, monotonic() - start - self._wiretime(2 + len(data)))
+					return (1,bytes(data[:-2].rstrip(b'\0')))
+				self.counters['crc_errors'] += 1
+			else:
+				self.counters['timeouts'] += 1
+			self._stale = True
 		return (0,0)
 
+	def _readversion(self):
+		#Version string through its terminating zero, or 48 bytes without one, then CRC.
+		#Reads whatever has arrived at once instead of a byte at a time. None if it didn't all arrive.
+		data = bytearray()
+		end = -1
+		while end < 0 and len(data) < _VERSION_LENGTH:
+			chunk = self._port.read(max(1, min(self._port.in_waiting, _VERSION_LENGTH + 2 - len(data))))
+			if not chunk:
+				return None
+			data += bytearray(chunk)
+			end = data.find(b'\0', 0, _VERSION_LENGTH)
+		if end >= 0:
+			length = end + 1 + 2
+		else:
+			length = _VERSION_LENGTH + 2
+		if len(data) < length:
+			data += bytearray(self._port.read(length - len(data)))
+			if len(data) < length:
+				return None
+		return data[:length]
+
 	def SetEncM1(self,address,cnt):
 		return self._write4(address,self.Cmd.SETM1ENCCOUNT,cnt)
 
@@ -775,6 +644,12 @@ class Roboclaw:
 	def DutyM1M2(self,address,m1,m2):
 		return self._writeS2S2(address,self.Cmd.MIXEDDUTY,m1,m2)
 
+	def DutyM1M2NoAck(self,address,m1,m2):
+		#Send once without waiting for acknowledgement, for emergency stop.
+		self._sendpacket(address,self.Cmd.MIXEDDUTY,'HH',(m1,m2))
+		self._unacked = self._unacked + 1
+		return True
+
 	def SpeedM1(self,address,val):
 		return self._writeS4(address,self.Cmd.M1SPEED,val)
 
@@ -842,7 +717,7 @@ class Roboclaw:
 		return (0,0,0)
 
 	def SpeedAccelM1M2_2(self,address,accel1,speed1,accel2,speed2):
-		return self._write4S44S4(address,self.Cmd.MIXEDSPEED2ACCEL,accel,speed1,accel2,speed2)
+		return self._write4S44S4(address,self.Cmd.MIXEDSPEED2ACCEL,accel1,speed1,accel2,speed2)
 
 	def SpeedAccelDistanceM1M2_2(self,address,accel1,speed1,distance1,accel2,speed2,distance2,buffer):
 		return self._write4S444S441(address,self.Cmd.MIXEDSPEED2ACCELDIST,accel1,speed1,distance1,accel2,speed2,distance2,buffer)
@@ -939,23 +814,9 @@ class Roboclaw:
 		return self._write111(address,self.Cmd.SETPINFUNCTIONS,S3mode,S4mode,S5mode)
 
 	def ReadPinFunctions(self,address):
-		trys = self._trystimeout
-		while 1:
-			self._sendcommand(address,self.Cmd.GETPINFUNCTIONS)
-			val1 = self._readbyte()
-			if val1[0]:
-				val2 = self._readbyte()
-				if val1[0]:
-					val3 = self._readbyte()
-					if val1[0]:
-						crc = self._readchecksumword()
-						if crc[0]:
-							if self._crc&0xFFFF!=crc[1]&0xFFFF:
-								return (0,0)
-							return (1,val1[1],val2[1],val3[1])
-			trys-=1
-			if trys==0:
-				break
+		val = self._readfixed(address,self.Cmd.GETPINFUNCTIONS,_REPLY111)
+		if val:
+			return (1,val[0],val[1],val[2])
 		return (0,0)
 
 	def SetDeadBand(self,address,min,max):
@@ -1033,9 +894,23 @@ class Roboclaw:
 	def ReadPWMMode(self,address):
 		return self._read1(address,self.Cmd.GETPWMMODE)
 
+	def Statistics(self):
+		#Counters of commands, retries, timeouts, CRC errors, late replies recovered and stray bytes
+		#discarded, plus measured round trip times and current reply timeout of each address
+		addresses = {}
+		for address, samples in self._rtts.items():
+			addresses[address] = {
+				'rtt_p50': self._percentile(samples, 0.5),
+				'rtt_p99': self._percentile(samples, 0.99),
+				'timeout': self._timeouts.get(address, self.max_timeout),
+			}
+		statistics = dict(self.counters)
+		statistics['addresses'] = addresses
+		return statistics
+
 	def Open(self):
 		try:
-			self._port = serial.Serial(port=self.comport, baudrate=self.rate, timeout=1, interCharTimeout=self.timeout)
+			self._port = serial.Serial(port=self.comport, baudrate=self.rate, timeout=self.max_timeout, interCharTimeout=self.timeout)
 		except:
 			return 0
 		return 1
@@ -0,0 +1,175 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import struct
+import time
+
+import roboclaw
+from rovertime import monotonic
+
+# Getters timed by default, one for each reply shape: byte, word, long
+# plus status byte, several longs, and terminated string.
+getters = [
+  ('ReadPWMMode', ()),
+  ('ReadMainBatteryVoltage', ()),
+  ('ReadEncM1', ()),
+  ('ReadM1VelocityPID', ()),
+  ('ReadVersion', ()),
+]
+
+# Reply of simulated_port to the command of each getter, before its CRC.
+simulated_replies = {
+  roboclaw.Roboclaw.Cmd.GETPWMMODE: struct.pack('>B', 1),
+  roboclaw.Roboclaw.Cmd.GETMBATT: struct.pack('>H', 120),
+  roboclaw.Roboclaw.Cmd.GETM1ENC: struct.pack('>iB', -1234, 2),
+  roboclaw.Roboclaw.Cmd.READM1PID: struct.pack('>IIII', 65536, 32768, 0, 4000),
+  roboclaw.Roboclaw.Cmd.GETVERSION: b'USB Roboclaw 2x7a v4.1.24\n\0',
+}
+
+class simulated_port(object):
+  """
+  Stands in for the serial port of a RoboClaw answering the getters above.
+  Every read() call takes 'latency' seconds however many bytes it returns,
+  like the system call, and over USB the bus poll, behind a real read.
+  """
+  def __init__(self, latency):
+    self.latency = latency
+    self.timeout = None
+    self.pending = bytearray()
+    self.reads = 0
+
+  @property
+  def in_waiting(self):
+    return len(self.pending)
+
+  def write(self, data):
+    data = bytearray(data)
+    reply = bytearray(simulated_replies[data[1]])
+    crc = roboclaw.crc16(reply, roboclaw.crc16(data[:2]))
+    self.pending += reply + bytearray((crc >> 8, crc & 0xFF))
+    return len(data)
+
+  def read(self, size=1):
+    self.reads = self.reads + 1
+    time.sleep(self.latency)
+    data = bytes(self.pending[:size])
+    del self.pending[:size]
+    return data
+
+class bytewise_roboclaw(roboclaw.Roboclaw):
+  """
+  RoboClaw API with the response path it had before replies were read a
+  frame at a time: one read() call per byte of every value, then one for
+  the CRC. Only here to compare against, see compare().
+  """
+  def _readfixed(self, address, cmd, reply):
+    seed = roboclaw.crc16(bytearray((address, cmd)))
+    for attempt in range(0, self._trystimeout):
+      self._sendcommand(address, cmd, reply.size)
+      data = bytearray()
+      while len(data) < reply.size - 2:
+        byte = self._port.read(1)
+        if not byte:
+          break
+        data += bytearray(byte)
+      data += bytearray(self._port.read(2))
+      if len(data) == reply.size:
+        values = reply.unpack(bytes(data))
+        if roboclaw.crc16(data[:-2], seed) == values[-1]:
+          return values
+    return None
+
+  def _readversion(self):
+    data = bytearray()
+    while len(data) < roboclaw._VERSION_LENGTH:
+      byte = self._port.read(1)
+      if not byte:
+        return None
+      data += bytearray(byte)
+      if byte == b'\0':
+        break
+    data += bytearray(self._port.read(2))
+    return data
+def benchmark(rc, address, count=100, names=None):
+  """
+  Call each getter 'count' times on an opened roboclaw.Roboclaw and
+  return a list of (name, mean, min, max) round trip seconds, and number
+  of failed calls.
+  """
+  results = list()
+  for name, args in getters:
+    if names and name not in names:
+      continue
+    method = getattr(rc, name)
+    times = list()
+    failures = 0
+    for i in range(count):
+      start = monotonic()
+      if not method(address, *args)[0]:
+        failures = failures + 1
+      times.append(monotonic() - start)
+    results.append((name, sum(times) / len(times), min(times), max(times), failures))
+  return results
+
+def compare(new, old, address, count=100, names=None):
+  """
+  Run benchmark() on 'new', a roboclaw.Roboclaw, then on 'old', a
+  bytewise_roboclaw on the same kind of port. Returns a list of (name, old
+  results, new results) for each getter, results as from benchmark().
+  """
+  before = dict((result[0], result) for result in benchmark(old, address, count, names))
+  return [(result[0], before[result[0]], result) for result in benchmark(new, address, count, names)]
+
+if __name__ == "__main__":
+  """
+  Command line utility printing round trip time of each getter with the
+  byte at a time and the frame at once response paths side by side, and
+  how much the latter saves. Against a RoboClaw on real hardware, or with
+  --simulate against simulated_port with the given milliseconds per read.
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(description="RoboClaw Getter Round Trip Benchmark")
+
+  parser.add_argument("port", nargs="?", help="Serial port of RoboClaw, for example /dev/ttyACM0")
+  parser.add_argument("-b", "--baudrate", help="Serial baud rate, default is 115200.", type=int, default=115200)
+  parser.add_argument("-a", "--address", help="RoboClaw address 128-135, default is 128.", type=int, default=128)
+  parser.add_argument("-c", "--count", help="Number of calls to each getter, default is 100.", type=int, default=100)
+  parser.add_argument("-s", "--simulate", help="Milliseconds per read of a simulated port, instead of a real one.", type=float)
+  args = parser.parse_args()
+
+  rc = roboclaw.Roboclaw(args.port, args.baudrate)
+  old = bytewise_roboclaw(args.port, args.baudrate)
+  if args.simulate is not None:
+    rc._port = simulated_port(args.simulate / 1000.0)
+    old._port = simulated_port(args.simulate / 1000.0)
+  elif args.port is None:
+    parser.error("Either a serial port or --simulate is required")
+  elif not rc.Open():
+    raise ValueError("Unable to open {}".format(args.port))
+  else:
+    old._port = rc._port
+
+  for name, before, after in compare(rc, old, args.address, args.count):
+    print("{:24} byte at a time {:7.3f} ms  frame at once {:7.3f} ms  saved {:7.3f} ms  failed {}/{}".format(
+      name, before[1] * 1000, after[1] * 1000, (before[1] - after[1]) * 1000, before[4], after[4]))
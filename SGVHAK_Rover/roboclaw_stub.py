@@ -38,18 +38,33 @@ class Roboclaw_stub:
   def __init__(self):
     self.name = "TEST API"
 
+    # Remember encoder positions so steering appears to instantly reach the
+    # commanded position. Key is (address, motor number)
+    self.encoders = dict()
+
   def ForwardBackwardM1(self,address,val):
     return True
 
   def ForwardBackwardM2(self,address,val):
     return True
 
+  def DutyM1M2NoAck(self,address,m1,m2):
+    return True
+
   def SetEncM1(self,address,cnt):
+    self.encoders[(address,1)] = cnt
     return True
 
   def SetEncM2(self,address,cnt):
+    self.encoders[(address,2)] = cnt
     return True
 
+  def ReadEncM1(self,address):
+    return (1, self.encoders.get((address,1), 0), 0)
+
+  def ReadEncM2(self,address):
+    return (1, self.encoders.get((address,2), 0), 0)
+
   def ReadMainBatteryVoltage(self,address):
     return (True, 123)
 
@@ -65,6 +80,12 @@ class Roboclaw_stub:
   def SpeedAccelM2(self,address,accel,speed):
     return True
 
+  def SpeedAccelM1M2(self,address,accel,speed1,speed2):
+    return True
+
+  def SpeedAccelM1M2_2(self,address,accel1,speed1,accel2,speed2):
+    return True
+
   def SetM1PositionPID(self,address,kp,ki,kd,kimax,deadzone,min,max):
     return True
 
@@ -72,9 +93,26 @@ class Roboclaw_stub:
     return True
 
   def SpeedAccelDeccelPositionM1(self,address,accel,speed,deccel,position,buffer):
+    self.encoders[(address,1)] = position
     return True
 
   def SpeedAccelDeccelPositionM2(self,address,accel,speed,deccel,position,buffer):
+    self.encoders[(address,2)] = position
+    return True
+
+  def WritePipelined(self,packets):
+    for address, cmd, format, values in packets:
+      # SpeedAccelDeccelPositionM1 / M2 / M1M2
+      if cmd in (65, 66):
+        self.encoders[(address,cmd-64)] = values[3]
+      elif cmd == 67:
+        self.encoders[(address,1)] = values[3]
+        self.encoders[(address,2)] = values[7]
+    return [True] * len(packets)
+
+  def SpeedAccelDeccelPositionM1M2(self,address,accel1,speed1,deccel1,position1,accel2,speed2,deccel2,position2,buffer):
+    self.encoders[(address,1)] = position1
+    self.encoders[(address,2)] = position2
     return True
 
   def ReadVersion(self,address):
@@ -21,7 +21,12 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import math
+import busowner
 import configuration
+import motor_control
+import rovertime
+import roboclaw
 from roboclaw import Roboclaw
 from roboclaw_stub import Roboclaw_stub
 
@@ -55,27 +60,180 @@ def apiset(result, errormessage="RoboClaw API Setter"):
   if not result:
     raise ValueError(errormessage)
 
-class roboclaw_wrapper:
+def check_ack(response):
+  """ RoboClaw acknowledges a write command with a single 0xFF byte """
+  if len(response) == 0 or response[0] != 0xFF:
+    raise ValueError("RoboClaw did not acknowledge command")
+
+class velocity_handle(object):
+  """
+  Rolling velocity control of a single RoboClaw motor. Identifier is
+  validated and parameters are looked up once when the handle is created,
+  leaving only arithmetic and the API call for each command.
+
+  setpoint() translates percentage of maximum velocity to encoder counts per
+  second, which is passed to send(). command() returns the same command as
+  a packet for asyncbus, along with its acknowledgement length and check.
+  fields() returns it as (address, cmd, format, values) for
+  Roboclaw.WritePipelined(), and fields_m1m2() the combined command
+  setting this motor (M1) and the other motor on its address together.
+  """
+  __slots__ = ('address', 'motor', 'inverted', 'maxvelocity', 'acceleration', 'deadband',
+    'send_command', 'cmd')
+
+  # Command that sets both motors of an address at once.
+  combined_cmd = Roboclaw.Cmd.MIXEDSPEED2ACCEL
+
+  # Bytes on the wire for one send(): address, command, two longs, CRC and acknowledgement.
+  wire_bytes = 13
+
+  def __init__(self, wrapper, id):
+    self.address, self.motor, self.inverted = wrapper.check_id(id)
+    wrapper.check_roboclaw()
+
+    # Encoder counts per second at 100 percent.
+    self.maxvelocity = wrapper.velocityparams['maxVelocity']
+
+    self.acceleration = wrapper.velocityparams['acceleration']
+    self.deadband = wrapper.velocity_deadband
+
+    if self.motor==1:
+      self.send_command = wrapper.roboclaw.SpeedAccelM1
+      self.cmd = Roboclaw.Cmd.M1SPEEDACCEL
+    else:
+      self.send_command = wrapper.roboclaw.SpeedAccelM2
+      self.cmd = Roboclaw.Cmd.M2SPEEDACCEL
+
+  def setpoint(self, pct_velocity):
+    if abs(int(pct_velocity)) > 100:
+      raise ValueError("Velocity percentage {} exceeds maximum of 100".format(pct_velocity))
+
+    # Same order of operations as before handles existed: integer inputs
+    # divide (and round) the same way, so the same value goes out.
+    qpps = int(self.maxvelocity * pct_velocity / 100)
+    if self.inverted:
+      qpps = -qpps
+
+    return qpps
+
+  def send(self, qpps):
+    if not self.send_command(self.address, self.acceleration, qpps):
+      raise ValueError("Velocity {} acceleration {} on RoboClaw M{}@{}".format(
+        qpps, self.acceleration, self.motor, self.address))
+
+  def command(self, qpps):
+    return (roboclaw.packet(self.address, self.cmd, 'Ii', self.acceleration, qpps), 1, check_ack)
+
+  def fields(self, qpps):
+    return (self.address, self.cmd, 'II', (self.acceleration, qpps))
+
+  def fields_m1m2(self, qpps, m2, m2_qpps):
+    if self.acceleration == m2.acceleration:
+      return (self.address, Roboclaw.Cmd.MIXEDSPEEDACCEL, 'III', (self.acceleration, qpps, m2_qpps))
+    return (self.address, self.combined_cmd, 'IIII', (self.acceleration, qpps, m2.acceleration, m2_qpps))
+
+class angle_handle(object):
+  """
+  Steering angle control of a single RoboClaw motor, see velocity_handle.
+
+  setpoint() translates angle in degrees off zero center to encoder
+  position, which is passed to send().
+  """
+  __slots__ = ('address', 'motor', 'inverted', 'count', 'maxangle', 'acceleration',
+    'speed', 'deceleration', 'deadband', 'send_command', 'cmd')
+
+  # Address, command, four longs, a byte, CRC and acknowledgement.
+  wire_bytes = 22
+
+  # Command that sets both motors of an address at once.
+  combined_cmd = Roboclaw.Cmd.MIXEDSPEEDACCELDECCELPOS
+
+  def __init__(self, wrapper, id):
+    self.address, self.motor, self.inverted = wrapper.check_id(id)
+    wrapper.check_roboclaw()
+
+    # Encoder count at the hard stop, and its angle off center
+    hardstop = wrapper.angleparams['hardstop']
+    self.count = hardstop['count']
+    self.maxangle = hardstop['angle']
+
+    self.acceleration = wrapper.angleparams['accel']
+    self.speed = wrapper.angleparams['speed']
+    self.deceleration = wrapper.angleparams['decel']
+    self.deadband = wrapper.angle_deadband
+
+    if self.motor==1:
+      self.send_command = wrapper.roboclaw.SpeedAccelDeccelPositionM1
+      self.cmd = Roboclaw.Cmd.M1SPEEDACCELDECCELPOS
+    else:
+      self.send_command = wrapper.roboclaw.SpeedAccelDeccelPositionM2
+      self.cmd = Roboclaw.Cmd.M2SPEEDACCELDECCELPOS
+
+  def setpoint(self, angle):
+    if abs(angle) > self.maxangle:
+      raise ValueError("Steering angle {} exceeds maximum of {} degrees off center".format(angle, self.maxangle))
+
+    # Translate angle to position
+    position = int(self.count * angle / self.maxangle)
+    if self.inverted:
+      position = -position
+
+    return position
+
+  def send(self, position):
+    if not self.send_command(self.address, self.acceleration, self.speed,
+      self.deceleration, position, immediate_execution):
+      raise ValueError("Position {} via {}/{}/{} on RoboClaw M{}@{}".format(
+        position, self.acceleration, self.speed, self.deceleration, self.motor, self.address))
+
+  def command(self, position):
+    return (roboclaw.packet(self.address, self.cmd, 'IIIiB', self.acceleration, self.speed,
+      self.deceleration, position, immediate_execution), 1, check_ack)
+
+  def fields(self, position):
+    return (self.address, self.cmd, 'IIIIB', (self.acceleration, self.speed,
+      self.deceleration, position, immediate_execution))
+
+  def fields_m1m2(self, position, m2, m2_position):
+    return (self.address, self.combined_cmd, 'IIIIIIIIB', (self.acceleration, self.speed,
+      self.deceleration, position, m2.acceleration, m2.speed, m2.deceleration, m2_position,
+      immediate_execution))
+
+class roboclaw_wrapper(motor_control.motor_control):
   """
   Class that wraps the roboclaw Python API released by Ion Motion Control.
   Includes some utility functions to help interface with the API, but mainly
   to keep the interface surface to the subset necessary to run a rover.
 
-  Goal: Eventually have an abstract base class or interface ("motor_control"?)
-  that defines the interface surface we need, and we have multiple derived
-  classes, each corresponding to a motor controller. Rover builders can then
-  swap out the appropriate software implementation to match different motor
+  The interface surface we need is defined by motor_control base class, with
+  one derived class for each motor controller. Rover builders can then swap
+  out the appropriate software implementation to match different motor
   controller hardware: RoboClaw, ODrive Robotics, etc.
 
-  Goal: Make this class safe to call from multiple threads.
-    Option 1: Only allow commands from one thread, reject commands from others.
-    Option 2: Allow commands from all threads, serialize them so only one is
-              executed at a time.
+  This class is not safe to call from multiple threads by itself. Wrapped in
+  busowner.proxy, as roverchassis does, commands from all threads are
+  serialized so only one is executed at a time.
   """
 
+  # Commands for every address on the port are written back to back and
+  # their acknowledgements read together, see Roboclaw.WritePipelined()
+  supports_velocity_many = True
+  supports_angle_many = True
+
+  # Two motors on the same RoboClaw share one input voltage reading.
+  supports_input_voltage_many = True
+
+  # Estimated, not measured.
+  turnaround = 0.001
+
   def __init__(self):
     self.roboclaw = None
 
+    # Changes smaller than these many encoder counts (per second for
+    # velocity) are not worth sending to the RoboClaw.
+    self.velocity_deadband = 0
+    self.angle_deadband = 0
+
   @staticmethod
   def check_id(id):
     """
@@ -122,34 +280,81 @@ class roboclaw_wrapper:
     if self.roboclaw == None:
       raise ValueError("RoboClaw not yet connected")
 
-  def connect(self):
+  def connect(self, instance=None):
     """
     Read all configuration parameters (not just connect) and use the connect
     parameters to create new RoboClaw API handle.
+
+    Given one of the "instances" in the configuration file, connect to that
+    instance instead.
     """
 
     # First load configuration file
     config = configuration.configuration("roboclaw")
-    allparams = config.load()
+    allparams = config.load(instance)
 
     self.velocityparams = allparams['velocity']
     self.angleparams = allparams['angle']
+    self.velocity_deadband = self.velocityparams.get('deadband', 0)
+    self.angle_deadband = self.angleparams.get('deadband', 0)
 
     # Use connect configuration to create a RoboClaw API handle
     portname = allparams['connect']['port']
+    self.bus = portname
     if portname == 'TEST':
       self.roboclaw = Roboclaw_stub()
     else:
       baudrate = allparams['connect']['baudrate']
       timeout = allparams['connect']['timeout']
       retries = allparams['connect']['retries']
-      newrc = Roboclaw(portname, baudrate, timeout, retries)
+      max_timeout = allparams['connect'].get('maxTimeout', 1.0)
+      newrc = Roboclaw(portname, baudrate, timeout, retries, max_timeout)
+      self.baudrate = baudrate
+      newrc.before_command = self.before_command
 
       if newrc.Open():
         self.roboclaw = newrc
       else:
         raise ValueError("Could not connect to RoboClaw. {} @ {}".format(portname, baudrate))
 
+  def device(self, id):
+    """ Both motors on a RoboClaw share its address """
+    address, motor, inverted = self.check_id(id)
+    return "RoboClaw {}".format(address)
+
+  def before_command(self):
+    """
+    Called by RoboClaw API before every command, including each retry. Gives
+    up when a higher priority command is waiting for the bus (for example a
+    stop behind a voltage query) or the current deadline has passed, and
+    otherwise limits the reply timeout the RoboClaw API has just set for
+    this command to what's left before the deadline.
+    """
+    if busowner.preempted():
+      raise ValueError("RoboClaw command abandoned for higher priority traffic")
+
+    port = self.roboclaw._port
+    timeout = rovertime.budget(port.timeout, "RoboClaw command")
+    if port.timeout != timeout:
+      port.timeout = timeout
+
+  def statistics(self):
+    """
+    Retries, timeouts, CRC errors, late replies recovered, and round trip
+    time and adapted reply timeout of each address. See Roboclaw.Statistics()
+    """
+    self.check_roboclaw()
+    if isinstance(self.roboclaw, Roboclaw):
+      return self.roboclaw.Statistics()
+    return None
+
+  def serial_port(self):
+    """Serial port for asyncbus. None for the stub, which has no port."""
+    self.check_roboclaw()
+    if isinstance(self.roboclaw, Roboclaw):
+      return self.roboclaw._port
+    return None
+
   def version(self, id):
     """Returns a version string for display"""
     address, motor, inverted = self.check_id(id)
@@ -178,6 +383,22 @@ class roboclaw_wrapper:
     else:
       apiset(self.roboclaw.ForwardBackwardM2(address,level), error)
 
+  def emergency_stop(self, ids):
+    """
+    Send zero duty cycle to both motors of every RoboClaw address in the
+    list, one command per address, without waiting for acknowledgement.
+    """
+    self.check_roboclaw()
+
+    addresses = list()
+    for id in ids:
+      address, motor, inverted = self.check_id(id)
+      if address not in addresses:
+        addresses.append(address)
+
+    for address in addresses:
+      self.roboclaw.DutyM1M2NoAck(address, 0, 0)
+
   def set_max_current(self, id, current):
     """
     Restrict the specified motor's maximum allowed amperage draw.
@@ -218,30 +439,70 @@ class roboclaw_wrapper:
     self.set_max_current(id, self.velocityparams['maxCurrent'])
     self.set_velocity_pid(id, self.velocityparams['velocity'])
 
-  def velocity(self, id, pct_velocity):
+  @staticmethod
+  def combine(commands):
     """
-    Run the specified motor (address,motor#) at the specified percentage of
-    maximum velocity.
+    Given a list of (handle, value) tuples, returns a list of (fields,
+    handles) packets to send. When both motors of an address are in the
+    list they share one combined M1M2 packet, halving packets and
+    acknowledgements for the usual two wheels per RoboClaw.
+    """
+    motors = dict()
+    for handle, value in commands:
+      motors[(handle.address, handle.combined_cmd, handle.motor)] = (handle, value)
+
+    packets = list()
+    for handle, value in commands:
+      key = (handle.address, handle.combined_cmd)
+      if key + (handle.motor,) not in motors:
+        continue # Already sent along with the other motor
+      if key + (1,) in motors and key + (2,) in motors:
+        m1, m1_value = motors.pop(key + (1,))
+        m2, m2_value = motors.pop(key + (2,))
+        packets.append((m1.fields_m1m2(m1_value, m2, m2_value), (m1, m2)))
+      else:
+        del motors[key + (handle.motor,)]
+        packets.append((handle.fields(value), (handle,)))
+    return packets
+
+  def send_many(self, commands, what):
+    """
+    Send a list of (handle, value) tuples pipelined, raise ValueError
+    naming the motors that still failed after retries.
     """
-    address, motor, inverted = self.check_id(id)
     self.check_roboclaw()
+    if not commands:
+      return
 
-    if abs(int(pct_velocity)) > 100:
-      raise ValueError("Velocity percentage {} exceeds maximum of 100".format(pct_velocity))
+    packets = self.combine(commands)
+    acked = self.roboclaw.WritePipelined([fields for fields, handles in packets])
+    failed = ["M{}@{}".format(handle.motor, handle.address)
+      for (fields, handles), ack in zip(packets, acked) if not ack for handle in handles]
+    if failed:
+      raise ValueError("RoboClaw {} not acknowledged by {}".format(what, ", ".join(failed)))
 
-    qpps = int(self.velocityparams['maxVelocity'] * pct_velocity / 100)
+  def send_velocity_many(self, commands, wait_ack=True):
+    """ Send velocity to several motors, any mix of addresses """
+    self.send_many(commands, "velocity")
 
-    if inverted:
-      qpps = -qpps
+  def send_angle_many(self, commands, wait_ack=True):
+    """ Send position to several motors, any mix of addresses """
+    self.send_many(commands, "position")
 
-    acceleration = self.velocityparams['acceleration']
-    args = (address, acceleration, qpps)
-    error = "Velocity {} acceleration {} on RoboClaw M{}@{}".format(qpps, acceleration, motor, address)
+  def velocity_handle(self, id):
+    """
+    Returns a velocity_handle for the specified motor, for callers that will
+    send many velocity commands to the same motor.
+    """
+    return velocity_handle(self, id)
 
-    if motor==1:
-      apiset(self.roboclaw.SpeedAccelM1(*args), error)
-    else:
-      apiset(self.roboclaw.SpeedAccelM2(*args), error)
+  def velocity(self, id, pct_velocity):
+    """
+    Run the specified motor (address,motor#) at the specified percentage of
+    maximum velocity.
+    """
+    handle = self.velocity_handle(id)
+    handle.send(handle.setpoint(pct_velocity))
 
   def set_position_pid(self, id, params, limit):
     """
@@ -280,36 +541,83 @@ class roboclaw_wrapper:
     """
     return self.angleparams['hardstop']['angle']
 
+  def angle_handle(self, id):
+    """
+    Returns an angle_handle for the specified motor, for callers that will
+    send many angle commands to the same motor.
+    """
+    return angle_handle(self, id)
+
   def angle(self, id, angle):
     """
     Immediately moves the specified motor (address,motor#) to the specified
     angle expressed in number of degrees off zero center, positive clockwise.
     """
+    handle = self.angle_handle(id)
+    handle.send(handle.setpoint(angle))
+
+  def steering_position(self, id):
+    """
+    Reads the steering motor encoder and returns current angle expressed in
+    number of degrees off zero center, positive clockwise.
+    """
     address, motor, inverted = self.check_id(id)
     self.check_roboclaw()
 
-    hardstopangle = self.angleparams['hardstop']['angle']
-    hardstopcount = self.angleparams['hardstop']['count']
+    error = "Read encoder of RoboClaw M{}@{}".format(motor, address)
 
-    if abs(angle) > hardstopangle:
-      raise ValueError("Steering angle {} exceeds maximum of {} degrees off center".format(angle, hardstopangle))
+    if motor==1:
+      position, status = apiget(self.roboclaw.ReadEncM1(address), error)
+    else:
+      position, status = apiget(self.roboclaw.ReadEncM2(address), error)
 
-    # Translate angle to position
-    position = int(hardstopcount * angle / hardstopangle)
+    return self.encoder_angle(position, inverted)
+
+  def steering_position_command(self, id):
+    """ Encoder read for asyncbus, see motor_control """
+    address, motor, inverted = self.check_id(id)
+
+    if motor==1:
+      cmd = Roboclaw.Cmd.GETM1ENC
+    else:
+      cmd = Roboclaw.Cmd.GETM2ENC
+
+    def parse(response):
+      values = roboclaw.reply_values(address, cmd, 'iB', response)
+      if values is None:
+        raise ValueError("Read encoder of RoboClaw M{}@{}".format(motor, address))
+      return self.encoder_angle(values[0], inverted)
 
+    packet, length = roboclaw.read_packet(address, cmd, 'iB')
+    return (packet, length, parse)
+
+  def encoder_angle(self, position, inverted):
+    """ Encoder position translated to degrees off zero center """
     if inverted:
       position = -position
 
-    acceleration = self.angleparams['accel']
+    hardstopangle = self.angleparams['hardstop']['angle']
+    hardstopcount = self.angleparams['hardstop']['count']
+
+    return float(position) * hardstopangle / hardstopcount
+
+  def steering_time(self, id, degrees):
+    """
+    Estimated number of seconds to steer through the given number of degrees,
+    following the acceleration and speed limits sent by angle().
+    """
+    hardstopangle = self.angleparams['hardstop']['angle']
+    hardstopcount = self.angleparams['hardstop']['count']
+    counts = float(degrees) * hardstopcount / hardstopangle
+
     speed = self.angleparams['speed']
-    deceleration = self.angleparams['decel']
-    args = (address, acceleration, speed, deceleration, position, immediate_execution)
-    error = "Position {} via {}/{}/{} on RoboClaw M{}@{}".format(position, acceleration, speed, deceleration, motor, address)
+    acceleration = (self.angleparams['accel'] + self.angleparams['decel']) / 2.0
 
-    if motor==1:
-      apiset(self.roboclaw.SpeedAccelDeccelPositionM1(*args), error)
+    if counts < speed * speed / acceleration:
+      # Never reaches full speed, accelerates halfway then decelerates.
+      return 2 * math.sqrt(counts / acceleration)
     else:
-      apiset(self.roboclaw.SpeedAccelDeccelPositionM2(*args), error)
+      return counts / speed + speed / acceleration
 
   def steer_setzero(self, id):
     """
@@ -338,3 +646,34 @@ class roboclaw_wrapper:
     voltage10 = apiget(self.roboclaw.ReadMainBatteryVoltage(address))
 
     return voltage10 / 10.0
+
+  def input_voltage_command(self, id):
+    """ Main battery voltage read for asyncbus, see motor_control """
+    address, motor, inverted = self.check_id(id)
+    cmd = Roboclaw.Cmd.GETMBATT
+
+    def parse(response):
+      values = roboclaw.reply_values(address, cmd, 'H', response)
+      if values is None:
+        raise ValueError("Read voltage of RoboClaw @{}".format(address))
+      return values[0] / 10.0
+
+    packet, length = roboclaw.read_packet(address, cmd, 'H')
+    return (packet, length, parse)
+
+  def input_voltage_many(self, ids):
+    """
+    Read input voltage for a list of motors, querying each RoboClaw only once
+    even if both of its motors are in the list.
+    """
+    self.check_roboclaw()
+
+    voltages = dict()
+    for id in ids:
+      address, motor, inverted = self.check_id(id)
+      if address not in voltages:
+        voltage10 = apiget(self.roboclaw.ReadMainBatteryVoltage(address),
+          "Read voltage of RoboClaw @{}".format(address))
+        voltages[address] = voltage10 / 10.0
+
+    return [voltages[self.check_id(id)[0]] for id in ids]
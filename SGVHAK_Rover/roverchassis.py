@@ -23,16 +23,33 @@ SOFTWARE.
 """
 import math
 import logging
+import threading
+import time
 import configuration
 import roboclaw_wrapper
 import adafruit_servo_wrapper
 import lewansoul_wrapper
 import dynamixel_wrapper
 import dmfe_wrapper
+import kinematics
+import maneuver
+import rovertime
+import busowner
+from rovertime import monotonic
 
 # Python 2 does not have a constant for infinity. (Python 3 added math.inf.)
 infinity = float("inf")
 
+# Motor controller types: name used in configuration files, wrapper class,
+# and description for error messages.
+motorcontroltypes = [
+  ('roboclaw', roboclaw_wrapper.roboclaw_wrapper, "roboclaw"),
+  ('adafruit_servo', adafruit_servo_wrapper.adafruit_servo_wrapper, "Adafruit Servo HAT library"),
+  ('lewansoul', lewansoul_wrapper.lewansoul_wrapper, "LewanSoul Servo Library"),
+  ('dynamixel', dynamixel_wrapper.dynamixel_wrapper, "Dynamixel Servo Library"),
+  ('dmfe', dmfe_wrapper.dmfe_wrapper, "DMFE serial bus device library"),
+]
+
 class roverwheel:
   """
   Rover wheel class tracks information specific to a particular wheel on
@@ -62,10 +79,29 @@ class roverwheel:
     self.angle = 0
     self.velocity = 0
 
+    # The value most recently sent to each motor controller, in the units
+    # each controller uses on the wire (see velocity_handle/angle_handle)
+    # and time when it was sent. None if nothing sent yet, or if the motor
+    # was commanded by some other means so we no longer know its state.
+    self.rollingsent = None
+    self.rollingsenttime = 0
+    self.steeringsent = None
+    self.steeringsenttime = 0
+
+    # Steering angle in degrees most recently sent to steering control.
+    self.steeringsentangle = 0
+
+    # Handles that send commands to a single motor without looking up and
+    # validating its parameters every time. Compiled below once the motor
+    # controller has been initialized.
+    self.rollinghandle = None
+    self.steeringhandle = None
+
     # If we were given a rolling velocity control, run any initialization we
     # need and obtain its label string to show to user.
     if self.rollingcontrol:
       self.rollingcontrol.init_velocity(self.rollingparam)
+      self.rollinghandle = self.rollingcontrol.velocity_handle(self.rollingparam)
       try:
         self.rollinglabel = self.rollingcontrol.version(self.rollingparam)
       except ValueError as ve:
@@ -74,6 +110,7 @@ class roverwheel:
     # Repeat the above, this time for steering angle control.
     if self.steeringcontrol:
       self.steeringcontrol.init_angle(self.steeringparam)
+      self.steeringhandle = self.steeringcontrol.angle_handle(self.steeringparam)
       try:
         self.steeringlabel = self.steeringcontrol.version(self.steeringparam)
       except ValueError as ve:
@@ -84,30 +121,145 @@ class roverwheel:
     Instructs the motor controller to stop rolling, stop holding position,
     whatever is the least-effort situation. (If applicable)
     """
+    self.poweroff_rolling()
+    self.poweroff_steering()
+
+  def poweroff_rolling(self):
+    """ Rolling half of poweroff() """
     self.velocity = 0
+    self.rollingsent = None
     if self.rollingcontrol:
       self.rollingcontrol.power_percent(self.rollingparam, 0)
 
+  def poweroff_steering(self):
+    """ Steering half of poweroff() """
     # Killing the power leaves the angle wherever it was last (except as
     # moved by external forces) so leave self.angle alone.
+    self.steeringsent = None
     if self.steeringcontrol:
       self.steeringcontrol.power_percent(self.steeringparam, 0)
 
-  def anglevelocity(self):
+  def anglevelocity(self, force=False, keepalive=None):
     """
-    Send the dictated angle and velocity to their respective controls
+    Send the dictated angle and velocity to their respective controls.
+
+    A command is skipped if it would send the same value (within deadband of
+    the motor controller) as the previous command, unless 'force' is True or
+    more than 'keepalive' seconds have passed since it was last sent.
     """
-    if self.rollingcontrol:
-      self.rollingcontrol.velocity(self.rollingparam, self.velocity)
+    self.sendvelocity(force, keepalive)
+    self.sendangle(force, keepalive)
 
-    if self.steeringcontrol:
-      self.steeringcontrol.angle(self.steeringparam, self.angle)
+  def sendvelocity(self, force=False, keepalive=None):
+    """
+    Send the dictated velocity to rolling control, see anglevelocity().
+    Returns True if a command was sent.
+    """
+    if not self.rollinghandle:
+      return False
+
+    now = monotonic()
+    sent = self.velocity_due(now, force, keepalive)
+    if sent is None:
+      return False
+
+    # Forget the previous value first, so it is sent again next time if
+    # this attempt raises an error.
+    self.rollingsent = None
+    self.rollinghandle.send(sent)
+    self.velocity_sent(sent, now)
+    return True
+
+  def velocity_due(self, now, force=False, keepalive=None):
+    """
+    Returns the value rolling control should be sent for dictated velocity,
+    or None if it doesn't need to be sent. See anglevelocity().
+    """
+    handle = self.rollinghandle
+    sent = handle.setpoint(self.velocity)
+    if force or self.rollingsent is None or \
+      abs(sent - self.rollingsent) > handle.deadband or \
+      (keepalive is not None and now - self.rollingsenttime > keepalive):
+      return sent
+    return None
+
+  def velocity_sent(self, sent, now):
+    """ Record value from velocity_due() was sent at time 'now' """
+    self.rollingsent = sent
+    self.rollingsenttime = now
+
+  def sendangle(self, force=False, keepalive=None):
+    """
+    Send the dictated angle to steering control, see anglevelocity().
+    Returns True if a command was sent.
+    """
+    if not self.steeringhandle:
+      return False
+
+    now = monotonic()
+    sent = self.angle_due(now, force, keepalive)
+    if sent is None:
+      return False
+
+    self.steeringsent = None
+    self.steeringhandle.send(sent)
+    self.angle_sent(sent, now)
+    return True
+
+  def angle_due(self, now, force=False, keepalive=None):
+    """
+    Returns the value steering control should be sent for dictated angle,
+    or None if it doesn't need to be sent. See anglevelocity().
+    """
+    handle = self.steeringhandle
+    sent = handle.setpoint(self.angle)
+    if force or self.steeringsent is None or \
+      abs(sent - self.steeringsent) > handle.deadband or \
+      (keepalive is not None and now - self.steeringsenttime > keepalive):
+      return sent
+    return None
+
+  def angle_sent(self, sent, now):
+    """ Record value from angle_due() was sent at time 'now' """
+    self.steeringsent = sent
+    self.steeringsenttime = now
+    self.steeringsentangle = self.angle
+
+  def health(self):
+    """
+    List of devices behind this wheel's motor controllers that are not
+    responding, see devicehealth.py
+    """
+    dead = list()
+    for handle in (self.rollinghandle, self.steeringhandle):
+      if not responding(handle) and handle.health.name not in dead:
+        dead.append(handle.health.name)
+    return dead
+
+  def steering_position(self):
+    """
+    Read back the actual steering angle from the steering control. Returns
+    None if the control can't report its position or failed to answer.
+    """
+    try:
+      return self.steeringcontrol.steering_position(self.steeringparam)
+    except ValueError:
+      return None
+
+  def steering_time(self, fromangle):
+    """
+    Estimated number of seconds for steering to move from the given angle to
+    the currently dictated angle.
+    """
+    return self.steeringcontrol.steering_time(self.steeringparam, abs(self.angle - fromangle))
 
   def steerto(self, angle):
     """
     Steer this wheel to the specified angle. Caller is responsible for
     validation of all parameters.
     """
+    self.steeringsent = None
+    self.steeringsentangle = angle
     self.steeringcontrol.angle(self.steeringparam, angle)
 
   def steersetzero(self):
@@ -115,6 +267,7 @@ class roverwheel:
     Set the current steering angle of this wheel as the new zero. Caller is
     responsible for validation of all parameters
     """
+    self.steeringsent = None
     self.steeringcontrol.steer_setzero(self.steeringparam)
 
   def motor_voltage(self):
@@ -136,6 +289,28 @@ class roverwheel:
 
     return voltages
 
+def responding(handle):
+  """
+  False if the device behind a velocity or angle handle is known not to be
+  responding, see devicehealth.py
+  """
+  health = getattr(handle, 'health', None)
+  return health is None or not health.open
+
+class bus_error(ValueError):
+  """
+  Work on some buses failed or didn't finish in time, see run_on_buses().
+  'errors' lists (bus, error) for each of them and 'finished' lists buses
+  where work was completed, so the caller knows what was and wasn't done.
+  """
+  def __init__(self, errors, finished):
+    message = "; ".join(["Bus {}: {}".format(bus, error) for bus, error in errors])
+    if finished:
+      message = "{} (finished: {})".format(message, ", ".join([str(bus) for bus in finished]))
+    ValueError.__init__(self, message)
+    self.errors = errors
+    self.finished = finished
+
 class chassis:
   """
   Rover chassis class tracks the physical geometry of the chassis and uses
@@ -170,48 +345,114 @@ class chassis:
     #   to an instance of the motor controller.
     self.motorcontrollers = dict()
 
+    # Structure-of-arrays copy of wheel geometry for the vectorized solver.
+    #   Built by ensureready() if NumPy is available, otherwise None and
+    #   calculations are done one wheel at a time.
+    self.geometry = None
+
+    # Precomputed wheel angle and velocity coefficients for each integer
+    #   steering percentage from -100 to 100. Built by build_steering_table()
+    #   and used by move_velocity_pct().
+    self.steeringtable = None
+    self.steeringtablewheels = list()
+
+    # Wheel commands identical to the previous one are not sent, except once
+    #   every this many seconds so controllers with a command timeout (and
+    #   any that missed a command) are kept up to date. None to disable.
+    self.keepalive = 1.0
+
+    # How wheel commands are sent by dispatch()
+    #   'wheel': steering and rolling of one wheel, then move on to next wheel.
+    #   'steer_first': steering of all wheels, wait for them to reach their
+    #     angles, then rolling of all wheels.
+    self.dispatch_mode = 'wheel'
+
+    # For 'steer_first' dispatch: wheels within this many degrees of their
+    #   dictated angle are close enough to start rolling, but never wait
+    #   more than steering_timeout seconds. Steering controls that can
+    #   report their position are polled every steering_poll seconds, the
+    #   rest are assumed done after their estimated time to steer.
+    self.steering_tolerance = 3
+    self.steering_timeout = 1.0
+    self.steering_poll = 0.01
+
+    # Timed sequence of motions currently being executed, if any.
+    self.maneuver = None
+
+    # Wheels grouped by the bus of their motor controllers, see group_buses()
+    #   Each element is a (bus name, rolling wheels, steering wheels) tuple.
+    self.buses = list()
+
+    # Commands to motor controllers on different buses (serial ports, I2C
+    #   bus) are sent at the same time, one thread per bus. Set to False to
+    #   send everything from the calling thread, one bus after another.
+    #   Either way, all buses have dispatch_timeout seconds to finish.
+    self.parallel_dispatch = True
+    self.dispatch_timeout = 0.5
+
+    # Most seconds any chassis operation (a drive command, reading voltages,
+    #   ...) may take, counting every retry by every motor controller. They
+    #   all give up and report what they didn't finish once this passes, see
+    #   rovertime.within(). Enough for 'steer_first' dispatch to use all of
+    #   dispatch_timeout twice and steering_timeout in between.
+    self.command_timeout = 2.0
+
+    # Motor controllers that can command several motors at once (see
+    #   motor_control.py) are sent all their wheels in one call. Set to False
+    #   to let the ones that can skip waiting for acknowledgement.
+    self.wait_ack = True
+
   def init_motorcontrollers(self):
     """
     Creates the dictionary where a name in the configuration file can be
     matched with its corresponding motor controller.
-    """
-    try:
-      # Each instance of this class represents one group of RoboClaw connected
-      # together on the same packet serial network. Up to eight addressible
-      # RoboClaws and two motors per controller = up to 16 motors.
-      rclaw = roboclaw_wrapper.roboclaw_wrapper()
-      rclaw.connect()
-      self.motorcontrollers['roboclaw'] = rclaw
-    except ValueError as ve:
-      logging.getLogger(__name__).error("Unable to initialize roboclaw: %s",str(ve))
 
-    try:
-      asw = adafruit_servo_wrapper.adafruit_servo_wrapper()
-      asw.connect()
-      self.motorcontrollers['adafruit_servo'] = asw
-    except StandardError as se:
-      logging.getLogger(__name__).error("Unable to initialize Adafruit Servo HAT library: %s",str(se))
+    Each type of motor controller is created from its configuration file and
+    named after its type, for example 'lewansoul'. Additional instances
+    listed under "instances" in that file are named by type and bus, such
+    as 'lewansoul@/dev/ttyUSB1', or by type and the instance's "name" if it
+    has one. The first instance is also available under its type@bus name.
 
-    try:
-      lws = lewansoul_wrapper.lewansoul_wrapper()
-      lws.connect()
-      self.motorcontrollers['lewansoul'] = lws
-    except StandardError as se:
-      logging.getLogger(__name__).error("Unable to initialize LewanSoul Servo Library: %s",str(se))
+    Every motor controller is wrapped in busowner.proxy so it may be called
+    from any thread.
+    """
+    for controltype, wrapperclass, description in motorcontroltypes:
+      try:
+        # For RoboClaw, each instance of this class represents one group of
+        # RoboClaw connected together on the same packet serial network. Up
+        # to eight addressible RoboClaws and two motors per controller = up
+        # to 16 motors.
+        control = wrapperclass()
+        control.connect()
+        control = busowner.proxy(control)
+        self.add_motorcontroller(controltype, control)
+        if control.bus:
+          self.add_motorcontroller("{}@{}".format(controltype, control.bus), control)
+      except StandardError as se:
+        logging.getLogger(__name__).error("Unable to initialize %s: %s", description, str(se))
 
-    try:
-      dms = dynamixel_wrapper.dynamixel_wrapper()
-      dms.connect()
-      self.motorcontrollers['dynamixel'] = dms
-    except StandardError as se:
-      logging.getLogger(__name__).error("Unable to initialize Dynamixel Servo Library: %s",str(se))
+      try:
+        instances = configuration.configuration(controltype).instances()
+      except StandardError:
+        # Already reported above.
+        instances = list()
 
-    try:
-      dmfe = dmfe_wrapper.dmfe_wrapper()
-      dmfe.connect()
-      self.motorcontrollers['dmfe'] = dmfe
-    except StandardError as se:
-      logging.getLogger(__name__).error("Unable to initialize DMFE serial bus device library: %s",str(se))
+      for instance in instances:
+        try:
+          control = wrapperclass()
+          control.connect(instance)
+          control = busowner.proxy(control)
+          self.add_motorcontroller("{}@{}".format(controltype, instance.get('name', control.bus)), control)
+        except StandardError as se:
+          logging.getLogger(__name__).error("Unable to initialize %s instance %s: %s", description, instance, str(se))
+
+  def add_motorcontroller(self, name, control):
+    """ Make motor controller available under given name """
+    if name in self.motorcontrollers:
+      if self.motorcontrollers[name] is control:
+        return
+      raise ValueError("Duplicate motor controller name {}".format(name))
+    self.motorcontrollers[name] = control
 
   def ensureready(self):
     """
@@ -271,8 +512,12 @@ class chassis:
       self.wheels[name] = roverwheel(name, wheel['x'], wheel['y'],
         rollingcontrol, rollingparam, steeringcontrol, steeringparam)
 
-    # Update radius min/max based on the rover chassis configuration info
-    self.calculate_radius_min_max()
+    # Pack wheel geometry into arrays for the vectorized solver and update
+    # radius min/max based on the rover chassis configuration info
+    self.refresh_geometry()
+
+    # Sort out which wheels can be commanded concurrently.
+    self.group_buses()
 
     # Wheels are initialized, set everything to zero.
     self.move_velocity_radius(0)
@@ -296,14 +541,480 @@ class chassis:
 
     self.currentMotion = (velocity, radius)
 
+    wheels, angles, velocities = self.calculate_wheels(velocity, radius)
+    for wheel, angle, wheelvelocity in zip(wheels, angles, velocities):
+      wheel.angle = angle
+      wheel.velocity = wheelvelocity
+
+    self.dispatch()
+
+  def move_velocity_pct(self, velocity, pct_angle):
+    """
+    Same as move_velocity_radius, except turning is expressed as percentage
+    of steering range (see radius_from_pct) instead of a radius. Integer
+    percentages are served from the precomputed steering table so no trig
+    is needed, anything else falls back to move_velocity_radius.
+    """
+    pct = int(pct_angle)
+    if self.steeringtable is None or pct != pct_angle or abs(pct) > 100:
+      self.move_velocity_radius(velocity, self.radius_from_pct(pct_angle))
+      return
+
+    if abs(velocity) > 100:
+      raise ValueError("Velocity percentage may not exceed 100")
+
+    radius, angles, forward, reverse = self.steeringtable[pct+100]
+    self.currentMotion = (velocity, radius)
+
+    if velocity < 0:
+      coefficients = reverse
+    else:
+      coefficients = forward
+
+    for wheel, angle, coefficient in zip(self.steeringtablewheels, angles, coefficients):
+      wheel.angle = angle
+      wheel.velocity = velocity * coefficient
+
+    self.dispatch()
+
+  def run_maneuver(self, segments):
+    """
+    Execute a list of (velocity, radius, duration) segments in the background
+    and stop at the end. Any maneuver already running is cancelled first.
+    Returns the maneuver object, which can report progress.
+    """
+    newmaneuver = maneuver.maneuver(self, segments)
+    self.cancel_maneuver()
+    self.maneuver = newmaneuver
+    newmaneuver.start()
+    return newmaneuver
+
+  def cancel_maneuver(self):
+    """
+    Stop executing maneuver, if one is running. Returns after its thread
+    has finished so caller is free to command the chassis.
+    """
+    if self.maneuver:
+      self.maneuver.cancel()
+
+  def dispatch(self, force=False):
+    """
+    Send each wheel's angle and velocity to its motor controllers. Commands
+    that would not change anything are skipped unless 'force' is True.
+    """
+    with rovertime.within(self.command_timeout):
+      if self.dispatch_mode == 'steer_first':
+        self.dispatch_steer_first(force)
+        return
+
+      # We're sending commands for a particular wheel - steering and rolling
+      # velocity - without waiting for steering to reach its angle. If this
+      # causes timing issues (wheels start moving before they've finished
+      # pointing in the right direction, etc.) use 'steer_first' dispatch.
+      def send(rolling, steering):
+        self.send_velocities(rolling, force)
+        self.send_angles(steering, force)
+      self.run_on_buses(send)
+
+  def dispatch_steer_first(self, force=False):
+    """
+    Send steering angle to all wheels, wait for them to get there, then send
+    rolling velocity to all wheels. This way the rover doesn't start moving
+    with wheels still pointed in their old directions.
+    """
+    moved = list()
+    def sendangles(rolling, steering):
+      moved.extend(self.send_angles(steering, force))
+    self.run_on_buses(sendangles)
+
+    self.wait_for_steering(moved)
+
+    def sendvelocities(rolling, steering):
+      self.send_velocities(rolling, force)
+    self.run_on_buses(sendvelocities)
+
+  def send_velocities(self, wheels, force=False):
+    """
+    Send dictated velocity of the given wheels to their rolling controls.
+    Controls that support velocity_many get all their wheels in one call,
+    the rest one wheel at a time.
+    """
+    now = monotonic()
+    batches = dict()
+    for wheel in wheels:
+      if not responding(wheel.rollinghandle):
+        # Don't wait on a device known to be dead, but send again once it's back.
+        wheel.rollingsent = None
+        continue
+      control = wheel.rollingcontrol
+      if not control.supports_velocity_many:
+        wheel.sendvelocity(force, self.keepalive)
+        continue
+      sent = wheel.velocity_due(now, force, self.keepalive)
+      if sent is not None:
+        batches.setdefault(control, list()).append((wheel, sent))
+
+    def sent(wheel, value):
+      wheel.velocity_sent(value, now)
+
+    for control, batch in batches.items():
+      for wheel, value in batch:
+        wheel.rollingsent = None
+      self.send_batch(control.send_velocity_many, [(wheel, wheel.rollinghandle, value) for wheel, value in batch], sent)
+
+  def send_angles(self, wheels, force=False):
+    """
+    Send dictated angle of the given wheels to their steering controls, see
+    send_velocities(). Returns list of (wheel, previous angle) tuples for
+    wheels that were sent new angles.
+    """
+    now = monotonic()
+    batches = dict()
+    moved = list()
+    for wheel in wheels:
+      if not responding(wheel.steeringhandle):
+        wheel.steeringsent = None
+        continue
+      control = wheel.steeringcontrol
+      fromangle = wheel.steeringsentangle
+      if not control.supports_angle_many:
+        if wheel.sendangle(force, self.keepalive):
+          moved.append((wheel, fromangle))
+        continue
+      sent = wheel.angle_due(now, force, self.keepalive)
+      if sent is not None:
+        batches.setdefault(control, list()).append((wheel, sent))
+
+    def sent(wheel, value):
+      moved.append((wheel, wheel.steeringsentangle))
+      wheel.angle_sent(value, now)
+
+    for control, batch in batches.items():
+      for wheel, value in batch:
+        wheel.steeringsent = None
+      self.send_batch(control.send_angle_many, [(wheel, wheel.steeringhandle, value) for wheel, value in batch], sent)
+
+    return moved
+
+  def send_batch(self, send_many, batch, sent):
+    """
+    Send a list of (wheel, handle, value) with send_many, a controller's
+    send_velocity_many or send_angle_many, calling sent(wheel, value) for
+    each wheel once sent. If that fails, each wheel is sent on its own to
+    find out which device failed, so only its health records the failure.
+    """
+    start = monotonic()
+    try:
+      send_many([(handle, value) for wheel, handle, value in batch], self.wait_ack)
+    except ValueError:
+      errors = list()
+      for wheel, handle, value in batch:
+        try:
+          handle.send(value)
+          sent(wheel, value)
+        except ValueError as ve:
+          errors.append("{}: {}".format(wheel.name, ve))
+      if errors:
+        raise ValueError("; ".join(errors))
+      return
+
+    elapsed = monotonic() - start
+    for wheel, handle, value in batch:
+      health = getattr(handle, 'health', None)
+      if health:
+        health.success(elapsed)
+      sent(wheel, value)
+
+  def wait_for_steering(self, steering):
+    """
+    Given a list of (wheel, previous angle) tuples for wheels that were just
+    sent new steering angles, wait until all of them are within
+    steering_tolerance of their new angle or steering_timeout has passed,
+    but not beyond the current deadline.
+    """
+    start = monotonic()
+    timeout = start + rovertime.budget(self.steering_timeout, "Steering")
+
+    # Each pending wheel is a list of [wheel, estimated completion time,
+    # whether position can be read back]. Ones that are close enough (or not
+    # really moving) are dropped right away.
+    pending = list()
+    for wheel, fromangle in steering:
+      if abs(wheel.angle - fromangle) > self.steering_tolerance:
+        pending.append([wheel, start + wheel.steering_time(fromangle), True])
+
+    while len(pending) > 0:
+      now = monotonic()
+      if now >= timeout:
+        break
+
+      stillpending = list()
+      for entry in pending:
+        wheel, estimate, readback = entry
+        if readback:
+          position = wheel.steering_position()
+          if position is None:
+            # Can't read back this wheel, rely on estimate from now on.
+            entry[2] = False
+          elif abs(position - wheel.angle) > self.steering_tolerance:
+            stillpending.append(entry)
+            continue
+          else:
+            continue
+        if now < estimate:
+          stillpending.append(entry)
+      pending = stillpending
+
+      if len(pending) > 0:
+        # Sleep until the next poll, or until the soonest estimated
+        # completion if nobody is being polled.
+        wakeup = timeout
+        for wheel, estimate, readback in pending:
+          if readback:
+            wakeup = min(wakeup, monotonic() + self.steering_poll)
+          else:
+            wakeup = min(wakeup, estimate)
+        delay = wakeup - monotonic()
+        if delay > 0:
+          time.sleep(delay)
+
+  def refresh(self):
+    """
+    Resend the current angle and velocity of every wheel even if they have
+    not changed.
+    """
+    self.dispatch(force=True)
+
+  def poweroff(self):
+    """ Power off every wheel, see roverwheel.poweroff() """
+    def poweroff(rolling, steering):
+      for wheel in rolling:
+        wheel.poweroff_rolling()
+      for wheel in steering:
+        wheel.poweroff_steering()
+    with rovertime.within(self.command_timeout):
+      self.run_on_buses(poweroff)
+
+  def emergency_stop(self):
+    """
+    Stop every motor as quickly as possible. Each motor controller is sent
+    its cheapest stop command (see motor_control.emergency_stop) without
+    waiting for acknowledgement, all buses at the same time. Any running
+    maneuver is cancelled. Returns number of seconds it took.
+    """
+    start = monotonic()
+
+    # Flag the maneuver first so it won't start another segment, but don't
+    # wait for it to finish before stopping.
+    running = self.maneuver and self.maneuver.running()
+    if running:
+      self.maneuver.cancelled = True
+
+    for wheel in self.wheels.values():
+      wheel.velocity = 0
+      wheel.rollingsent = None
+      wheel.steeringsent = None
+
+    def stop(rolling, steering):
+      ids = dict()
+      for wheel in rolling:
+        ids.setdefault(wheel.rollingcontrol, list()).append(wheel.rollingparam)
+      for wheel in steering:
+        ids.setdefault(wheel.steeringcontrol, list()).append(wheel.steeringparam)
+
+      # Keep going if one controller fails, so the others still get stopped.
+      errors = list()
+      for control, idlist in ids.items():
+        try:
+          control.emergency_stop(idlist)
+        except StandardError as se:
+          errors.append(str(se))
+      if errors:
+        raise ValueError("; ".join(errors))
+    self.run_on_buses(stop)
+
+    if running:
+      # Maneuver may have sent a command while we were stopping. Once it
+      # has finished, stop again to be sure.
+      self.cancel_maneuver()
+      self.run_on_buses(stop)
+
+    elapsed = monotonic() - start
+    logging.getLogger(__name__).info("Emergency stop took %.1f ms", elapsed*1000)
+    return elapsed
+
+  def motor_voltages(self):
+    """
+    Same as calling roverwheel.motor_voltage() on every wheel and returning
+    a dictionary of results by wheel name, but each motor controller is
+    asked for all of its motors in a single input_voltage_many() call.
+    Controllers that fail, or aren't reached within command_timeout, have
+    their error reported in place of voltage.
+    """
+    voltages = dict()
+    queries = dict()
+    for name, wheel in self.wheels.items():
+      voltages[name] = {"Rolling": "Not Applicable", "Steering": "Not Applicable"}
+      if wheel.rollingcontrol:
+        queries.setdefault(wheel.rollingcontrol, list()).append((name, "Rolling", wheel.rollingparam))
+      if wheel.steeringcontrol:
+        queries.setdefault(wheel.steeringcontrol, list()).append((name, "Steering", wheel.steeringparam))
+
+    with rovertime.within(self.command_timeout):
+      for control, query in queries.items():
+        try:
+          results = control.input_voltage_many([param for name, motor, param in query])
+        except ValueError as ve:
+          results = ["Error: {}".format(ve)] * len(query)
+        for (name, motor, param), voltage in zip(query, results):
+          voltages[name][motor] = voltage
+
+    return voltages
+
+  def controller_statistics(self):
+    """
+    Dictionary of protocol statistics by motor controller name, for those
+    that keep them. See motor_control.statistics()
+    """
+    statistics = dict()
+    seen = list()
+    for name in sorted(self.motorcontrollers):
+      control = self.motorcontrollers[name]
+      if control in seen:
+        continue
+      seen.append(control)
+      try:
+        result = control.statistics()
+      except ValueError as ve:
+        result = "Error: {}".format(ve)
+      if result is not None:
+        statistics[name] = result
+    return statistics
+
+  def steering_positions(self):
+    """
+    Dictionary of steering angle read back from each steerable wheel by
+    name, None for wheels that can't report it. See
+    roverwheel.steering_position()
+    """
+    positions = dict()
+    with rovertime.within(self.command_timeout):
+      for name, wheel in self.wheels.items():
+        if wheel.steeringcontrol:
+          positions[name] = wheel.steering_position()
+    return positions
+
+  def wheel_status(self):
+    """
+    Dictionary of velocity, angle and unresponsive devices (see
+    roverwheel.health()) of every wheel by name.
+    """
+    status = dict()
+    for name, wheel in self.wheels.items():
+      status[name] = {'velocity': wheel.velocity, 'angle': wheel.angle, 'health': wheel.health()}
+    return status
+
+  def group_buses(self):
+    """
+    Group wheels by the bus their rolling and steering controls are on. A
+    wheel may appear under two buses if its rolling and steering controls
+    are on different buses.
+    """
+    buses = dict()
+    for wheel in self.wheels.values():
+      if wheel.rollingcontrol:
+        buses.setdefault(wheel.rollingcontrol.bus, (list(), list()))[0].append(wheel)
+      if wheel.steeringcontrol:
+        buses.setdefault(wheel.steeringcontrol.bus, (list(), list()))[1].append(wheel)
+
+    self.buses = [(bus, rolling, steering) for bus, (rolling, steering) in buses.items()]
+
+  def run_on_buses(self, work):
+    """
+    Call work(rolling, steering) once per bus, where 'rolling' and 'steering'
+    are lists of wheels whose rolling and steering controls are on that bus.
+    Buses are worked on concurrently unless parallel_dispatch is False or
+    there is only one bus, so time taken is that of the slowest bus instead
+    of the sum of all buses.
+
+    Every bus has dispatch_timeout seconds, or until the deadline already
+    in effect if that is sooner (see rovertime.within). Motor controllers
+    give up once it passes. Raises bus_error if work raised an error on any
+    bus or any bus has not finished by the deadline. Work on a bus that
+    timed out carries on in the background until its controllers give up.
+    Motor controllers are wrapped in busowner.proxy, so its commands can't
+    collide with later ones.
+    """
+    errors = list()
+    finished = list()
+
+    with rovertime.within(self.dispatch_timeout) as deadline:
+      def run(bus, rolling, steering):
+        try:
+          with rovertime.within(deadline):
+            work(rolling, steering)
+          finished.append(bus)
+        except StandardError as se:
+          errors.append((bus, se))
+
+      if not self.parallel_dispatch or len(self.buses) < 2:
+        for bus, rolling, steering in self.buses:
+          run(bus, rolling, steering)
+      else:
+        threads = list()
+        for bus, rolling, steering in self.buses:
+          thread = threading.Thread(target=run, args=(bus, rolling, steering), name="bus {}".format(bus))
+          thread.daemon = True
+          thread.start()
+          threads.append((bus, thread))
+
+        for bus, thread in threads:
+          thread.join(max(0, deadline.remaining()))
+          if thread.is_alive():
+            errors.append((bus, "Did not finish before deadline"))
+
+    if errors:
+      for bus, error in errors:
+        logging.getLogger(__name__).error("Bus %s: %s", bus, error)
+      raise bus_error(errors, finished)
+
+  def radius_from_pct(self, pct_angle):
+    """
+    Translate steering percentage into turning radius. Zero is straight
+    ahead, +/-100 is the tightest possible turn right/left, and values in
+    between are spread linearly between minRadius and maxRadius.
+    """
+    if pct_angle == 0:
+      return infinity
+    elif pct_angle > 0:
+      return self.minRadius + (self.maxRadius-self.minRadius) * (100-pct_angle)/100.0
+    else:
+      return -self.minRadius - (self.maxRadius-self.minRadius) * (100+pct_angle)/100.0
+
+  def calculate_wheels(self, velocity, radius):
+    """
+    Calculate angle and velocity for each wheel without changing wheel state.
+    Returns a tuple of three lists: wheels, their angles, and velocities.
+
+    Uses the vectorized solver in kinematics.py if available, otherwise
+    calculates one wheel at a time here. The two must stay in sync.
+    """
+    if self.geometry:
+      angles, velocities = self.geometry.solve(velocity, radius, self.maxRadius)
+      return self.geometry.wheels, angles.tolist(), velocities.tolist()
+
+    wheels = list(self.wheels.values())
+    angles = list()
+    velocities = list()
+
     if radius > self.maxRadius:
       # Straight line travel
-      for wheel in self.wheels.values():
-        wheel.angle = 0
-        wheel.velocity = velocity
+      for wheel in wheels:
+        angles.append(0)
+        velocities.append(velocity)
     else:
       # Calculate angle and velocity for each wheel
-      for wheel in self.wheels.values():
+      for wheel in wheels:
         # Dimensions of triangle representing the wheel. Used for calculations
         # in form of opposite, adjacent, and hypotenuse
         opp = wheel.y
@@ -312,44 +1023,72 @@ class chassis:
 
         # Calculate wheel steering angle to execute the commanded motion.
         if adj == 0:
-          wheel.angle = 90
+          angle = 90
         else:
-          wheel.angle = math.degrees(math.atan(float(opp)/float(adj)))
+          angle = math.degrees(math.atan(float(opp)/float(adj)))
 
         # Calculate wheel rolling velocity to execute the commanded motion.
         if radius == 0:
-          wheel.velocity = 0 # TODO: Velocity calculation for spin-in-place where radius is zero
+          wheelvelocity = 0 # TODO: Velocity calculation for spin-in-place where radius is zero
         else:
-          wheel.velocity = velocity * hyp/abs(radius)
+          wheelvelocity = velocity * hyp/abs(radius)
 
         # If center of rotation is within the wheel track, and between the
         # wheel and the origin, then this wheel will need to turn in the
         # opposite direction so the rover body can turn about the center.
         if (radius < 0 and wheel.x < 0 and wheel.x < radius) or (radius > 0 and wheel.x > 0 and wheel.x > radius):
-          wheel.velocity = -wheel.velocity
+          wheelvelocity = -wheelvelocity
+
+        angles.append(angle)
+        velocities.append(wheelvelocity)
 
     # Go back and normalize al the wheel roll rate magnitude so they are at or
     # below target velocity while maintaining relative ratios between their rates.
     maxCalculated = 0
 
-    for wheel in self.wheels.values():
-      if abs(wheel.velocity) > maxCalculated:
-        maxCalculated = abs(wheel.velocity)
+    for wheelvelocity in velocities:
+      if abs(wheelvelocity) > maxCalculated:
+        maxCalculated = abs(wheelvelocity)
 
-    if maxCalculated > velocity:
+    if maxCalculated > velocity and maxCalculated > 0:
       # At least one wheel exceeded specified maxVelocity, calculate
       # normalization ratio and apply to every wheel.
       reductionRatio = abs(velocity)/float(maxCalculated)
-      for wheel in self.wheels.values():
-        wheel.velocity = wheel.velocity * reductionRatio
-
-    # We're sending commands for a particular wheel - steering and rolling
-    # velocity - before we move on to the next wheel. If this causes timing
-    # issues (wheels start moving before they've finished pointing in the
-    # right direction, etc.) we may have to send all steering commands first,
-    # wait until we reach the angles, before sending velocity commands.
-    for wheel in self.wheels.values():
-      wheel.anglevelocity()
+      velocities = [wheelvelocity * reductionRatio for wheelvelocity in velocities]
+
+    return wheels, angles, velocities
+
+  def evaluate_velocity_radius(self, motions):
+    """
+    Calculate wheel angles and velocities for a list of (velocity, radius)
+    pairs without sending anything to the motor controllers and without
+    changing current wheel state. Intended for planning code that wants to
+    compare many candidate arcs. Requires NumPy.
+
+    Returns a tuple (names, angles, velocities, feasible)
+    * names: list of wheel names, in the column order of the arrays.
+    * angles: array of steering angles, one row per motion.
+    * velocities: array of rolling velocities, one row per motion.
+    * feasible: array of booleans, one per motion. False if the motion would
+      be rejected by move_velocity_radius or requires a steering angle beyond
+      what a wheel can reach.
+    """
+    if not self.geometry:
+      raise ValueError("Evaluating multiple motions requires NumPy")
+
+    numpy = kinematics.numpy
+    pairs = numpy.asarray(motions, dtype=float).reshape(-1, 2)
+    velocities = pairs[:,0]
+    radii = pairs[:,1]
+
+    angles, wheelvelocities = self.geometry.solve_many(velocities, radii, self.maxRadius)
+
+    with numpy.errstate(invalid='ignore'):
+      steerlimit = numpy.abs(angles) <= self.geometry.maxangle
+    steerok = (steerlimit | ~self.geometry.steerable).all(axis=1)
+    feasible = (numpy.abs(radii) >= self.minRadius) & (numpy.abs(velocities) <= 100) & steerok
+
+    return self.geometry.names, angles, wheelvelocities, feasible
 
   def calculate_radius_min_max(self):
     """
@@ -388,3 +1127,41 @@ class chassis:
 
     self.minRadius = limit_min
     self.maxRadius = limit_max
+
+    # Radius limits feed into the steering table, rebuild it.
+    self.build_steering_table()
+
+  def build_steering_table(self):
+    """
+    Precompute wheel angles and velocity coefficients for every integer
+    steering percentage accepted by move_velocity_pct. Wheel angles depend
+    only on radius, and wheel velocities scale linearly with commanded
+    velocity, so each entry stores the result of calculating for velocity
+    of 1 (forward) and -1 (reverse) and move_velocity_pct only has to pick
+    an entry and multiply.
+
+    Must be rebuilt whenever wheel geometry or steering limits change, which
+    calculate_radius_min_max takes care of.
+    """
+    self.steeringtable = None
+
+    table = list()
+    for pct in range(-100, 101):
+      radius = self.radius_from_pct(pct)
+      wheels, angles, forward = self.calculate_wheels(1, radius)
+      wheels, angles, reverse = self.calculate_wheels(-1, radius)
+      reverse = [-wheelvelocity for wheelvelocity in reverse]
+      table.append((radius, angles, forward, reverse))
+
+    self.steeringtablewheels = wheels
+    self.steeringtable = table
+
+  def refresh_geometry(self):
+    """
+    Call after changing wheel position or steering limits of a running
+    chassis. Rebuilds the vectorized geometry, radius limits, and steering
+    table, all of which are calculated from them.
+    """
+    if kinematics.available():
+      self.geometry = kinematics.chassis_geometry(self.wheels.values())
+    self.calculate_radius_min_max()
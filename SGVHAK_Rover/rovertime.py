@@ -0,0 +1,125 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import threading
+import time
+
+def _clock_gettime_monotonic():
+  """
+  Python 2 does not have time.monotonic (Python 3.3 added it) so ask the
+  C library directly. Returns None if that's not possible on this system.
+  """
+  try:
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1 # From <linux/time.h>
+
+    def monotonic():
+      t = timespec()
+      if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+        raise OSError(ctypes.get_errno(), "clock_gettime failed")
+      return t.tv_sec + t.tv_nsec * 1e-9
+
+    monotonic()
+    return monotonic
+  except (ImportError, AttributeError, TypeError, OSError):
+    return None
+
+# Seconds from a clock that never jumps backwards. Wall clock time on a Pi
+# jumps whenever NTP sync happens (it has no battery backed clock) so timing
+# calculations should always use this instead of time.time().
+if hasattr(time, 'monotonic'):
+  monotonic = time.monotonic
+else:
+  monotonic = _clock_gettime_monotonic() or time.time
+
+class deadline(object):
+  """
+  A point in monotonic time by which an operation must be finished, given
+  as number of seconds from now.
+  """
+  __slots__ = ('end',)
+
+  def __init__(self, seconds):
+    self.end = monotonic() + seconds
+
+  def remaining(self):
+    return self.end - monotonic()
+
+  def expired(self):
+    return monotonic() >= self.end
+
+# Deadline in effect for the current thread, see within()
+_local = threading.local()
+
+def current_deadline():
+  """ Deadline in effect for the current thread, None if there isn't one """
+  return getattr(_local, 'deadline', None)
+
+class within(object):
+  """
+  Context manager putting a deadline into effect for the current thread.
+  Given a deadline, or number of seconds from now, or None for no change.
+  An enclosing deadline that ends sooner stays in effect, so every layer
+  can add its own limit without extending its caller's.
+  """
+  def __init__(self, limit):
+    self.limit = limit
+    self.previous = None
+
+  def __enter__(self):
+    self.previous = current_deadline()
+    limit = self.limit
+    if limit is not None and not isinstance(limit, deadline):
+      limit = deadline(limit)
+    if limit is None or (self.previous is not None and self.previous.end <= limit.end):
+      limit = self.previous
+    _local.deadline = limit
+    return limit
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _local.deadline = self.previous
+    return False
+
+def budget(timeout, what="Operation"):
+  """
+  Seconds a single wait may take: the lesser of 'timeout' (None for no
+  limit of its own) and the time left before the current deadline. Raises
+  ValueError if the deadline has already passed.
+  """
+  current = current_deadline()
+  if current is None:
+    return timeout
+  remaining = current.remaining()
+  if remaining <= 0:
+    raise ValueError("{} gave up, deadline passed".format(what))
+  if timeout is None:
+    return remaining
+  return min(timeout, remaining)
@@ -0,0 +1,222 @@
+"""
+MIT License
+
+Copyright (c) 2018 Roger Cheng
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import heapq
+import logging
+import time
+
+from rovertime import monotonic
+
+class job(object):
+  """
+  A function called every 'period' seconds by the scheduler. It should
+  finish within 'deadline' seconds of when it was due, otherwise it is
+  counted as an overrun. When several jobs are due at once, the one with
+  higher priority runs first.
+
+  Timing statistics are kept so we can tell whether the Pi keeps up:
+  lateness is how long after its due time a job started, runtime is how
+  long the function took. If a job falls more than a whole period behind,
+  the periods it missed are skipped (and counted) instead of running it
+  back to back to catch up.
+  """
+  def __init__(self, name, function, period, priority=0, deadline=None):
+    if period <= 0:
+      raise ValueError("Job {} period {} must be positive".format(name, period))
+
+    self.name = name
+    self.function = function
+    self.period = float(period)
+    self.priority = priority
+    if deadline is None:
+      deadline = self.period
+    self.deadline = float(deadline)
+
+    self.due = monotonic()
+    self.cancelled = False
+
+    self.runs = 0
+    self.runtime_total = 0.0
+    self.runtime_max = 0.0
+    self.lateness_total = 0.0
+    self.lateness_max = 0.0
+    self.overruns = 0
+    self.skipped = 0
+    self.errors = 0
+    self.error = None
+
+  def run(self, now):
+    """ Call the function, update statistics and schedule the next run """
+    lateness = now - self.due
+    try:
+      self.function()
+    except StandardError as se:
+      self.errors = self.errors + 1
+      self.error = str(se)
+      logging.getLogger(__name__).error("Scheduled job %s failed: %s", self.name, self.error)
+    finished = monotonic()
+    runtime = finished - now
+
+    self.runs = self.runs + 1
+    self.runtime_total = self.runtime_total + runtime
+    self.runtime_max = max(self.runtime_max, runtime)
+    self.lateness_total = self.lateness_total + lateness
+    self.lateness_max = max(self.lateness_max, lateness)
+    if finished - self.due > self.deadline:
+      self.overruns = self.overruns + 1
+
+    # Next run is scheduled from when this one was due, not when it ran, so
+    # the period doesn't drift. Skip any periods already gone by.
+    self.due = self.due + self.period
+    if self.due <= finished:
+      missed = int((finished - self.due) / self.period) + 1
+      self.skipped = self.skipped + missed
+      self.due = self.due + missed * self.period
+
+  def status(self):
+    """ Dictionary of timing statistics, suitable for JSON """
+    runs = max(self.runs, 1)
+    return {
+      'name': self.name,
+      'period': self.period,
+      'priority': self.priority,
+      'deadline': self.deadline,
+      'runs': self.runs,
+      'runtime_mean': self.runtime_total / runs,
+      'runtime_max': self.runtime_max,
+      'lateness_mean': self.lateness_total / runs,
+      'lateness_max': self.lateness_max,
+      'overruns': self.overruns,
+      'skipped': self.skipped,
+      'errors': self.errors,
+      'error': self.error,
+    }
+
+class scheduler:
+  """
+  Runs periodic jobs cooperatively from a single thread. Jobs are kept in
+  a heap ordered by due time, and each one runs to completion before the
+  next. Something has to call run_pending() frequently, either:
+
+  * serve(), which handles web requests in between jobs.
+  * run(), which does nothing but run jobs, for use without the web UI.
+  * Any existing loop, for example Flask request handlers.
+  """
+  def __init__(self):
+    self.heap = list()
+    self.jobs = dict()
+    self.sequence = 0
+
+  def add(self, name, function, period, priority=0, deadline=None):
+    """ Call function every 'period' seconds, see job. Returns the job. """
+    if name in self.jobs:
+      raise ValueError("Job {} already scheduled".format(name))
+
+    newjob = job(name, function, period, priority, deadline)
+    self.jobs[name] = newjob
+    self.push(newjob)
+    return newjob
+
+  def remove(self, name):
+    """ Stop running the named job """
+    self.jobs.pop(name).cancelled = True
+
+  def push(self, pending):
+    self.sequence = self.sequence + 1
+    heapq.heappush(self.heap, (pending.due, self.sequence, pending))
+
+  def time_until_next(self):
+    """ Seconds until the next job is due, None if there are no jobs """
+    while self.heap and self.heap[0][2].cancelled:
+      heapq.heappop(self.heap)
+    if not self.heap:
+      return None
+    return max(0, self.heap[0][0] - monotonic())
+
+  def run_pending(self, minimum=None):
+    """
+    Run every job that is due, highest priority first. If 'minimum' is
+    given, only jobs of at least that priority run and the rest stay due.
+    Returns number of jobs run.
+    """
+    now = monotonic()
+    due = list()
+    held = list()
+    while self.heap and self.heap[0][0] <= now:
+      pending = heapq.heappop(self.heap)[2]
+      if pending.cancelled:
+        continue
+      if minimum is not None and pending.priority < minimum:
+        held.append(pending)
+      else:
+        due.append(pending)
+    for pending in held:
+      self.push(pending)
+
+    due.sort(key=lambda pending: (-pending.priority, pending.due))
+    try:
+      for pending in due:
+        pending.run(monotonic())
+    finally:
+      # Even if something got past job.run(), keep every job scheduled.
+      for pending in due:
+        if not pending.cancelled:
+          self.push(pending)
+
+    return len(due)
+
+  def run(self, duration=None):
+    """
+    Run jobs, sleeping in between, for 'duration' seconds or forever if
+    not given.
+    """
+    end = None
+    if duration is not None:
+      end = monotonic() + duration
+
+    while end is None or monotonic() < end:
+      wait = self.time_until_next()
+      if wait is None:
+        wait = 1.0
+      if end is not None:
+        wait = min(wait, end - monotonic())
+      if wait > 0:
+        time.sleep(wait)
+      self.run_pending()
+
+  def serve(self, app, host='127.0.0.1', port=5000):
+    """
+    Serve Flask app with a single threaded web server that runs jobs as
+    they come due in between web requests. Never returns.
+    """
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app)
+    while True:
+      server.timeout = self.time_until_next()
+      server.handle_request()
+      self.run_pending()
+
+  def status(self):
+    """ List of every job's status, see job.status() """
+    return [self.jobs[name].status() for name in sorted(self.jobs)]
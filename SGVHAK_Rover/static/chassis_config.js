@@ -45,10 +45,21 @@ var requestWheels = function() {
 var updateWheels = function(data, textStatus, jqXHR) {
   Object.keys(data).forEach(function(key,index) {
     updateWheelCanvas(key, data[key].angle, data[key].velocity);
+    updateWheelHealth(key, data[key].health);
   })
   setTimeout(requestWheels, 200);
 }
 
+// List any motor controller devices of this wheel that are not responding.
+var updateWheelHealth = function(name, dead) {
+  var health = document.getElementById("health_"+name);
+  if (dead.length > 0) {
+    health.textContent = "Not responding: " + dead.join(", ");
+  } else {
+    health.textContent = "";
+  }
+}
+
 // Given a wheel name, its angle, and its velocity, find the <canvas> tag
 // representing that wheel and draw a visual representation.
 var updateWheelCanvas = function(name, angle, velocity) {